@@ -0,0 +1,306 @@
+"""
+Several M-PESA lines, each with its own store and writer.
+
+A personal phone, a business till and an agent float are separate accounts:
+their balance chains and transaction codes must not mix, and a busy agent line
+should not hold up the personal one. Each source is mapped to an account by
+its device serial, file path or HTTP token, and each account is a shard: an
+MPESATransactionLogger with its own store, code index, rollups, balance chain,
+journal and sinks. ingest_service.py gives every shard its own queue and
+writer thread, and http_ingest.py routes posts by token.
+
+The map is a JSON file named by --accounts or MPESA_ACCOUNTS:
+
+    {"personal": {"serials": ["R58M12345"], "files": ["/sdcard/mpesa.txt"]},
+     "agent": {"serials": ["emulator-5554"], "tokens": ["till-7f3a"]}}
+
+Sources it does not name belong to the default account, which keeps the files
+used before accounts existed (mpesa_transactions.db, .xlsx and so on);
+account "agent" uses mpesa_transactions.agent.db, .agent.xlsx and so on.
+
+Queries that span accounts are answered here from each shard's own indexes:
+searches are merged newest first with a cursor per shard, dashboard totals
+add up the shards' rollups, and reports merge the shards' cursors in day order
+(report_export.AccountsReport).
+
+Usage: python ingest_service.py --accounts accounts.json --all-devices
+"""
+
+import heapq
+import json
+import os
+import re
+from contextlib import ExitStack
+
+from analytics import ALL, SPEND_TYPES, Rollup
+from mpesa_logger import MPESATransactionLogger
+from output_sinks import DEFAULT_SINKS, SINKS_ENV
+
+ACCOUNTS_ENV = "MPESA_ACCOUNTS"
+DEFAULT_ACCOUNT = "default"
+# Keys of an account entry and the source kind each one names
+SOURCE_KINDS = {"serials": "adb", "files": "file", "tokens": "token"}
+# Account names become part of file names
+_NAME_RE = re.compile(r'[A-Za-z0-9_-]+')
+
+
+def shard_file(path, account):
+    """The path an account uses for a file: 'mpesa.xlsx' becomes 'mpesa.agent.xlsx'"""
+    if account == DEFAULT_ACCOUNT:
+        return path
+    base, extension = os.path.splitext(path)
+    return f"{base}.{account}{extension}"
+
+
+def shard_sinks(spec, account):
+    """A sink spec for an account, with any explicit sink paths moved to the account's files"""
+    if spec is None:
+        spec = os.environ.get(SINKS_ENV) or DEFAULT_SINKS
+    if isinstance(spec, str):
+        spec = spec.split(",")
+    entries = []
+    for entry in spec:
+        kind, _, path = entry.strip().partition(":")
+        entries.append(f"{kind}:{shard_file(path, account)}" if path else kind)
+    return entries
+
+
+def _source_key(kind, key):
+    # The same file can be named relative to different directories
+    return (kind, os.path.abspath(key) if kind == "file" else key)
+
+
+class AccountMap:
+    """Which account each source belongs to"""
+
+    def __init__(self, accounts=None):
+        # {account: {"serials": [...], "files": [...], "tokens": [...]}}
+        self.accounts = accounts or {}
+        self.routes = {}
+        for account, sources in self.accounts.items():
+            if not isinstance(account, str) or not _NAME_RE.fullmatch(account):
+                raise ValueError(f"account names may only use letters, digits, '-' and '_': {account!r}")
+            if not isinstance(sources, dict):
+                raise ValueError(f"account {account!r} must be an object of serials, files and tokens")
+            for field, values in sources.items():
+                kind = SOURCE_KINDS.get(field)
+                if kind is None:
+                    raise ValueError(f"unknown source list {field!r} for account {account!r}; "
+                                     f"use {', '.join(SOURCE_KINDS)}")
+                if not isinstance(values, list):
+                    raise ValueError(f"{field} of account {account!r} must be a list")
+                for value in values:
+                    key = _source_key(kind, str(value))
+                    other = self.routes.setdefault(key, account)
+                    if other != account:
+                        raise ValueError(f"{kind} {value} is mapped to both {other!r} and {account!r}")
+
+    @classmethod
+    def load(cls, path):
+        """Read a map from a JSON file; raises ValueError if it cannot be used"""
+        try:
+            with open(path, encoding="utf-8") as f:
+                accounts = json.load(f)
+        except OSError as e:
+            raise ValueError(f"cannot read accounts from {path}: {e}") from e
+        if not isinstance(accounts, dict):
+            raise ValueError(f"{path} must hold an object of accounts")
+        return cls(accounts)
+
+    def names(self):
+        """Every account, the default one first"""
+        return [DEFAULT_ACCOUNT] + sorted(name for name in self.accounts if name != DEFAULT_ACCOUNT)
+
+    def account_for(self, kind, key):
+        """The account of a source: kind is adb, file or token and key its serial, path or token"""
+        if key is None:
+            return DEFAULT_ACCOUNT
+        return self.routes.get(_source_key(kind, key), DEFAULT_ACCOUNT)
+
+
+def load_accounts(path=None):
+    """The map in path (defaults to $MPESA_ACCOUNTS); with neither, every source is the default account"""
+    path = path or os.environ.get(ACCOUNTS_ENV)
+    return AccountMap.load(path) if path else AccountMap()
+
+
+class CombinedRollups:
+    """RollupEngine's queries answered across several accounts' rollups"""
+
+    def __init__(self, engines):
+        self.engines = engines
+
+    def total(self, period=ALL, transaction_type=None):
+        combined = Rollup()
+        for engine in self.engines:
+            combined.add(*engine.total(period, transaction_type).state())
+        return combined
+
+    def by_type(self, period=ALL):
+        combined = {}
+        for engine in self.engines:
+            for transaction_type, cell in engine.by_type(period).items():
+                combined.setdefault(transaction_type, Rollup()).add(*cell.state())
+        return combined
+
+    def by_counterparty(self, period=ALL, transaction_types=SPEND_TYPES, limit=None):
+        combined = {}
+        for engine in self.engines:
+            for party, cell in engine.by_counterparty(period, transaction_types):
+                combined.setdefault(party, Rollup()).add(*cell.state())
+        ranked = sorted(combined.items(), key=lambda item: item[1].total, reverse=True)
+        return ranked[:limit] if limit else ranked
+
+
+def _parse_cursor(cursor, accounts):
+    """{account: before id} from a cursor of 'account:id' pairs; accounts missing from it are done"""
+    if not cursor:
+        return {account: 0 for account in accounts}
+    positions = {}
+    for part in str(cursor).split(","):
+        account, _, before = part.partition(":")
+        if account not in accounts or not before.isdigit():
+            raise ValueError(f"invalid cursor {cursor!r}")
+        positions[account] = int(before)
+    return positions
+
+
+class ShardedLogger:
+    """One MPESATransactionLogger per account, with queries across all of them"""
+
+    def __init__(self, excel_file="mpesa_transactions.xlsx", accounts=None, sinks=None, loggers=None):
+        self.accounts = accounts or AccountMap()
+        # Loggers already open can be passed in; the other accounts are opened here
+        self.loggers = dict(loggers or {})
+        for name in self.accounts.names():
+            if name not in self.loggers:
+                self.loggers[name] = MPESATransactionLogger(shard_file(excel_file, name),
+                                                            sinks=shard_sinks(sinks, name))
+
+    @classmethod
+    def single(cls, logger):
+        """Wrap one logger as the default account"""
+        return cls(loggers={DEFAULT_ACCOUNT: logger})
+
+    @property
+    def default(self):
+        return self.loggers[DEFAULT_ACCOUNT]
+
+    def logger_for(self, kind, key):
+        """The logger of the account a source belongs to"""
+        return self.loggers[self.accounts.account_for(kind, key)]
+
+    def select(self, account=None):
+        """{account: logger} for one account, or for all of them; raises ValueError for unknown ones"""
+        if account is None:
+            return dict(self.loggers)
+        if account not in self.loggers:
+            raise ValueError(f"unknown account {account!r}; choose from {', '.join(self.loggers)}")
+        return {account: self.loggers[account]}
+
+    def start_batching(self, **options):
+        """Give every shard its own BatchWriter (see MPESATransactionLogger.start_batching)"""
+        for logger in self.loggers.values():
+            logger.start_batching(**options)
+
+    def flush(self):
+        return sum(logger.flush() for logger in self.loggers.values())
+
+    def close(self):
+        for logger in self.loggers.values():
+            logger.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def rollups(self, account=None):
+        """Rollups for one account, or their sum across all of them"""
+        selected = self.select(account)
+        if len(selected) == 1:
+            return next(iter(selected.values())).rollups
+        return CombinedRollups([logger.rollups for logger in selected.values()])
+
+    def count(self, account=None):
+        return sum(logger.store.count() for logger in self.select(account).values())
+
+    def search(self, text=None, before=None, limit=50, account=None, **filters):
+        """Search one account or all of them, newest first; returns (rows, next_cursor)
+
+        Rows carry their "account". Each shard is searched through its own
+        indexes for a page in id order, and the pages are merged by processing
+        time without reordering any shard's rows. The cursor lists each shard
+        that still has rows as 'account:id', the id to continue before (0 when
+        none of its rows were shown yet).
+        """
+        selected = self.select(account)
+        if len(selected) == 1:
+            (name, logger), = selected.items()
+            rows, next_cursor = logger.search(text, before=before, limit=limit, **filters)
+            for row in rows:
+                row["account"] = name
+            return rows, next_cursor
+
+        positions = _parse_cursor(before, selected)
+        pages, remaining = {}, {}
+        for name, position in positions.items():
+            rows, next_cursor = selected[name].search(text, before=position or None, limit=limit, **filters)
+            for row in rows:
+                row["account"] = name
+            pages[name] = rows
+            remaining[name] = next_cursor
+        # Shards page by id, and imports or a journal replay store rows after newer ones, so
+        # processing time is not sorted within a page. Keying each row by the oldest time up to
+        # it keeps the merge's input sorted and every shard's rows in id order, which the cursor needs.
+        def keyed(rows):
+            oldest = None
+            for row in rows:
+                time = row["processed_datetime"] or ""
+                oldest = time if oldest is None else min(oldest, time)
+                yield oldest, row
+
+        merged = heapq.merge(*(keyed(rows) for rows in pages.values()), key=lambda item: item[0], reverse=True)
+        page = [row for _, (_, row) in zip(range(int(limit)), merged)]
+
+        shown = {}
+        for row in page:
+            shown[row["account"]] = row["id"]
+        cursor = []
+        for name, position in positions.items():
+            if name not in shown:
+                if pages[name]:
+                    cursor.append(f"{name}:{position}")
+            elif shown[name] != pages[name][-1]["id"] or remaining[name]:
+                cursor.append(f"{name}:{shown[name]}")
+        return page, ",".join(cursor) or None
+
+    def report(self, account=None, **options):
+        """A report over one account or all of them; returns (report, connections to close)
+
+        Options are those of report_export.Report. Queued transactions are
+        flushed first and each store is read on its own read-only connection.
+        """
+        # The report writer is only imported once a report is asked for
+        from report_export import AccountsReport, Report
+
+        selected = self.select(account)
+        conns = {}
+        for name, logger in selected.items():
+            logger.flush()
+            conns[name] = logger.store.open_reader()
+        if len(conns) == 1:
+            return Report(next(iter(conns.values())), **options), list(conns.values())
+        return AccountsReport(conns, **options), list(conns.values())
+
+    def export_report(self, target, account=None, subtotals=False, **filters):
+        """Stream a report over one account or all of them to an .xlsx or .csv file"""
+        report, conns = self.report(account, subtotals=subtotals, **filters)
+        with ExitStack() as stack:
+            for conn in conns:
+                stack.callback(conn.close)
+            count = report.write(target)
+        print(f"📊 Wrote a report of {count} transactions from {len(conns)} accounts to {target}")
+        return count
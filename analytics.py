@@ -0,0 +1,251 @@
+"""
+Incremental daily/monthly rollups for spending analytics.
+
+Every logged transaction updates a handful of counters (sum, count, fees and
+min/max balance, all in integer cents) at three granularities: per day
+("2025-08-20"), per month ("2025-08") and all time ("all"). Within a period,
+the counters exist per transaction type and counterparty, per type, and for
+the whole period. Questions like "spend per merchant this month" only read
+that month's cells instead of rescanning the history.
+
+Rollups are snapshotted to a JSON file with the id of the last store row they
+cover; on load, rows added since are caught up from the store. A full rebuild
+aggregates the store with pandas group-bys.
+"""
+
+import json
+import os
+import threading
+from datetime import datetime
+from decimal import Decimal
+
+SPEND_TYPES = ("Send Money", "Pay Bill/Buy Goods", "Withdraw", "Airtime")
+GRANULARITIES = ("day", "month", "all")
+ALL = "all"
+
+
+def _cents(value):
+    # Parsed amounts have at most two decimal places, so this is exact
+    return None if value is None else int(value * 100)
+
+
+def _money(cents):
+    return None if cents is None else str(Decimal(cents).scaleb(-2))
+
+
+def period_keys(moment):
+    """Return the (day, month, all) period keys for a datetime"""
+    month = f"{moment.year:04d}-{moment.month:02d}"
+    return f"{month}-{moment.day:02d}", month, ALL
+
+
+class Rollup:
+    """Counters for one cell; money is held in integer cents"""
+
+    __slots__ = ("total", "count", "fees", "min_balance", "max_balance")
+
+    def __init__(self, total=0, count=0, fees=0, min_balance=None, max_balance=None):
+        self.total = total
+        self.count = count
+        self.fees = fees
+        self.min_balance = min_balance
+        self.max_balance = max_balance
+
+    def add(self, total, count, fees, min_balance, max_balance):
+        self.total += total
+        self.count += count
+        self.fees += fees
+        if min_balance is not None and (self.min_balance is None or min_balance < self.min_balance):
+            self.min_balance = min_balance
+        if max_balance is not None and (self.max_balance is None or max_balance > self.max_balance):
+            self.max_balance = max_balance
+
+    def state(self):
+        return [self.total, self.count, self.fees, self.min_balance, self.max_balance]
+
+    def as_dict(self):
+        """Return the counters with money as decimal strings in KSh"""
+        return {
+            "total": _money(self.total),
+            "count": self.count,
+            "fees": _money(self.fees),
+            "min_balance": _money(self.min_balance),
+            "max_balance": _money(self.max_balance),
+        }
+
+    def __repr__(self):
+        return f"Rollup({self.as_dict()})"
+
+
+class RollupEngine:
+    """Daily, monthly and all-time rollups per transaction type and counterparty"""
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        # periods[period][(type, party)] with None standing for "every" type/party
+        self.periods = {}
+        self.last_id = 0
+        self.lock = threading.Lock()
+
+    def _add(self, keys, transaction_type, party, counters):
+        for period in keys:
+            cells = self.periods.get(period)
+            if cells is None:
+                cells = self.periods[period] = {}
+            for key in ((transaction_type, party), (transaction_type, None), (None, None)):
+                cell = cells.get(key)
+                if cell is None:
+                    cell = cells[key] = Rollup()
+                cell.add(*counters)
+
+    def add_many(self, transactions):
+        """Fold newly stored transactions into the rollups"""
+        with self.lock:
+            for transaction in transactions:
+                moment = transaction.transaction_datetime or transaction.processed_datetime
+                balance = _cents(transaction.new_balance)
+                counters = (_cents(transaction.amount), 1, _cents(transaction.transaction_cost), balance, balance)
+                self._add(period_keys(moment), transaction.transaction_type,
+                          transaction.recipient_sender, counters)
+
+    def add(self, transaction):
+        self.add_many([transaction])
+
+    def load(self, store):
+        """Load the snapshot and catch up with rows stored since it was written"""
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file, encoding="utf-8") as f:
+                    self._restore(json.load(f))
+            except (ValueError, KeyError, TypeError):
+                # A damaged snapshot is rebuilt from the store below
+                self.periods = {}
+                self.last_id = 0
+        if self.last_id > store.max_id():
+            # The snapshot belongs to a different or rebuilt store
+            self.periods = {}
+            self.last_id = 0
+        if self.last_id == 0 and store.count():
+            return self.rebuild(store)
+        if store.max_id() > self.last_id:
+            self._aggregate(store, self.last_id)
+        return self
+
+    def rebuild(self, store):
+        """Recompute every rollup from the store with vectorized group-bys"""
+        with self.lock:
+            self.periods = {}
+            self.last_id = 0
+        self._aggregate(store, 0)
+        self.save()
+        return self
+
+    def catch_up(self, store, after_id):
+        """Fold store rows with id > after_id in with group-bys (used after bulk imports)"""
+        self._aggregate(store, after_id)
+
+    def _aggregate(self, store, after_id, chunk_size=250000):
+        # pandas is only needed here, so it is not imported on every startup
+        import pandas as pd
+
+        query = ("SELECT id, amount, transaction_type, recipient_sender, date, new_balance, "
+                 "transaction_cost, processed_datetime FROM transactions WHERE id > ? ORDER BY id")
+        for frame in pd.read_sql_query(query, store.conn, params=(after_id,), chunksize=chunk_size):
+            if frame.empty:
+                continue
+
+            def cents(column):
+                values = pd.to_numeric(column.str.replace(",", "", regex=False), errors="coerce")
+                return (values * 100).round()
+
+            day = pd.to_datetime(frame["date"], format="%d/%m/%y", errors="coerce")
+            day = day.fillna(pd.to_datetime(frame["processed_datetime"].str[:10], format="%Y-%m-%d", errors="coerce"))
+            balance = cents(frame["new_balance"])
+            rows = pd.DataFrame({
+                "type": frame["transaction_type"],
+                "party": frame["recipient_sender"],
+                "day": day.dt.strftime("%Y-%m-%d"),
+                "month": day.dt.strftime("%Y-%m"),
+                "all": ALL,
+                "total": cents(frame["amount"]).fillna(0).astype("int64"),
+                "fees": cents(frame["transaction_cost"]).fillna(0).astype("int64"),
+                "min_balance": balance,
+                "max_balance": balance,
+            })
+
+            with self.lock:
+                for granularity in GRANULARITIES:
+                    grouped = rows.groupby([granularity, "type", "party"], dropna=False).agg(
+                        total=("total", "sum"), count=("total", "size"), fees=("fees", "sum"),
+                        min_balance=("min_balance", "min"), max_balance=("max_balance", "max"),
+                    )
+                    for (period, transaction_type, party), total, count, fees, low, high in grouped.itertuples(name=None):
+                        if pd.isna(period):
+                            continue
+                        counters = (int(total), int(count), int(fees),
+                                    None if pd.isna(low) else int(low), None if pd.isna(high) else int(high))
+                        self._add((period,), transaction_type, party, counters)
+                self.last_id = int(frame["id"].iloc[-1])
+
+    def _restore(self, state):
+        periods = {}
+        for period, cells in state["periods"].items():
+            periods[period] = {(transaction_type, party): Rollup(*counters)
+                               for transaction_type, party, counters in cells}
+        self.periods = periods
+        self.last_id = state["last_id"]
+
+    def save(self, last_id=None):
+        """Snapshot the rollups; last_id is the newest store row they include"""
+        with self.lock:
+            if last_id is not None:
+                self.last_id = last_id
+            state = {
+                "last_id": self.last_id,
+                "periods": {
+                    period: [[transaction_type, party, cell.state()] for (transaction_type, party), cell in cells.items()]
+                    for period, cells in self.periods.items()
+                },
+            }
+        temp_file = self.state_file + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(temp_file, self.state_file)
+
+    def total(self, period=ALL, transaction_type=None):
+        """Counters for a period, optionally for one transaction type"""
+        with self.lock:
+            cell = self.periods.get(period, {}).get((transaction_type, None))
+            return Rollup(*cell.state()) if cell else Rollup()
+
+    def by_type(self, period=ALL):
+        """{transaction type: Rollup} for a period"""
+        with self.lock:
+            return {transaction_type: Rollup(*cell.state())
+                    for (transaction_type, party), cell in self.periods.get(period, {}).items()
+                    if transaction_type is not None and party is None}
+
+    def by_counterparty(self, period=ALL, transaction_types=SPEND_TYPES, limit=None):
+        """[(counterparty, Rollup)] for a period, largest total first"""
+        with self.lock:
+            totals = {}
+            for (transaction_type, party), cell in self.periods.get(period, {}).items():
+                if party is None or (transaction_types and transaction_type not in transaction_types):
+                    continue
+                totals.setdefault(party, Rollup()).add(*cell.state())
+        ranked = sorted(totals.items(), key=lambda item: item[1].total, reverse=True)
+        return ranked[:limit] if limit else ranked
+
+    def periods_of(self, granularity):
+        """Sorted period keys for a granularity: day, month or all"""
+        length = {"day": 10, "month": 7}.get(granularity)
+        with self.lock:
+            if length is None:
+                return [ALL] if ALL in self.periods else []
+            return sorted(p for p in self.periods if p != ALL and len(p) == length)
+
+
+def current_periods(now=None):
+    """(today, this month) period keys"""
+    day, month, _ = period_keys(now or datetime.now())
+    return day, month
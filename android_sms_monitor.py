@@ -1,89 +1,168 @@
 # Android SMS Monitoring Integration
 # This requires additional setup with Android ADB or SMS monitoring apps
 
-import subprocess
+import logging
+import os
 import time
-import re
+from instrumentation import REGISTRY, configure_logging, stage
 from mpesa_logger import MPESATransactionLogger  # Import our main logger
+from mpesa_parser import is_confirmation
+
+log = logging.getLogger(__name__)
+
+def is_mpesa_message(message):
+    """Check if the message is an M-PESA confirmation, not just any SMS mentioning Ksh or a balance"""
+    return is_confirmation(message)
 
 class AndroidSMSMonitor:
-    def __init__(self, excel_file="mpesa_transactions.xlsx"):
-        self.logger = MPESATransactionLogger(excel_file)
-        self.mpesa_keywords = ['confirmed', 'ksh', 'm-pesa', 'transaction', 'balance']
+    def __init__(self, excel_file="mpesa_transactions.xlsx", batch_size=50, flush_ms=1000, sinks=None, journal=True):
+        self.logger = MPESATransactionLogger(excel_file, sinks=sinks)
+        # Bursts (e.g. after the phone reconnects) are written as one group commit, and
+        # journaled first so the cursor can move on before that commit
+        self.logger.start_batching(max_rows=batch_size, max_delay_ms=flush_ms, mirror=True, journal=journal)
+        self.base_name = os.path.splitext(excel_file)[0]
+        self.adb_cursor_file = self.base_name + ".adb_cursor.json"
         
     def is_mpesa_message(self, message):
-        """Check if the message is likely an M-PESA transaction"""
-        message_lower = message.lower()
-        return any(keyword in message_lower for keyword in self.mpesa_keywords)
+        """Check if the message is an M-PESA confirmation"""
+        return is_mpesa_message(message)
     
-    def monitor_sms_adb(self):
-        """Monitor SMS using ADB (requires USB debugging enabled)"""
+    def monitor_sms_adb(self, min_interval=0.5, max_interval=3.0, serial=None, senders=None):
+        """Monitor SMS using ADB (requires USB debugging enabled)
+        
+        senders is a comma-separated allowlist of sender addresses selected on
+        the phone (default: $MPESA_SENDERS or MPESA; "*" fetches every SMS).
+        """
+        # Each monitoring method imports its own modules, keeping start-up fast
+        from adb_inbox import AdaptiveInterval, AdbInboxReader, InboxCursor, device_cursor_file, sender_allowlist
+        from balance_reconciler import refetch_gaps
+        
         print("🔍 Starting SMS monitoring via ADB...")
         print("📱 Make sure your Android device is connected with USB debugging enabled")
         
-        # This is a simplified approach - you might need to use specific ADB commands
-        # depending on your Android version and permissions
+        # Only rows past the persisted high-water mark are transferred each poll,
+        # over one adb shell session kept open between polls
+        cursor_path = device_cursor_file(self.base_name, serial) if serial else self.adb_cursor_file
+        cursor = InboxCursor(cursor_path)
+        reader = AdbInboxReader(cursor, serial=serial, senders=sender_allowlist(senders))
+        interval = AdaptiveInterval(min_interval, max_interval)
+        if cursor.last_id:
+            log.info("Resuming after inbox row %s", cursor.last_id)
         
         try:
+            connected = True
             while True:
-                # Get SMS messages (this is a placeholder - actual implementation depends on device)
-                # You may need to use: adb shell content query --uri content://sms/inbox
-                result = subprocess.run([
-                    'adb', 'shell', 'content', 'query',
-                    '--uri', 'content://sms/inbox',
-                    '--projection', 'address,body,date',
-                    '--where', 'read=0'
-                ], capture_output=True, text=False)
-
-                if result.returncode == 0 and result.stdout:
-                    # Decode the output to handle encoding issues
-                    stdout = result.stdout.decode('utf-8', errors='replace')
-                    # Parse the output and look for new M-PESA messages
-                    print("📨 New SMS detected, checking for M-PESA...")
-                    print(f"ADB Output: {stdout[:200]}...")  # Debug: show first 200 chars
-
-                    # Parse ADB output to extract SMS body
-                    body_match = re.search(r'body=(.+)', stdout)
-                    if body_match:
-                        body = body_match.group(1).strip()
-                        if self.is_mpesa_message(body):
-                            print("🆕 M-PESA message found, processing...")
-                            self.logger.process_message(body)
-                        else:
-                            print("📨 SMS detected but not M-PESA")
-                    else:
-                        print("❌ Could not extract SMS body from ADB output")
+                try:
+                    with stage("poll"):
+                        rows = reader.fetch()
+                except (ConnectionError, RuntimeError) as e:
+                    if connected:
+                        log.warning("ADB connection lost (%s), reconnecting...", e)
+                    REGISTRY.inc("mpesa_errors_total", stage="poll")
+                    connected = False
+                    time.sleep(interval.fail())
+                    continue
+                
+                if not connected:
+                    log.info("ADB reconnected")
+                    connected = True
+                
+                if rows:
+                    log.info("%d new SMS detected, checking for M-PESA...", len(rows))
+                    self.process_inbox_rows(rows, "adb")
+                    # The mark moves only once the rows are journaled (or committed), so
+                    # a crash re-reads a poll instead of losing it
+                    cursor.advance(rows)
+                    cursor.save()
+                
+                # A break in the balance chain means messages were missed; ask for just their time window
+                try:
+                    recovered = refetch_gaps(self.logger.reconciler, reader, self.logger.code_index)
+                except (ConnectionError, RuntimeError) as e:
+                    log.warning("Re-fetch failed (%s), retrying later", e)
+                    REGISTRY.inc("mpesa_errors_total", stage="refetch")
+                    recovered = []
+                if recovered:
+                    self.process_inbox_rows(recovered, "adb:refetch")
                 
-                time.sleep(10)  # Check every 10 seconds
+                # Poll quickly while messages are arriving, back off when idle
+                time.sleep(interval.next(bool(rows)))
                 
         except KeyboardInterrupt:
             print("\n⏹️ SMS monitoring stopped")
         except FileNotFoundError:
             print("❌ ADB not found. Please install Android SDK platform-tools")
+        finally:
+            reader.close()
+            self.logger.flush()
+    
+    def process_inbox_rows(self, rows, source):
+        """Filter inbox rows and hand the M-PESA ones to the logger, journaled (or committed) on return"""
+        REGISTRY.inc("mpesa_messages_received_total", len(rows), source=source)
+        entries = []
+        for row in rows:
+            body = row["body"]
+            with stage("filter"):
+                accepted = self.is_mpesa_message(body)
+            if accepted:
+                # The inbox date (milliseconds) is when the SMS reached the phone
+                arrived = int(row["date"]) / 1000 if row.get("date") else None
+                entries.append((body, arrived, None))
+        self.logger.process_durably(entries)
+        if self.logger.journal is None:
+            self.logger.flush()
+        else:
+            self.logger.flush_soon()
+    
+    def monitor_all_devices(self):
+        """Monitor every attached device concurrently, picking up phones as they are plugged in"""
+        # Imported here because the ingest service builds on this module
+        import asyncio
+        from adb_inbox import sender_allowlist
+        from ingest_service import IngestService, devices_source
+        
+        print("🔍 Starting SMS monitoring on all ADB devices...")
+        service = IngestService(self.logger, accept=self.is_mpesa_message)
+        service.add_source("devices", devices_source(self.base_name, senders=sender_allowlist()))
+        asyncio.run(service.run())
     
     def monitor_sms_file(self, file_path):
         """Monitor SMS from a text file (for testing or manual input)"""
+        from file_tailer import FileTailer, cursor_file
+        
         print(f"📁 Monitoring SMS from file: {file_path}")
         
-        processed_lines = set()
+        # Reads only appended lines, resuming from the saved offset after a restart
+        tailer = FileTailer(file_path, cursor_file(self.base_name, file_path))
         
         try:
-            while True:
-                if os.path.exists(file_path):
-                    with open(file_path, 'r') as f:
-                        lines = f.readlines()
-                    
-                    for i, line in enumerate(lines):
-                        line = line.strip()
-                        if line and i not in processed_lines and self.is_mpesa_message(line):
-                            print(f"\n🆕 New M-PESA message detected!")
-                            self.logger.process_message(line)
-                            processed_lines.add(i)
-                
-                time.sleep(5)  # Check every 5 seconds
+            for lines in tailer.follow():
+                entries = []
+                for line in lines:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    REGISTRY.inc("mpesa_messages_received_total", source="file")
+                    with stage("filter"):
+                        accepted = self.is_mpesa_message(line)
+                    if accepted:
+                        entries.append((line, None, None))
+                self.logger.process_durably(entries)
+                if self.logger.journal is None:
+                    self.logger.flush()
+                else:
+                    self.logger.flush_soon()
+                tailer.commit()
                 
         except KeyboardInterrupt:
             print("\n⏹️ File monitoring stopped")
+        finally:
+            tailer.close()
+            self.logger.flush()
+    
+    def close(self):
+        """Flush queued transactions and close the logger"""
+        self.logger.close()
 
 # Alternative approach using Tasker (Android automation app)
 class TaskerIntegration:
@@ -132,8 +211,7 @@ class TaskerIntegration:
 
 # Main execution
 if __name__ == "__main__":
-    import os
-    
+    configure_logging()
     print("📱 M-PESA Real-time SMS Monitor")
     print("=" * 40)
     
@@ -143,24 +221,31 @@ if __name__ == "__main__":
     print("1. ADB Method (requires Android SDK)")
     print("2. File Method (manual/Tasker integration)")
     print("3. Show Tasker setup instructions")
+    print("4. ADB Method on all connected devices")
     
-    choice = input("\nEnter your choice (1-3): ").strip()
+    try:
+        choice = input("\nEnter your choice (1-4): ").strip()
     
-    if choice == "1":
-        monitor.monitor_sms_adb()
-    elif choice == "2":
-        file_path = input("Enter path to SMS file (or press Enter for 'sms_messages.txt'): ").strip()
-        if not file_path:
-            file_path = "sms_messages.txt"
-            # Create sample file if it doesn't exist
-            if not os.path.exists(file_path):
-                with open(file_path, 'w') as f:
-                    f.write("THK04TF1W4 Confirmed. Ksh250.00 sent to Antony Kiumbe on 20/8/25 at 10:15 AM. New M-PESA balance is Ksh93.09. Transaction cost, Ksh7.00.\n")
-                print(f"📄 Created sample file: {file_path}")
+        if choice == "1":
+            monitor.monitor_sms_adb()
+        elif choice == "2":
+            file_path = input("Enter path to SMS file (or press Enter for 'sms_messages.txt'): ").strip()
+            if not file_path:
+                file_path = "sms_messages.txt"
+                # Create sample file if it doesn't exist
+                if not os.path.exists(file_path):
+                    with open(file_path, 'w') as f:
+                        f.write("THK04TF1W4 Confirmed. Ksh250.00 sent to Antony Kiumbe on 20/8/25 at 10:15 AM. New M-PESA balance is Ksh93.09. Transaction cost, Ksh7.00.\n")
+                    print(f"📄 Created sample file: {file_path}")
         
-        monitor.monitor_sms_file(file_path)
-    elif choice == "3":
-        tasker = TaskerIntegration()
-        tasker.setup_instructions()
-    else:
-        print("❌ Invalid choice")
\ No newline at end of file
+            monitor.monitor_sms_file(file_path)
+        elif choice == "3":
+            tasker = TaskerIntegration()
+            tasker.setup_instructions()
+        elif choice == "4":
+            monitor.monitor_all_devices()
+        else:
+            print("❌ Invalid choice")
+    finally:
+        # Guarantees queued transactions are written on exit or Ctrl+C
+        monitor.close()
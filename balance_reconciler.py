@@ -0,0 +1,341 @@
+"""
+Balance-chain reconciliation: finds M-PESA messages that never reached the store.
+
+Every confirmation ends with the account balance after the transaction, so
+each one can be checked against the one before it: the previous balance plus
+the amount received, or minus the amount and fee sent, paid or withdrawn, must
+give the new balance. The reconciler keeps the head of that chain (the latest
+transaction by time) and checks each newly stored transaction against it, one
+comparison per message. A mismatch is recorded as a gap: the transactions on
+either side, their times, and the balances the missing ones must bridge.
+Transactions stored late (older than the head, e.g. recovered ones) are
+matched against the open gaps instead and close them from either end.
+
+Each open gap spans a few minutes of inbox time, so the ADB sources ask the
+phone for just that date range (AdbInboxReader.fetch_range) instead of
+rescanning the inbox; rows already stored are dropped by the duplicate check.
+Confirmation times are the phone's wall clock, so windows are converted to
+Unix time with the phone's own UTC offset (AdbInboxReader.utc_offset).
+A gap is fetched again after each of RETRY_DELAYS in case its SMS was delayed,
+then left open for `mpesa_logger.py reconcile` to report.
+
+The chain is snapshotted to JSON with the id of the last store row it covers,
+as the rollups are; on load, rows stored since are caught up from the store.
+"""
+
+import calendar
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from instrumentation import REGISTRY, stage
+from mpesa_parser import parse_datetime
+from transaction_store import amount_cents
+
+log = logging.getLogger(__name__)
+
+# +1 adds the amount to the balance; -1 takes off the amount and the fee.
+# Other types have no known effect, so the chain restarts at them unchecked.
+DIRECTIONS = {
+    "Receive Money": 1,
+    "Deposit": 1,
+    "Reversal": 1,
+    "M-Shwari Withdraw": 1,
+    "Send Money": -1,
+    "Pay Bill/Buy Goods": -1,
+    "Withdraw": -1,
+    "Airtime": -1,
+    "M-Shwari Deposit": -1,
+}
+# Seconds to wait before each fetch of a gap's window, counted from the previous one
+RETRY_DELAYS = (0, 60, 600, 3600)
+# Confirmations carry the minute of the transaction and the inbox date is when the
+# SMS reached the phone, so windows are widened by this many seconds each side
+WINDOW_SLACK = 300
+MAX_GAPS = 500
+
+REGISTRY.describe("mpesa_balance_gaps_total", "counter", "Breaks found in the balance chain")
+REGISTRY.describe("mpesa_balance_gaps_closed_total", "counter", "Balance chain breaks closed by late transactions")
+REGISTRY.describe("mpesa_balance_gaps_open", "gauge", "Balance chain breaks still open")
+REGISTRY.describe("mpesa_refetches_total", "counter", "Narrow inbox queries for balance chain breaks")
+
+
+def _cents(value):
+    # Parsed amounts have at most two decimal places, so this is exact
+    return None if value is None else int(value * 100)
+
+
+def _money(cents):
+    return f"{cents / 100:.2f}"
+
+
+def _log_gap(level, gap):
+    log.log(level, "Balance chain gap between %s and %s: KSh %s unaccounted for",
+            gap.after, gap.before, _money(gap.end_balance - gap.start_balance))
+
+
+def balance_before(transaction_type, amount, cost, balance):
+    """Balance in cents before a transaction, or None when its type's effect is unknown"""
+    direction = DIRECTIONS.get(transaction_type)
+    if direction is None or amount is None or balance is None:
+        return None
+    return balance - amount if direction > 0 else balance + amount + (cost or 0)
+
+
+class BalanceGap:
+    """A break in the chain between two stored transactions"""
+
+    __slots__ = ("after", "before", "start", "end", "start_balance", "end_balance", "attempts", "next_fetch")
+
+    def __init__(self, after, before, start, end, start_balance, end_balance, attempts=0, next_fetch=0.0):
+        self.after = after
+        self.before = before
+        self.start = start
+        self.end = end
+        # Balance after the transaction `after`, and before the transaction `before`
+        self.start_balance = start_balance
+        self.end_balance = end_balance
+        self.attempts = attempts
+        self.next_fetch = next_fetch
+
+    def contains(self, moment):
+        return self.start <= moment <= self.end
+
+    def window(self, slack=WINDOW_SLACK, utc_offset=None):
+        """(first, last) inbox date to query, in Unix milliseconds
+
+        utc_offset is the phone's offset from UTC in seconds; without it the
+        times are taken to be in this host's time zone.
+        """
+        if utc_offset is None:
+            start, end = time.mktime(self.start.timetuple()), time.mktime(self.end.timetuple())
+        else:
+            start = calendar.timegm(self.start.timetuple()) - utc_offset
+            end = calendar.timegm(self.end.timetuple()) - utc_offset
+        # The end time is to the minute, so the whole minute is included
+        return int((start - slack) * 1000), int((end + 60 + slack) * 1000)
+
+    def state(self):
+        return [self.after, self.before, self.start.isoformat(), self.end.isoformat(),
+                self.start_balance, self.end_balance, self.attempts, self.next_fetch]
+
+    @classmethod
+    def from_state(cls, state):
+        after, before, start, end, *rest = state
+        return cls(after, before, datetime.fromisoformat(start), datetime.fromisoformat(end), *rest)
+
+    def as_dict(self):
+        """Return the gap with times as strings and money in KSh"""
+        return {
+            "after": self.after,
+            "before": self.before,
+            "start": self.start.isoformat(sep=" ", timespec="minutes"),
+            "end": self.end.isoformat(sep=" ", timespec="minutes"),
+            "missing": _money(self.end_balance - self.start_balance),
+            "attempts": self.attempts,
+        }
+
+    def __repr__(self):
+        return f"BalanceGap({self.as_dict()})"
+
+
+class BalanceReconciler:
+    """Checks each stored transaction against the balance chain and tracks its gaps"""
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        # (time, code, balance in cents) of the latest transaction in the chain
+        self.head = None
+        self.gaps = []
+        self.last_id = 0
+        self.lock = threading.Lock()
+
+    def add_many(self, transactions):
+        """Check newly stored transactions against the chain"""
+        with self.lock:
+            for t in transactions:
+                amount, balance = _cents(t.amount), _cents(t.new_balance)
+                before = balance_before(t.transaction_type, amount, _cents(t.transaction_cost), balance)
+                gap = self._check(t.transaction_datetime, t.transaction_code, balance, before)
+                if gap:
+                    _log_gap(logging.WARNING, gap)
+            REGISTRY.set("mpesa_balance_gaps_open", len(self.gaps))
+
+    def add(self, transaction):
+        self.add_many([transaction])
+
+    def _check(self, moment, code, balance, before):
+        """Extend the chain with a transaction; returns the gap it opened, if any"""
+        if moment is None or balance is None:
+            return None
+        head = self.head
+        if head is None or (moment >= head[0] and (before is None or before == head[2])):
+            self.head = (moment, code, balance)
+            return None
+        if before is not None and self._fill(moment, code, balance, before):
+            return None
+        if moment >= head[0]:
+            gap = self._open(BalanceGap(head[1], code, head[0], moment, head[2], before))
+            self.head = (moment, code, balance)
+            return gap
+        # Otherwise it predates the chain, which starts after it
+        return None
+
+    def _fill(self, moment, code, balance, before):
+        """Narrow the open gap a late transaction belongs to; returns False if it fits none"""
+        # Late transactions mostly belong to the newest gaps
+        for i in range(len(self.gaps) - 1, -1, -1):
+            gap = self.gaps[i]
+            if not gap.contains(moment):
+                continue
+            if before == gap.start_balance:
+                gap.after, gap.start, gap.start_balance = code, moment, balance
+            elif balance == gap.end_balance:
+                gap.before, gap.end, gap.end_balance = code, moment, before
+            else:
+                continue
+            if gap.start_balance == gap.end_balance:
+                del self.gaps[i]
+                REGISTRY.inc("mpesa_balance_gaps_closed_total")
+                log.info("Balance chain gap between %s and %s closed", gap.after, gap.before)
+            return True
+        return False
+
+    def _open(self, gap):
+        self.gaps.append(gap)
+        if len(self.gaps) > MAX_GAPS:
+            del self.gaps[0]
+        REGISTRY.inc("mpesa_balance_gaps_total")
+        return gap
+
+    def due(self, now=None, limit=1, force=False):
+        """Claim up to limit gaps whose window should be fetched now (every open gap with force)"""
+        now = time.time() if now is None else now
+        claimed = []
+        with self.lock:
+            for gap in self.gaps:
+                if limit is not None and len(claimed) >= limit:
+                    break
+                if not force and (gap.attempts >= len(RETRY_DELAYS) or gap.next_fetch > now):
+                    continue
+                gap.attempts += 1
+                if gap.attempts < len(RETRY_DELAYS):
+                    gap.next_fetch = now + RETRY_DELAYS[gap.attempts]
+                claimed.append(gap)
+        return claimed
+
+    def open_gaps(self):
+        """The open gaps, oldest first"""
+        with self.lock:
+            return list(self.gaps)
+
+    def load(self, store):
+        """Load the snapshot and catch up with rows stored since it was written"""
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file, encoding="utf-8") as f:
+                    self._restore(json.load(f))
+            except (ValueError, KeyError, TypeError):
+                # A damaged snapshot is rebuilt from the store below
+                self._reset()
+        if self.last_id > store.max_id():
+            # The snapshot belongs to a different or rebuilt store
+            self._reset()
+        if store.max_id() > self.last_id:
+            self.catch_up(store, self.last_id)
+        return self
+
+    def rebuild(self, store):
+        """Recheck the whole store from its oldest transaction"""
+        with self.lock:
+            self._reset()
+        self.catch_up(store, 0)
+        self.save()
+        return self
+
+    def catch_up(self, store, after_id):
+        """Check store rows with id > after_id (used on load and after bulk imports)"""
+        rows = store.conn.execute(
+            "SELECT id, day, transaction_code, amount, transaction_type, date, time, new_balance, "
+            "transaction_cost FROM transactions WHERE id > ? ORDER BY day, id", (after_id,)
+        )
+        opened = missing = 0
+        with self.lock, stage("reconcile"):
+            # Imports are often newest first, so rows are checked in time order, a day at a time
+            for _, day_rows in itertools.groupby(rows, key=lambda row: row[1]):
+                links = []
+                for row_id, _, code, amount, transaction_type, date, clock, balance, cost in day_rows:
+                    self.last_id = max(self.last_id, row_id)
+                    moment = parse_datetime(date, clock)
+                    if moment is None:
+                        continue
+                    balance = amount_cents(balance)
+                    before = balance_before(transaction_type, amount_cents(amount), amount_cents(cost), balance)
+                    links.append((moment, code, balance, before))
+                links.sort(key=lambda link: link[0])
+                for link in links:
+                    gap = self._check(*link)
+                    if gap:
+                        # An import can open thousands of gaps, so each one is only logged at debug
+                        _log_gap(logging.DEBUG, gap)
+                        opened += 1
+                        missing += gap.end_balance - gap.start_balance
+            REGISTRY.set("mpesa_balance_gaps_open", len(self.gaps))
+        if opened:
+            log.warning("Balance chain has %d new gaps with KSh %s unaccounted for; "
+                        "see `mpesa_logger.py reconcile`", opened, _money(missing))
+
+    def _reset(self):
+        self.head = None
+        self.gaps = []
+        self.last_id = 0
+
+    def _restore(self, state):
+        head = state["head"]
+        self.head = (datetime.fromisoformat(head[0]), head[1], head[2]) if head else None
+        self.gaps = [BalanceGap.from_state(gap) for gap in state["gaps"]]
+        self.last_id = state["last_id"]
+        REGISTRY.set("mpesa_balance_gaps_open", len(self.gaps))
+
+    def save(self, last_id=None):
+        """Snapshot the chain; last_id is the newest store row it includes"""
+        with self.lock:
+            if last_id is not None:
+                self.last_id = last_id
+            head = self.head
+            state = {
+                "last_id": self.last_id,
+                "head": [head[0].isoformat(), head[1], head[2]] if head else None,
+                "gaps": [gap.state() for gap in self.gaps],
+            }
+        temp_file = self.state_file + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(temp_file, self.state_file)
+
+
+def refetch_gaps(reconciler, reader, known=(), limit=1):
+    """Query the phone for the windows of gaps due a fetch; returns the inbox rows found
+
+    Runs on the thread that owns reader's shell session. Rows whose leading
+    transaction code is in known (the logger's code index) are left out, and
+    the rest go through the normal pipeline and its duplicate checks.
+    """
+    rows = []
+    utc_offset = None
+    for gap in reconciler.due(limit=limit):
+        with stage("refetch"):
+            if utc_offset is None:
+                # Read each time gaps are fetched, as the phone's zone can change
+                utc_offset = reader.utc_offset()
+            found = reader.fetch_range(*gap.window(utc_offset=utc_offset))
+        REGISTRY.inc("mpesa_refetches_total")
+        new = [row for row in found if row["body"][:10] not in known]
+        log.info("Fetched %d inbox rows (%d new) from %s to %s for the gap between %s and %s",
+                 len(found), len(new), gap.start, gap.end, gap.after, gap.before)
+        rows.extend(new)
+    return rows
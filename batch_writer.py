@@ -0,0 +1,145 @@
+import logging
+import threading
+import time
+
+from instrumentation import REGISTRY, record_commit, stage
+
+log = logging.getLogger(__name__)
+
+
+class BatchWriter:
+    """Queues parsed transactions and writes them as one group commit.
+
+    A flush happens when max_rows transactions are queued or max_delay_ms has
+    passed since the oldest queued one, whichever comes first. Each flush is a
+    single store transaction and, with mirror enabled, a single append to each
+    output sink, so bursts cost one write instead of one write per message.
+    Without mirror the sinks are only exported when the logger closes.
+    """
+
+    def __init__(self, logger, max_rows=50, max_delay_ms=1000, mirror=True):
+        self.logger = logger
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000.0
+        self.mirror = mirror
+        self.pending = []
+        self.pending_codes = set()
+        # Arrival time of each pending transaction, for the commit lag metric
+        self.arrivals = []
+        self.oldest = None
+        self.closed = False
+        self.lock = threading.RLock()
+        self.wakeup = threading.Condition(self.lock)
+        self.flusher = threading.Thread(target=self._flush_loop, name="batch-writer", daemon=True)
+        self.flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def is_pending(self, transaction_code):
+        """Check whether a transaction code is queued but not yet flushed"""
+        with self.lock:
+            return transaction_code in self.pending_codes
+
+    def add(self, transaction, arrived=None):
+        """Queue a transaction; returns False if its code is already queued
+
+        arrived is the Unix time the message reached the pipeline, defaulting to now.
+        """
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("BatchWriter is closed")
+            code = transaction.transaction_code
+            if code in self.pending_codes:
+                return False
+            self.pending.append(transaction)
+            self.pending_codes.add(code)
+            self.arrivals.append(time.time() if arrived is None else arrived)
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+                self.wakeup.notify()
+            if len(self.pending) >= self.max_rows:
+                self.flush()
+            return True
+
+    def flush_soon(self):
+        """Have the background flusher write what is queued now, without waiting for it here"""
+        with self.lock:
+            if self.pending:
+                self.oldest = time.monotonic() - self.max_delay
+                self.wakeup.notify()
+
+    def flush(self):
+        """Write every queued transaction now; returns the number stored"""
+        with self.lock:
+            journal = self.logger.journal
+            # Every journaled message handed to the logger so far is in this batch or was skipped
+            upto = journal.processed_seq if journal else 0
+            batch = self.pending
+            if not batch:
+                if journal:
+                    journal.compact(upto, self.logger.store)
+                return 0
+            arrivals = self.arrivals
+            self.pending = []
+            self.pending_codes = set()
+            self.arrivals = []
+            self.oldest = None
+
+            try:
+                with stage("flush"):
+                    inserted = self.logger.store.add_batch(batch)
+            except Exception:
+                log.exception("Error writing batch of %d transactions", len(batch))
+                REGISTRY.inc("mpesa_errors_total", stage="flush")
+                # Put the batch back so a later flush can retry it
+                self.pending = batch + self.pending
+                self.pending_codes.update(t.transaction_code for t in batch)
+                self.arrivals = arrivals + self.arrivals
+                self.oldest = time.monotonic()
+                return 0
+
+            self.logger.record_inserted(inserted)
+            if journal:
+                journal.compact(upto, self.logger.store)
+            inserted_ids = set(map(id, inserted))
+            record_commit(arrived for t, arrived in zip(batch, arrivals) if id(t) in inserted_ids)
+            REGISTRY.inc("mpesa_rows_written_total", len(inserted))
+            REGISTRY.inc("mpesa_messages_total", len(inserted), outcome="imported")
+            REGISTRY.inc("mpesa_messages_total", len(batch) - len(inserted), outcome="duplicate")
+
+            if inserted:
+                if self.mirror:
+                    self.logger.write_sinks(inserted)
+                else:
+                    self.logger.mark_sinks_stale()
+
+            log.info("Flushed %d transactions (%d duplicates skipped)",
+                     len(inserted), len(batch) - len(inserted))
+            return len(inserted)
+
+    def _flush_loop(self):
+        with self.lock:
+            while not self.closed:
+                if self.oldest is None:
+                    self.wakeup.wait()
+                    continue
+                remaining = self.oldest + self.max_delay - time.monotonic()
+                if remaining > 0:
+                    self.wakeup.wait(remaining)
+                    continue
+                self.flush()
+
+    def close(self):
+        """Flush anything queued and stop the background flusher"""
+        with self.lock:
+            if self.closed:
+                return
+            self.flush()
+            self.closed = True
+            self.wakeup.notify()
+        self.flusher.join()
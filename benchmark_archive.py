@@ -0,0 +1,84 @@
+"""
+Load-time benchmark for the columnar archive against the Excel export.
+
+Fills a store with synthetic transactions (1M by default), writes it as an
+archive, then times opening it and typical analysis passes: totals per type,
+a one-month counterparty breakdown and a month as a DataFrame. For comparison
+it reads a smaller Excel export with pandas and scales the time to the same
+row count, since reading a million-row workbook takes minutes.
+
+Usage: python benchmark_archive.py [--rows 1000000] [--db archive.db] [--excel-rows 20000]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from openpyxl import Workbook
+
+from benchmark_search import fill_store
+from mpesa_logger import HEADERS
+from transaction_archive import TransactionArchive, write_archive
+from transaction_store import TransactionStore
+
+
+def timed(label, function):
+    start = time.perf_counter()
+    result = function()
+    print(f"{label:<44} {(time.perf_counter() - start) * 1000:>10.2f} ms")
+    return result
+
+
+def write_excel(store, path, rows):
+    """Write the first rows transactions the way export_to_excel does"""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("M-PESA Transactions")
+    ws.append(HEADERS)
+    for count, row in enumerate(store.iter_rows()):
+        if count == rows:
+            break
+        ws.append(list(row))
+    wb.save(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar archive load benchmark")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--db", help="Keep the store in this file to reuse it between runs")
+    parser.add_argument("--excel-rows", type=int, default=20000, help="Rows in the Excel comparison file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = TransactionStore(args.db or os.path.join(tmp, "archive.db"))
+        fill_store(store, args.rows)
+        rows = store.count()
+        archive_path = os.path.join(tmp, "transactions.archive")
+        timed(f"write archive ({rows} rows)", lambda: write_archive(store, archive_path))
+
+        archive = timed("open archive", lambda: TransactionArchive(archive_path))
+        timed("map every column", lambda: [archive[name] for name in archive.meta["columns"]])
+        timed("totals by type (all rows)", lambda: archive.totals("type"))
+        month = str(np.datetime64(archive["time"][len(archive) // 2], "M"))
+        start, end = np.datetime64(month, "M"), np.datetime64(month, "M") + 1
+        timed(f"totals by counterparty ({month})", lambda: archive.totals("counterparty", start=start, end=end))
+        frame = timed(f"DataFrame for {month}", lambda: archive.to_frame(start=start, end=end))
+        timed("raw message of one row", lambda: archive.message(len(archive) // 3))
+        print(f"{'':<44} ({len(frame)} rows in the month)")
+
+        excel_rows = min(args.excel_rows, rows)
+        excel_path = os.path.join(tmp, "transactions.xlsx")
+        write_excel(store, excel_path, excel_rows)
+        import pandas as pd
+
+        start_time = time.perf_counter()
+        pd.read_excel(excel_path)
+        seconds = time.perf_counter() - start_time
+        print(f"{f'pandas.read_excel ({excel_rows} rows)':<44} {seconds * 1000:>10.2f} ms")
+        print(f"{f'  scaled to {rows} rows':<44} {seconds * rows / excel_rows:>10.1f} s")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Parallel parsing benchmark.
+
+Parses a synthetic corpus (one million messages by default) with 1, 2, 4, ...
+worker processes up to the CPU count and reports throughput and speedup over
+the single-process run. Output order is checked against the serial parse.
+
+Usage: python benchmark_parallel.py [--messages 1000000] [--workers 1,2,4,8]
+"""
+
+import argparse
+import os
+import time
+
+from message_generator import generate_messages
+from mpesa_parser import parse_message
+from parallel_parser import parse_messages_parallel
+
+
+def default_worker_counts():
+    """Powers of two up to the CPU count, plus the CPU count itself"""
+    cpus = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= cpus:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cpus:
+        counts.append(cpus)
+    return counts
+
+
+def run(messages, workers, chunk_size):
+    """Parse every message and return (seconds, codes in output order)"""
+    start = time.perf_counter()
+    if workers == 1:
+        codes = [parse_message(message).transaction_code for message in messages]
+    else:
+        codes = [t.transaction_code for t in parse_messages_parallel(messages, workers, chunk_size)]
+    return time.perf_counter() - start, codes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel parsing benchmark")
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--workers", help="Comma-separated worker counts (default: 1, 2, 4, ... CPU count)")
+    parser.add_argument("--chunk-size", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    counts = [int(n) for n in args.workers.split(",")] if args.workers else default_worker_counts()
+    print(f"Generating {args.messages} messages...")
+    messages = list(generate_messages(args.messages, args.seed))
+
+    baseline = None
+    expected = None
+    print(f"{'workers':>8} {'seconds':>9} {'msg/s':>10} {'speedup':>8}")
+    for workers in counts:
+        seconds, codes = run(messages, workers, args.chunk_size)
+        if expected is None:
+            expected = codes
+        elif codes != expected:
+            raise SystemExit(f"❌ Output order differs from the serial parse with {workers} workers")
+        baseline = baseline or seconds
+        print(f"{workers:>8} {seconds:>9.2f} {len(messages) / seconds:>10.0f} {baseline / seconds:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
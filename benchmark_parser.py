@@ -0,0 +1,124 @@
+"""
+Parser micro-benchmark and golden-corpus check.
+
+Verifies mpesa_parser.parse_message against examples/golden_messages.json
+(send, receive, paybill, buy goods, withdraw, deposit, airtime, Fuliza,
+reversal, balance and M-Shwari formats), then compares its
+throughput with the previous regex-per-field implementation.
+
+Usage: python benchmark_parser.py [--iterations 20000]
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime
+
+from mpesa_parser import parse_message
+
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples", "golden_messages.json")
+
+
+def legacy_parse_mpesa_message(message):
+    """The parser MPESATransactionLogger used before mpesa_parser, kept for comparison"""
+    data = {}
+
+    code_match = re.search(r'^([A-Z0-9]{10})', message)
+    data['transaction_code'] = code_match.group(1) if code_match else "N/A"
+
+    amount_match = re.search(r'Ksh([\d,]+\.?\d*)', message)
+    data['amount'] = amount_match.group(1).replace(',', '') if amount_match else "0"
+
+    lower_msg = message.lower()
+    if 'sent to' in lower_msg:
+        data['transaction_type'] = 'Send Money'
+        recipient_match = re.search(r'sent to (.+?)(?: on |\.|$)', message, re.IGNORECASE)
+        data['recipient_sender'] = recipient_match.group(1).strip() if recipient_match else "N/A"
+    elif 'received from' in lower_msg:
+        data['transaction_type'] = 'Receive Money'
+        sender_match = re.search(r'received from (.+?)(?: on |\.|$)', message, re.IGNORECASE)
+        data['recipient_sender'] = sender_match.group(1).strip() if sender_match else "N/A"
+    elif 'paid to' in lower_msg:
+        data['transaction_type'] = 'Pay Bill/Buy Goods'
+        merchant_match = re.search(r'paid to (.+?)(?: on |\.|$)', message, re.IGNORECASE)
+        data['recipient_sender'] = merchant_match.group(1).strip() if merchant_match else "N/A"
+    elif 'withdrawn' in lower_msg:
+        data['transaction_type'] = 'Withdraw'
+        data['recipient_sender'] = 'ATM/Agent'
+    else:
+        data['transaction_type'] = 'Other'
+        data['recipient_sender'] = 'N/A'
+
+    date_time_match = re.search(r'on (\d{1,2}/\d{1,2}/\d{2,4}) at (\d{1,2}:\d{2} [AP]M)', message)
+    if date_time_match:
+        data['date'] = date_time_match.group(1)
+        data['time'] = date_time_match.group(2)
+    else:
+        data['date'] = "N/A"
+        data['time'] = "N/A"
+
+    balance_match = re.search(r'New M-PESA balance is Ksh([\d,]+\.?\d*)', message)
+    data['new_balance'] = balance_match.group(1).replace(',', '') if balance_match else "N/A"
+
+    cost_match = re.search(r'Transaction cost[,.]? Ksh([\d,]+\.?\d*)', message)
+    data['transaction_cost'] = cost_match.group(1).replace(',', '') if cost_match else "0"
+
+    limit_match = re.search(r'Amount you can transact within the day is ([\d,]+\.?\d*)', message)
+    data['daily_limit_remaining'] = limit_match.group(1).replace(',', '') if limit_match else "N/A"
+
+    data['raw_message'] = message
+    data['processed_datetime'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    return data
+
+
+def check_golden(corpus):
+    """Compare parser output with the expected fields; returns a list of failures"""
+    failures = []
+    for case in corpus:
+        actual = parse_message(case["message"]).as_dict()
+        for field, expected in case["expected"].items():
+            if actual[field] != expected:
+                failures.append(f"[{case['format']}] {case['message'][:40]}... "
+                                f"{field}: expected {expected!r}, got {actual[field]!r}")
+    return failures
+
+
+def time_parser(parse, messages, iterations):
+    """Return messages per second for a parser over the corpus"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for message in messages:
+            parse(message)
+    elapsed = time.perf_counter() - start
+    return iterations * len(messages) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="M-PESA parser benchmark")
+    parser.add_argument("--iterations", type=int, default=20000,
+                        help="Passes over the golden corpus per parser")
+    args = parser.parse_args()
+
+    with open(GOLDEN_FILE, encoding="utf-8") as f:
+        corpus = json.load(f)
+
+    failures = check_golden(corpus)
+    for failure in failures:
+        print(f"❌ {failure}")
+    if failures:
+        sys.exit(1)
+    print(f"✅ Golden corpus: {len(corpus)} messages match")
+
+    messages = [case["message"] for case in corpus]
+    legacy_rate = time_parser(legacy_parse_mpesa_message, messages, args.iterations)
+    new_rate = time_parser(parse_message, messages, args.iterations)
+    print(f"legacy parser: {legacy_rate:>10.0f} msg/s")
+    print(f"mpesa_parser:  {new_rate:>10.0f} msg/s  ({new_rate / legacy_rate:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
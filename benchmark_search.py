@@ -0,0 +1,119 @@
+"""
+Search latency benchmark for the transaction store.
+
+Loads synthetic transactions (1M by default) and times typical dashboard
+queries: free-text and prefix search, type, date and amount filters, their
+combinations, code lookups and deep pagination. Each query should return its
+page in under 50 ms.
+
+Usage: python benchmark_search.py [--rows 1000000] [--db search.db] [--repeat 5]
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from message_generator import generate_messages
+from mpesa_parser import parse_message
+from transaction_store import TransactionStore
+
+TARGET_MS = 50
+
+
+def fill_store(store, rows, batch_size=20000):
+    """Bulk-load parsed synthetic messages until the store holds rows transactions"""
+    missing = rows - store.count()
+    if missing <= 0:
+        return
+    messages = generate_messages(missing, seed=store.count() + 1)
+    batch = []
+    for message in messages:
+        batch.append(parse_message(message))
+        if len(batch) == batch_size:
+            store.add_many(batch)
+            batch = []
+    if batch:
+        store.add_many(batch)
+
+
+def queries(store):
+    """Name and search() keyword arguments for each benchmarked query"""
+    first, = store.conn.execute("SELECT MIN(day) FROM transactions").fetchone()
+    last, = store.conn.execute("SELECT MAX(day) FROM transactions").fetchone()
+    middle, = store.conn.execute(
+        "SELECT day FROM transactions WHERE id = ?", (store.max_id() // 2,)
+    ).fetchone()
+    code, = store.conn.execute(
+        "SELECT transaction_code FROM transactions WHERE id = ?", (store.max_id() // 3,)
+    ).fetchone()
+    month = middle[:7]
+    print(f"History from {first} to {last}; filtering on {month}")
+    return [
+        ("latest page", {}),
+        ("text 'naivas'", {"text": "naivas"}),
+        ("prefix 'kam'", {"text": "kam"}),
+        ("two words 'grace kamau'", {"text": "grace kamau"}),
+        ("no match 'zzzz'", {"text": "zzzz"}),
+        ("type Withdraw", {"transaction_type": "Withdraw"}),
+        ("one month", {"date_from": f"{month}-01", "date_to": f"{month}-31"}),
+        ("one day", {"date_from": middle, "date_to": middle}),
+        ("amount 1000-1500", {"min_amount": 1000, "max_amount": 1500}),
+        ("amount >= 49000", {"min_amount": 49000}),
+        ("type + month", {"transaction_type": "Pay Bill/Buy Goods", "date_from": f"{month}-01",
+                          "date_to": f"{month}-31"}),
+        ("text + month", {"text": "java", "date_from": f"{month}-01", "date_to": f"{month}-31"}),
+        ("text + amount", {"text": "kplc", "min_amount": 2000, "max_amount": 2100}),
+        ("code", {"code": code}),
+    ]
+
+
+def timed(store, options, repeat):
+    """Median milliseconds for a search, and the page it returned"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        page = store.search(**options)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), page
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transaction search benchmark")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--db", help="Keep the store in this file to reuse it between runs")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--pages", type=int, default=20, help="Pages followed for the deep pagination check")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = TransactionStore(args.db or os.path.join(tmp, "search.db"))
+        start = time.perf_counter()
+        fill_store(store, args.rows)
+        print(f"Store holds {store.count()} transactions (loaded in {time.perf_counter() - start:.1f}s)")
+
+        slow = 0
+        print(f"{'query':<28} {'rows':>5} {'ms':>8}")
+        for name, options in queries(store):
+            elapsed, (rows, _) = timed(store, options, args.repeat)
+            slow += elapsed > TARGET_MS
+            print(f"{name:<28} {len(rows):>5} {elapsed:>8.2f}{'  SLOW' if elapsed > TARGET_MS else ''}")
+
+        # Cursor pagination costs the same on page 20 as on page 1
+        for name, options in (("text 'kamau'", {"text": "kamau"}), ("type Send Money", {"transaction_type": "Send Money"})):
+            cursor, worst = None, 0.0
+            for _ in range(args.pages):
+                elapsed, (rows, cursor) = timed(store, dict(options, before=cursor), args.repeat)
+                worst = max(worst, elapsed)
+                if cursor is None:
+                    break
+            slow += worst > TARGET_MS
+            print(f"{name + f' x{args.pages} pages':<28} {'':>5} {worst:>8.2f}{'  SLOW' if worst > TARGET_MS else ''}")
+
+        print(f"{'All queries' if not slow else f'{slow} queries not'} under {TARGET_MS} ms")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Cold-start benchmark for the command-line entry points.
+
+Each scenario runs in a fresh interpreter, so module imports are paid every
+time, exactly as when the monitor is launched by hand or by a service manager.
+The monitor scenarios construct AndroidSMSMonitor on an existing store with
+the given sinks and close it again, i.e. everything up to the first poll.
+"interpreter" (python -c pass) is the floor no entry point can beat.
+
+Usage: python benchmark_startup.py [--runs 15]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MONITOR = ("from android_sms_monitor import AndroidSMSMonitor; "
+           "AndroidSMSMonitor('startup.xlsx', sinks={sinks!r}).close()")
+SCENARIOS = [
+    ("interpreter", "pass"),
+    ("import_mpesa_logger", "import mpesa_logger"),
+    ("import_ingest_service", "import ingest_service"),
+    ("import_http_ingest", "import http_ingest"),
+    ("monitor_csv", MONITOR.format(sinks="csv")),
+    ("monitor_none", MONITOR.format(sinks="none")),
+    ("monitor_xlsx", MONITOR.format(sinks="xlsx")),
+    # What every start paid while openpyxl was imported eagerly
+    ("import_openpyxl", "import openpyxl"),
+]
+
+
+def measure_startup(code, runs, cwd):
+    """Wall-clock milliseconds of runs fresh interpreters executing code"""
+    env = dict(os.environ, PYTHONPATH=HERE + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    # Scenarios name their sinks explicitly
+    env.pop("MPESA_SINKS", None)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=cwd, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def run_scenarios(runs):
+    """Yield (name, median ms, min ms) per scenario, against a store created up front"""
+    with tempfile.TemporaryDirectory() as tmp:
+        # The first start creates the store and its indexes; later starts open it
+        measure_startup(MONITOR.format(sinks="none"), 1, tmp)
+        for name, code in SCENARIOS:
+            timings = measure_startup(code, runs, tmp)
+            yield name, statistics.median(timings), min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Entry point cold-start benchmark")
+    parser.add_argument("--runs", type=int, default=15)
+    args = parser.parse_args()
+
+    print(f"{'scenario':<24} {'median':>10} {'best':>10}")
+    for name, median, best in run_scenarios(args.runs):
+        print(f"{name:<24} {median:>7.1f} ms {best:>7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Insert latency benchmark for the SQLite transaction store.
+
+Grows the store through 1k, 10k, 100k and 1M rows and measures single-row
+insert latency at each size, showing that inserts stay flat as history grows.
+
+Usage: python benchmark_store.py [--max-rows 1000000] [--samples 1000]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import string
+import tempfile
+import time
+from datetime import datetime
+from decimal import Decimal
+
+from mpesa_parser import MPESATransaction
+from transaction_store import TransactionStore
+
+MESSAGE = ("{code} Confirmed. Ksh{amount} sent to Benchmark Recipient on 20/8/25 at 10:15 AM. "
+           "New M-PESA balance is Ksh93.09. Transaction cost, Ksh7.00.")
+
+
+def make_transaction(rng):
+    """Build a synthetic transaction with a random code"""
+    code = "".join(rng.choices(string.ascii_uppercase + string.digits, k=10))
+    amount = f"{rng.randint(1, 50000)}.00"
+    return MPESATransaction(
+        transaction_code=code,
+        amount=Decimal(amount),
+        transaction_type="Send Money",
+        recipient_sender="Benchmark Recipient",
+        transaction_datetime=datetime(2025, 8, 20, 10, 15),
+        new_balance=Decimal("93.09"),
+        transaction_cost=Decimal("7.00"),
+        daily_limit_remaining=None,
+        raw_message=MESSAGE.format(code=code, amount=amount),
+        processed_datetime=datetime(2025, 8, 20, 10, 15),
+    )
+
+
+def fill_store(store, target_rows, rng, batch_size=10000):
+    """Bulk-load the store up to target_rows"""
+    while True:
+        missing = target_rows - store.count()
+        if missing <= 0:
+            break
+        store.add_many(make_transaction(rng) for _ in range(min(batch_size, missing)))
+
+
+def measure_inserts(store, samples, rng):
+    """Time individual committed inserts; returns latencies in microseconds"""
+    latencies = []
+    for _ in range(samples):
+        transaction = make_transaction(rng)
+        start = time.perf_counter()
+        store.add(transaction)
+        latencies.append((time.perf_counter() - start) * 1e6)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transaction store insert benchmark")
+    parser.add_argument("--max-rows", type=int, default=1000000)
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    sizes = [size for size in (1000, 10000, 100000, 1000000) if size <= args.max_rows]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = TransactionStore(os.path.join(tmp, "benchmark.db"))
+        print(f"{'rows':>10} {'p50 (us)':>10} {'p99 (us)':>10} {'max (us)':>10}")
+        for size in sizes:
+            fill_store(store, size, rng)
+            latencies = sorted(measure_inserts(store, args.samples, rng))
+            p99 = latencies[int(len(latencies) * 0.99) - 1]
+            print(f"{size:>10} {statistics.median(latencies):>10.1f} {p99:>10.1f} {latencies[-1]:>10.1f}")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
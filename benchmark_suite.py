@@ -0,0 +1,459 @@
+"""
+Benchmark suite for the hot paths, with machine-readable results.
+
+Sections (all run by default, pick some with --only):
+
+    parser   parse_message throughput on a seeded corpus with malformed messages,
+             and the share of messages no template matched
+    store    single-row insert latency as the store grows (see benchmark_store.py)
+    dedup    code index lookups at growing sizes, and bulk import throughput
+             of a corpus with re-delivered duplicates
+    adb      end-to-end latency from a message landing in the phone's inbox to
+             its row being committed, through ingest_service.py and the fake adb
+             in examples/fake_adb
+    filter   bytes one inbox query transfers with and without the sender
+             allowlist, and how many non-confirmations each host-side check
+             lets through to the parser, on an inbox mixed with other senders
+    sinks    appending a batch to one workbook holding the whole history
+             against the current month's workbook of an xlsx@month sink
+    report   peak memory and throughput of streaming CSV and xlsx reports
+             from stores of growing size, each in a fresh interpreter
+    accounts journaled ingest throughput of one account against the same
+             messages spread over four, and the latency of a quiet line
+             while a busy one floods the service, sharing a writer or not
+    startup  cold start of the entry points in fresh interpreters
+             (see benchmark_startup.py)
+
+Every metric is printed and, with --json, written as
+{"meta": {...}, "metrics": {name: {"value", "unit", "better"}}}. Pass an earlier
+file to --baseline to compare: metrics that got worse by more than
+--tolerance are listed and the exit status is 1, so a CI job or a pre-merge
+run catches regressions with numbers.
+
+Usage: python benchmark_suite.py [--only parser,dedup] [--json results.json]
+                                 [--baseline results.json] [--tolerance 0.2] [--quick]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import signal
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmark_startup import run_scenarios
+from benchmark_store import fill_store, make_transaction, measure_inserts
+from code_index import TransactionCodeIndex
+from adb_inbox import SENDERS, AdbInboxReader, InboxCursor, parse_content_query
+from message_generator import MessageGenerator, generate_messages
+from message_templates import load_registry
+from mpesa_parser import NOT_AVAILABLE, is_confirmation, parse_message
+from transaction_store import TransactionStore
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKE_ADB_DIR = os.path.join(HERE, "examples", "fake_adb")
+SECTIONS = ("parser", "store", "dedup", "adb", "filter", "sinks", "report", "accounts", "startup")
+# The host-side check before confirmations were matched by structure
+KEYWORDS = ("confirmed", "ksh", "m-pesa", "transaction", "balance")
+# Writes one report and prints its peak RSS in KiB and seconds taken
+# ru_maxrss of a forked child starts at the parent's peak, so the child reads its own VmHWM (kB)
+REPORT_SCRIPT = """
+import sys, time
+from report_export import Report
+from transaction_store import TransactionStore
+store = TransactionStore(sys.argv[1])
+conn = store.open_reader()
+start = time.perf_counter()
+Report(conn, subtotals=True).write(sys.argv[2])
+with open("/proc/self/status") as f:
+    peak = next(line.split()[1] for line in f if line.startswith("VmHWM:"))
+print(peak, time.perf_counter() - start)
+"""
+
+
+class Results:
+    """Collects named metrics and prints each one as it is recorded"""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name, value, unit, better):
+        self.metrics[name] = {"value": round(value, 3), "unit": unit, "better": better}
+        print(f"   {name:<40} {value:>14.2f} {unit}")
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def bench_parser(results, options):
+    messages = list(generate_messages(options.messages, seed=options.seed, malformed=0.05))
+    # A warm-up pass keeps first-call costs out of the measurement
+    for message in messages[:1000]:
+        parse_message(message)
+    start = time.perf_counter()
+    parsed = [parse_message(message) for message in messages]
+    seconds = time.perf_counter() - start
+    unparsed = sum(t.transaction_code == NOT_AVAILABLE for t in parsed)
+    # Messages no template matched, which took the slower anchor pass
+    registry = load_registry()
+    fallback = sum(registry.match(message)[1] is None for message in messages)
+    results.add("parser.messages_per_second", len(messages) / seconds, "msg/s", "higher")
+    results.add("parser.us_per_message", seconds / len(messages) * 1e6, "us", "lower")
+    results.add("parser.unparsed_fraction", unparsed / len(messages), "ratio", "equal")
+    results.add("parser.fallback_fraction", fallback / len(messages), "ratio", "equal")
+
+
+def bench_store(results, options, tmp):
+    rng = random.Random(options.seed)
+    store = TransactionStore(os.path.join(tmp, "store.db"))
+    try:
+        for size in options.sizes:
+            fill_store(store, size, rng)
+            latencies = measure_inserts(store, options.samples, rng)
+            results.add(f"store.insert_p50_us@{size}", statistics.median(latencies), "us", "lower")
+            results.add(f"store.insert_p99_us@{size}", percentile(latencies, 0.99), "us", "lower")
+    finally:
+        store.close()
+
+
+def bench_dedup(results, options, tmp):
+    rng = random.Random(options.seed)
+    store = TransactionStore(os.path.join(tmp, "dedup.db"))
+    index = TransactionCodeIndex(os.path.join(tmp, "dedup.codes")).load(store)
+    codes = []
+    try:
+        for size in options.sizes:
+            indexed = len(codes)
+            while len(codes) < size:
+                codes.append(make_transaction(rng).transaction_code)
+            index.add_many(codes[indexed:])
+            hits = [rng.choice(codes) for _ in range(options.samples)]
+            misses = [make_transaction(rng).transaction_code for _ in range(options.samples)]
+            for name, probes in (("hit", hits), ("miss", misses)):
+                start = time.perf_counter()
+                for code in probes:
+                    code in index
+                elapsed = time.perf_counter() - start
+                results.add(f"dedup.lookup_{name}_ns@{size}", elapsed / len(probes) * 1e9, "ns", "lower")
+    finally:
+        index.close()
+        store.close()
+
+    # Bulk import where a fifth of the messages are re-deliveries
+    from mpesa_logger import MPESATransactionLogger
+
+    messages = list(generate_messages(options.messages, seed=options.seed, malformed=0.02, duplicates=0.2))
+    logger = MPESATransactionLogger(os.path.join(tmp, "import.xlsx"))
+    try:
+        stats = logger.process_messages(messages)
+    finally:
+        logger.close()
+    results.add("dedup.import_messages_per_second", stats["messages_per_second"], "msg/s", "higher")
+    results.add("dedup.import_duplicates", stats["duplicates"], "messages", "equal")
+
+
+def bench_adb(results, options, tmp):
+    inbox = os.path.join(tmp, "inbox.jsonl")
+    open(inbox, "w").close()
+    excel = os.path.join(tmp, "adb.xlsx")
+    env = dict(os.environ, PATH=FAKE_ADB_DIR + os.pathsep + os.environ.get("PATH", ""),
+               FAKE_ADB_INBOX=inbox, PYTHONUNBUFFERED="1")
+    env.pop("FAKE_ADB_DEVICES", None)
+    service = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "ingest_service.py"), "--adb", "--excel", excel, "--no-mirror"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    db_file = os.path.splitext(excel)[0] + ".db"
+    rng = random.Random(options.seed)
+    latencies = []
+    try:
+        deadline = time.monotonic() + 30
+        while not os.path.exists(db_file):
+            if time.monotonic() > deadline or service.poll() is not None:
+                raise RuntimeError("ingest_service.py did not start")
+            time.sleep(0.05)
+        conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+
+        for message in generate_messages(options.adb_messages, seed=options.seed):
+            # Irregular gaps, so some messages meet a backed-off poll interval
+            time.sleep(rng.uniform(0.1, 1.5))
+            code = message[:10]
+            with open(inbox, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"body": message, "date": int(time.time() * 1000)}) + "\n")
+            start = time.perf_counter()
+            deadline = start + 15
+            while not conn.execute("SELECT 1 FROM transactions WHERE transaction_code = ?", (code,)).fetchone():
+                if time.perf_counter() > deadline:
+                    raise RuntimeError(f"message {code} was not stored within 15 seconds")
+                time.sleep(0.005)
+            latencies.append((time.perf_counter() - start) * 1000)
+        conn.close()
+    finally:
+        service.send_signal(signal.SIGINT)
+        try:
+            service.wait(10)
+        except subprocess.TimeoutExpired:
+            service.kill()
+
+    results.add("adb.latency_p50_ms", statistics.median(latencies), "ms", "lower")
+    results.add("adb.latency_p95_ms", percentile(latencies, 0.95), "ms", "lower")
+    results.add("adb.latency_max_ms", max(latencies), "ms", "lower")
+
+
+def bench_filter(results, options, tmp):
+    generator = MessageGenerator(options.seed, malformed=0.05)
+    inbox = os.path.join(tmp, "filter_inbox.jsonl")
+    with open(inbox, "w", encoding="utf-8") as f:
+        for message in generator.messages(options.filter_messages):
+            f.write(json.dumps({"address": "MPESA", "body": message}) + "\n")
+            # About as many SMS again from banks, lenders and shops
+            for _ in range(generator.rng.randint(0, 2)):
+                sender, body = generator.other_sms()
+                f.write(json.dumps({"address": sender, "body": body}) + "\n")
+
+    os.environ["FAKE_ADB_INBOX"] = inbox
+    polled = {}
+    for name, senders in (("all", None), ("allowlist", SENDERS)):
+        reader = AdbInboxReader(InboxCursor(os.path.join(tmp, f"filter_{name}.json")),
+                                adb=os.path.join(FAKE_ADB_DIR, "adb"), senders=senders)
+        try:
+            _, output = reader.shell.run(reader.query())
+        finally:
+            reader.close()
+        results.add(f"filter.query_kib_{name}", len(output.encode("utf-8")) / 1024, "KiB", "lower")
+        polled[name] = [row["body"] for row in parse_content_query(output)]
+
+    # Before: every SMS was pulled and checked for keywords. Now: allowlisted senders, matched by structure
+    for name, bodies, accept in (
+            ("keywords", polled["all"], lambda body: any(word in body.lower() for word in KEYWORDS)),
+            ("matcher", polled["allowlist"], is_confirmation)):
+        start = time.perf_counter()
+        accepted = [body for body in bodies if accept(body)]
+        elapsed = time.perf_counter() - start
+        # Messages handed to the parser that yield no transaction
+        rejected = sum(parse_message(body).transaction_code == NOT_AVAILABLE for body in accepted)
+        results.add(f"filter.{name}_ns", elapsed / len(bodies) * 1e9, "ns", "lower")
+        results.add(f"filter.{name}_parsed", len(accepted), "messages", "lower")
+        results.add(f"filter.{name}_false_positives", rejected, "messages", "lower")
+
+
+def bench_sinks(results, options, tmp):
+    from mpesa_logger import MPESATransactionLogger
+    from output_sinks import ExcelSink, MonthlySink
+
+    messages = list(generate_messages(options.sink_rows + 50, seed=options.seed))
+    logger = MPESATransactionLogger(os.path.join(tmp, "sinks.xlsx"), sinks="none")
+    try:
+        logger.process_messages(messages[:-50])
+        sinks = (("single", ExcelSink(os.path.join(tmp, "single.xlsx"))),
+                 ("monthly", MonthlySink(ExcelSink, os.path.join(tmp, "monthly.xlsx"))))
+        for _, sink in sinks:
+            sink.export(logger.store)
+        # The newest transactions, appended in batches as the batch writer would
+        batch = logger.store.add_batch([parse_message(message) for message in messages[-50:]])
+        for name, sink in sinks:
+            latencies = []
+            for i in range(0, len(batch), 10):
+                start = time.perf_counter()
+                sink.append(batch[i:i + 10], logger.store)
+                latencies.append((time.perf_counter() - start) * 1000)
+            results.add(f"sinks.xlsx_append_ms_{name}@{options.sink_rows}", statistics.median(latencies), "ms", "lower")
+    finally:
+        logger.close()
+
+
+def bench_report(results, options, tmp):
+    db_file = os.path.join(tmp, "report.db")
+    store = TransactionStore(db_file)
+    rng = random.Random(options.seed)
+    try:
+        for size in options.report_sizes:
+            fill_store(store, size, rng)
+            store.sync()
+            for fmt in ("csv", "xlsx"):
+                output = subprocess.run(
+                    [sys.executable, "-c", REPORT_SCRIPT, db_file, os.path.join(tmp, f"report.{fmt}")],
+                    cwd=HERE, capture_output=True, text=True, check=True,
+                ).stdout.split()
+                peak_kib, seconds = int(output[0]), float(output[1])
+                # Flat across sizes when memory does not depend on the row count
+                results.add(f"report.{fmt}_peak_mib@{size}", peak_kib / 1024, "MiB", "lower")
+                results.add(f"report.{fmt}_rows_per_s@{size}", size / seconds, "rows/s", "higher")
+    finally:
+        store.close()
+
+
+def _flood(messages, account, burst=50):
+    """Source submitting messages in bursts, each followed by a checkpoint as a poll would"""
+    async def run(service):
+        for i in range(0, len(messages), burst):
+            for message in messages[i:i + burst]:
+                await service.submit(message, source=f"bench:{account}", account=account)
+            await service.checkpoint(lambda: None, account=account)
+    return run
+
+
+def _trickle(messages, account, latencies, interval):
+    """Source submitting one message at a time, timing each until it is journaled"""
+    async def run(service):
+        for message in messages:
+            sent = time.perf_counter()
+            await service.submit(message, source=f"bench:{account}", account=account)
+            await service.checkpoint(lambda sent=sent: latencies.append((time.perf_counter() - sent) * 1000),
+                                     account=account)
+            await asyncio.sleep(interval)
+    return run
+
+
+def _run_service(path, names, sources):
+    """Run an IngestService over accounts with a journal; returns the seconds until drained"""
+    from account_shards import AccountMap, ShardedLogger
+    from ingest_service import IngestService
+
+    shards = ShardedLogger(path, AccountMap({name: {} for name in names}), sinks="none")
+    try:
+        shards.start_batching(journal=True)
+        service = IngestService(shards)
+        for i, source in enumerate(sources):
+            service.add_source(f"bench-{i}", source)
+        start = time.perf_counter()
+        asyncio.run(service.run())
+        return time.perf_counter() - start
+    finally:
+        shards.close()
+
+
+def bench_accounts(results, options, tmp):
+    # Lines mixed into one account break its balance chain on purpose; the gap warnings are noise here
+    logging.disable(logging.WARNING)
+    try:
+        _bench_accounts(results, options, tmp)
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def _bench_accounts(results, options, tmp):
+    messages = list(generate_messages(options.account_messages, seed=options.seed))
+    for count in (1, 4):
+        names = [f"line{i}" for i in range(count)]
+        size = len(messages) // count
+        seconds = _run_service(os.path.join(tmp, f"accounts{count}.xlsx"), names,
+                               [_flood(messages[i * size:(i + 1) * size], name) for i, name in enumerate(names)])
+        results.add(f"accounts.ingest_messages_per_second@{count}", len(messages) / seconds, "msg/s", "higher")
+
+    # A personal line sending a message every 10 ms while an agent line floods the service
+    quiet = list(generate_messages(options.account_quiet, seed=options.seed + 1))
+    for name, personal in (("shared", "agent"), ("sharded", "personal")):
+        latencies = []
+        _run_service(os.path.join(tmp, f"isolation_{name}.xlsx"), ["agent", "personal"],
+                     [_flood(messages, "agent"), _trickle(quiet, personal, latencies, 0.01)])
+        results.add(f"accounts.quiet_line_p50_ms_{name}", statistics.median(latencies), "ms", "lower")
+        results.add(f"accounts.quiet_line_p95_ms_{name}", percentile(latencies, 0.95), "ms", "lower")
+
+
+def bench_startup(results, options):
+    for name, median, _ in run_scenarios(options.startup_runs):
+        results.add(f"startup.{name}_ms", median, "ms", "lower")
+
+
+def compare(metrics, baseline, tolerance):
+    """Return (name, old, new) for metrics that got worse by more than tolerance"""
+    regressions = []
+    for name, metric in metrics.items():
+        old = baseline.get(name)
+        if not old or metric["better"] == "equal" or not old["value"]:
+            continue
+        change = (metric["value"] - old["value"]) / abs(old["value"])
+        if (metric["better"] == "lower" and change > tolerance) or \
+                (metric["better"] == "higher" and change < -tolerance):
+            regressions.append((name, old["value"], metric["value"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark suite for parser, store, dedup, ADB ingestion and startup")
+    parser.add_argument("--only", help=f"Comma-separated sections: {', '.join(SECTIONS)}")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Results file from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown (0.2 = 20%%)")
+    parser.add_argument("--quick", action="store_true", help="Smaller sizes for a fast smoke run")
+    parser.add_argument("--seed", type=int, default=42)
+    options = parser.parse_args()
+
+    sections = options.only.split(",") if options.only else list(SECTIONS)
+    unknown = set(sections) - set(SECTIONS)
+    if unknown:
+        parser.error(f"unknown sections: {', '.join(sorted(unknown))}")
+    options.messages = 20000 if options.quick else 100000
+    options.sizes = (1000, 10000) if options.quick else (1000, 10000, 100000)
+    options.samples = 200 if options.quick else 1000
+    options.adb_messages = 5 if options.quick else 20
+    options.filter_messages = 2000 if options.quick else 10000
+    options.sink_rows = 3000 if options.quick else 20000
+    options.report_sizes = (2000, 20000) if options.quick else (10000, 100000, 500000)
+    options.account_messages = 20000 if options.quick else 100000
+    options.account_quiet = 50 if options.quick else 200
+    options.startup_runs = 5 if options.quick else 15
+
+    results = Results()
+    with tempfile.TemporaryDirectory() as tmp:
+        for section in sections:
+            print(f"▶️ {section}")
+            if section == "parser":
+                bench_parser(results, options)
+            elif section == "store":
+                bench_store(results, options, tmp)
+            elif section == "dedup":
+                bench_dedup(results, options, tmp)
+            elif section == "adb":
+                bench_adb(results, options, tmp)
+            elif section == "filter":
+                bench_filter(results, options, tmp)
+            elif section == "sinks":
+                bench_sinks(results, options, tmp)
+            elif section == "report":
+                bench_report(results, options, tmp)
+            elif section == "accounts":
+                bench_accounts(results, options, tmp)
+            elif section == "startup":
+                bench_startup(results, options)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": options.seed,
+            "quick": options.quick,
+        },
+        "metrics": results.metrics,
+    }
+    if options.json:
+        with open(options.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"📝 Results written to {options.json}")
+
+    if options.baseline:
+        with open(options.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["metrics"]
+        regressions = compare(results.metrics, baseline, options.tolerance)
+        for name, old, new in regressions:
+            print(f"❌ {name} regressed: {old} -> {new}")
+        if regressions:
+            sys.exit(1)
+        print(f"✅ No metric regressed by more than {options.tolerance:.0%}")
+
+
+if __name__ == "__main__":
+    main()
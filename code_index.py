@@ -0,0 +1,103 @@
+import os
+import re
+from array import array
+from bisect import bisect_left
+
+# M-PESA codes are 10 upper-case alphanumerics, which fit in a signed 64-bit integer in base 36
+CODE_PATTERN = re.compile(r'[A-Z0-9]{10}')
+UNINDEXED = -1  # Placeholder record for store rows whose code is not a valid M-PESA code
+
+
+def encode_code(code):
+    """Pack a transaction code into an integer, or None if it is not a valid M-PESA code"""
+    if code and CODE_PATTERN.fullmatch(code):
+        return int(code, 36)
+    return None
+
+
+class TransactionCodeIndex:
+    """Compact set of seen transaction codes, persisted next to the output file.
+
+    Codes are kept as a sorted array of 64-bit integers (8 bytes per code) plus a
+    small set of recent additions that is merged in periodically. The file on disk
+    holds one int64 record per store row, in store order, so it can be caught up
+    from the store after a crash.
+    """
+
+    def __init__(self, index_file, merge_threshold=4096):
+        self.index_file = index_file
+        self.merge_threshold = merge_threshold
+        self._sorted = array('q')
+        self._recent = set()
+        self._records = 0
+        self._file = None
+
+    def load(self, store):
+        """Load the index from disk and catch up with any rows the file is missing"""
+        records = array('q')
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'rb') as f:
+                data = f.read()
+            # Drop a torn trailing record left by an interrupted append
+            data = data[:len(data) - len(data) % records.itemsize]
+            records.frombytes(data)
+
+        store_count = store.count()
+        if len(records) > store_count:
+            # The store was replaced or truncated; rebuild from scratch
+            records = array('q')
+
+        if len(records) < store_count:
+            for code in store.iter_codes(offset=len(records)):
+                value = encode_code(code)
+                records.append(UNINDEXED if value is None else value)
+
+        with open(self.index_file, 'wb') as f:
+            records.tofile(f)
+
+        self._records = len(records)
+        self._sorted = array('q', sorted(value for value in records if value != UNINDEXED))
+        self._recent = set()
+        self._file = open(self.index_file, 'ab')
+        return self
+
+    def __contains__(self, code):
+        value = encode_code(code)
+        if value is None:
+            return False
+        if value in self._recent:
+            return True
+        position = bisect_left(self._sorted, value)
+        return position < len(self._sorted) and self._sorted[position] == value
+
+    def __len__(self):
+        return len(self._sorted) + len(self._recent)
+
+    def add(self, code):
+        """Record a code that has just been inserted into the store"""
+        self.add_many([code])
+
+    def add_many(self, codes):
+        """Record codes inserted into the store, in store order, with one file write"""
+        values = [encode_code(code) for code in codes]
+        self._file.write(array('q', [UNINDEXED if v is None else v for v in values]).tobytes())
+        self._file.flush()
+        self._records += len(values)
+
+        self._recent.update(v for v in values if v is not None)
+        if len(self._recent) >= self.merge_threshold:
+            self._merge()
+
+    def _merge(self):
+        # Both inputs are sorted, so timsort merges the two runs in linear time
+        merged = self._sorted.tolist()
+        merged.extend(sorted(self._recent))
+        merged.sort()
+        self._sorted = array('q', merged)
+        self._recent = set()
+
+    def close(self):
+        """Close the index file"""
+        if self._file:
+            self._file.close()
+            self._file = None
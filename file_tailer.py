@@ -0,0 +1,184 @@
+"""
+Tail-follow reader for append-only message files (e.g. written by Tasker).
+
+Only bytes appended since the last read are read, from a byte offset that is
+persisted together with the file's inode, so a restarted monitor resumes where
+it stopped. A trailing line without a newline is left for the next read,
+truncation restarts from the beginning, and a rotated file is drained before
+the new one is followed. Waits use inotify on Linux and fall back to polling.
+"""
+
+import hashlib
+import json
+import os
+import select
+import time
+
+# inotify event bits for changes to files inside the watched directory
+_IN_MODIFY = 0x002
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_FROM = 0x040
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_WATCH_MASK = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+
+class _Inotify:
+    """Minimal ctypes binding to Linux inotify watching one directory"""
+
+    def __init__(self, directory):
+        # Imported here: ctypes.util pulls in shutil and tempfile, so only watchers pay for it
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), _WATCH_MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"cannot watch {directory}")
+
+    def fileno(self):
+        return self.fd
+
+    def drain(self):
+        """Discard pending events; they are only a wake-up and the tailer re-checks the file"""
+        while True:
+            try:
+                os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+
+    def wait(self, timeout):
+        """Block until something in the directory changes or the timeout passes"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            self.drain()
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watch(path):
+    """Return an inotify watcher for the file's directory, or None to poll"""
+    try:
+        return _Inotify(os.path.dirname(os.path.abspath(path)))
+    except (OSError, AttributeError, TypeError):
+        # Not Linux, no libc inotify, or the directory is missing
+        return None
+
+
+def cursor_file(base_name, path):
+    """State file for tailing path, stored next to the workbook base_name"""
+    digest = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:8]
+    return f"{base_name}.{digest}.file_cursor.json"
+
+
+class FileTailer:
+    """Reads complete lines appended to a file, resuming from a persisted offset"""
+
+    def __init__(self, path, state_file, poll_interval=5.0, max_read=1 << 20):
+        self.path = path
+        self.state_file = state_file
+        self.poll_interval = poll_interval
+        self.max_read = max_read
+        self.handle = None
+        self.inode = None
+        self.offset = 0
+        self._load_state()
+
+    def _load_state(self):
+        if not os.path.exists(self.state_file):
+            return
+        with open(self.state_file, encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("path") == os.path.abspath(self.path):
+            self.inode = state.get("inode")
+            self.offset = int(state.get("offset", 0))
+
+    def snapshot(self):
+        """Return the current position, for committing once the lines before it are processed"""
+        return self.inode, self.offset
+
+    def commit(self, position=None):
+        """Persist the position (or an earlier snapshot) after the returned lines are processed"""
+        inode, offset = position or self.snapshot()
+        temp_file = self.state_file + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump({"path": os.path.abspath(self.path), "inode": inode, "offset": offset}, f)
+        os.replace(temp_file, self.state_file)
+
+    def _open(self):
+        try:
+            self.handle = open(self.path, "rb")
+        except FileNotFoundError:
+            return False
+        stat = os.fstat(self.handle.fileno())
+        # A different inode means the file was rotated while we were stopped
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.offset = 0
+        self.inode = stat.st_ino
+        return True
+
+    def _read(self, final=False):
+        """Read complete lines from the offset; with final, keep an unterminated tail too"""
+        self.handle.seek(self.offset)
+        data = self.handle.read(self.max_read)
+        end = data.rfind(b"\n") + 1
+        if final or (not end and len(data) == self.max_read):
+            end = len(data)
+        self.offset += end
+        return [line.decode("utf-8", errors="replace").rstrip("\r")
+                for line in data[:end].split(b"\n") if line]
+
+    def read_lines(self):
+        """Return the complete lines appended since the last call"""
+        if self.handle is None and not self._open():
+            return []
+        lines = self._read()
+        if lines:
+            return lines
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            stat = None
+        if stat is None or stat.st_ino != self.inode:
+            # Rotated or removed: the open handle still reaches the old file,
+            # whose last line will never get its newline now
+            lines = self._read(final=True)
+            self.handle.close()
+            self.handle = None
+            self.offset = 0
+            if not lines and stat is not None and self._open():
+                lines = self._read()
+        elif stat.st_size < self.offset:
+            # Truncated in place
+            self.offset = 0
+            lines = self._read()
+        return lines
+
+    def follow(self):
+        """Yield batches of new lines, sleeping until the file changes"""
+        watcher = watch(self.path)
+        try:
+            while True:
+                lines = self.read_lines()
+                if lines:
+                    yield lines
+                elif watcher:
+                    # The timeout is a safety net for missed events (e.g. network filesystems)
+                    watcher.wait(self.poll_interval)
+                else:
+                    time.sleep(self.poll_interval)
+        finally:
+            if watcher:
+                watcher.close()
+
+    def close(self):
+        if self.handle:
+            self.handle.close()
+            self.handle = None
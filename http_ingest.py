@@ -0,0 +1,498 @@
+"""
+Local HTTP ingest endpoint for M-PESA messages.
+
+POST /messages accepts one message as text/plain or form data (message=...),
+a JSON body ("...", ["...", ...], {"message": "..."} or {"messages": [...]})
+or NDJSON with one of those per line. The reply lists every message with its
+parsed transaction and a status: imported, duplicate, unparsed, or ignored
+when it is not an M-PESA SMS. Connections are kept alive (HTTP/1.1), so
+Tasker's HTTP Post action and the web page push messages as they arrive
+instead of going through a polled file. GET / serves web_interface.html, which
+posts to the same endpoint and therefore uses the same parser, and GET /stats
+answers its dashboard totals from the analytics rollups. GET /transactions
+searches the store (q, type, from, to, min, max, code) a page at a time;
+pass the reply's "next" back as before= for the following page. GET /metrics
+exposes the pipeline metrics in Prometheus text format (/metrics.json as JSON).
+GET /report streams a report (format=csv or xlsx, from, to, type, party,
+subtotals=1) as a chunked download; see report_export.
+
+With --accounts (see account_shards), a post's token (Authorization: Bearer
+<token>, or ?token=) picks the account it is stored in, and each account has
+its own lock, so posts for different accounts are written in parallel. GET
+/stats, /transactions and /report cover every account, or one with account=.
+
+Replies carry no CORS headers unless the request's Origin is in the
+--allow-origin list; the page served at GET / is same-origin and needs none,
+and a copy opened from disk (file://) sends Origin "null". Bound to anything
+but loopback, every request except the page itself must carry a token: one
+given with --token or one from the accounts map. The page forwards the token
+from its own URL (http://host:8765/?token=...).
+
+Any website the user visits could otherwise post forged confirmations to the
+loopback server, so a post a browser sends (one with an Origin header) must
+come from the server's own page or an --allow-origin origin, and be JSON or
+NDJSON, which no page can post to another origin without a CORS preflight.
+Posts without an Origin, from curl or Tasker, may use any content type.
+
+Usage: python http_ingest.py [--host 127.0.0.1] [--port 8765] [--no-mirror] [--sink xlsx,csv] [--accounts accounts.json]
+       python http_ingest.py --host 0.0.0.0 --token "$MPESA_HTTP_TOKEN"
+"""
+
+import hmac
+import ipaddress
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import ExitStack
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from account_shards import DEFAULT_ACCOUNT, ShardedLogger, load_accounts
+from analytics import current_periods
+from android_sms_monitor import is_mpesa_message
+from instrumentation import (PROMETHEUS_CONTENT_TYPE, REGISTRY, add_logging_arguments, configure_logging,
+                             stage, traced)
+from mpesa_logger import add_sink_argument
+
+log = logging.getLogger(__name__)
+
+WEB_INTERFACE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "web_interface.html")
+MAX_BODY = 10 * 1024 * 1024
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+# Content types any page can post to another origin without a preflight
+SIMPLE_TYPES = ("text/plain", "application/x-www-form-urlencoded", "multipart/form-data")
+# Paths served without a token: the page itself holds no data
+PUBLIC_PATHS = ("/", "/web_interface.html")
+
+
+def is_loopback(host):
+    """Whether a bind address only accepts connections from this machine"""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _messages_from_json(data):
+    if isinstance(data, str):
+        return [data]
+    if isinstance(data, list):
+        return [message for item in data for message in _messages_from_json(item)]
+    if isinstance(data, dict):
+        if "messages" in data:
+            return _messages_from_json(data["messages"])
+        # Tasker users tend to name the field after %SMSRB
+        for key in ("message", "body"):
+            if isinstance(data.get(key), str):
+                return [data[key]]
+    raise ValueError("expected a message string, a list, or an object with 'message' or 'messages'")
+
+
+def query_day(text):
+    """A YYYY-MM-DD argument in the form the day column stores"""
+    return date.fromisoformat(text).isoformat()
+
+
+def query_amount(text):
+    """A KSh amount argument, kept as given"""
+    if not math.isfinite(float(text)):
+        raise ValueError
+    return text
+
+
+# Checked query string arguments: the conversion, and the message sent back when it fails
+QUERY_ARGUMENTS = {
+    "from": (query_day, "from must be a date, YYYY-MM-DD"),
+    "to": (query_day, "to must be a date, YYYY-MM-DD"),
+    "limit": (int, "limit must be a whole number"),
+    "min": (query_amount, "min must be an amount in KSh"),
+    "max": (query_amount, "max must be an amount in KSh"),
+}
+
+
+def query_value(query, name):
+    """The first value of a query string argument, or None; raises ValueError with a fixed message if it is invalid"""
+    value = query.get(name, [None])[0] or None
+    if value is None or name not in QUERY_ARGUMENTS:
+        return value
+    convert, message = QUERY_ARGUMENTS[name]
+    try:
+        return convert(value)
+    except ValueError:
+        raise ValueError(message) from None
+
+
+def media_type(content_type):
+    """The media type of a Content-Type header, lower-cased; text/plain when there is none"""
+    return (content_type or "text/plain").split(";")[0].strip().lower()
+
+
+def parse_body(body, content_type):
+    """Return the messages in a request body"""
+    text = body.decode("utf-8")
+    kind = media_type(content_type)
+    if kind == "application/json":
+        return _messages_from_json(json.loads(text))
+    if kind in NDJSON_TYPES:
+        return [message for line in text.splitlines() if line.strip()
+                for message in _messages_from_json(json.loads(line))]
+    if kind == "application/x-www-form-urlencoded":
+        form = parse_qs(text)
+        return form.get("message") or form.get("body") or []
+    return [text] if text.strip() else []
+
+
+class IngestServer(ThreadingHTTPServer):
+    """HTTP server wrapping a ShardedLogger, or one MPESATransactionLogger"""
+
+    daemon_threads = True
+
+    def __init__(self, address, logger, mirror=True, accept=is_mpesa_message, tokens=(), allowed_origins=()):
+        shards = logger if isinstance(logger, ShardedLogger) else ShardedLogger.single(logger)
+        # Tokens that may use the server: the given ones (stored in the default account) and the accounts'
+        self.tokens = [token.encode("utf-8") for token in tokens]
+        self.tokens += [key.encode("utf-8") for kind, key in shards.accounts.routes if kind == "token"]
+        # Anything that can reach a non-loopback address must prove who it is
+        self.require_token = not is_loopback(address[0])
+        if self.require_token and not self.tokens:
+            raise ValueError(f"listening on {address[0]} needs a token (--token or account tokens)")
+        self.allowed_origins = set(allowed_origins)
+        super().__init__(address, IngestHandler)
+        self.shards = shards
+        self.logger = self.shards.default
+        self.mirror = mirror
+        self.accept = accept
+        # Requests are handled on many threads but each account's logger has one writer
+        self.locks = {account: threading.Lock() for account in self.shards.loggers}
+        self.lock = self.locks[DEFAULT_ACCOUNT]
+
+    def locked(self, accounts):
+        """Hold the locks of several accounts, always taken in the same order"""
+        stack = ExitStack()
+        for account in sorted(accounts):
+            stack.enter_context(self.locks[account])
+        return stack
+
+    def authorized(self, token):
+        """Whether a request with this token (or None) may be served"""
+        if not self.require_token:
+            return True
+        if token is None:
+            return False
+        token = token.encode("utf-8")
+        # Compared in constant time, and against every token, so timing reveals nothing
+        return sum(hmac.compare_digest(token, known) for known in self.tokens) > 0
+
+    def ingest(self, messages, token=None):
+        """Store a batch of messages in the token's account and build the response body"""
+        account = self.shards.accounts.account_for("token", token)
+        logger = self.shards.loggers[account]
+        arrived = time.time()
+        REGISTRY.inc("mpesa_messages_received_total", len(messages), source="http")
+        with stage("filter"):
+            flags = [self.accept(message) for message in messages]
+        accepted = [message for message, ok in zip(messages, flags) if ok]
+        REGISTRY.inc("mpesa_messages_total", len(messages) - len(accepted), outcome="ignored")
+        with self.locks[account]:
+            results, inserted = logger.ingest_messages(accepted, arrived=arrived, mirror=self.mirror)
+
+        counts = {"imported": 0, "duplicate": 0, "unparsed": 0, "ignored": len(messages) - len(accepted)}
+        records = iter(results)
+        response = []
+        for ok in flags:
+            if not ok:
+                response.append({"status": "ignored", "duplicate": False, "transaction": None})
+                continue
+            transaction, status = next(records)
+            counts[status] += 1
+            response.append({"status": status, "duplicate": status == "duplicate",
+                             "transaction": transaction.as_dict()})
+
+        log.info("%d messages via HTTP for %s: %d imported, %d duplicates, %d unparsed, %d ignored",
+                 len(messages), account, counts["imported"], counts["duplicate"], counts["unparsed"],
+                 counts["ignored"])
+        return {"received": len(messages), "account": account, **counts, "results": response}
+
+    def stats(self, query):
+        """Dashboard totals from the rollups: all time, today, this month and top counterparties"""
+        rollups = self.shards.rollups(query.get("account", [None])[0] or None)
+        today, month = current_periods()
+        month = query.get("month", [month])[0]
+        return {
+            "all_time": rollups.total().as_dict(),
+            "today": rollups.total(today).as_dict(),
+            "month": month,
+            "this_month": rollups.total(month).as_dict(),
+            "by_type": {name: cell.as_dict() for name, cell in rollups.by_type(month).items()},
+            "top_counterparties": [{"counterparty": party, **cell.as_dict()}
+                                   for party, cell in rollups.by_counterparty(month, limit=10)],
+        }
+
+
+    def search(self, query):
+        """One page of stored transactions matching the query string filters"""
+        def value(name):
+            return query_value(query, name)
+
+        account = value("account")
+        with self.locked(self.shards.select(account)):
+            rows, next_cursor = self.shards.search(
+                value("q"), before=value("before"), limit=value("limit") or 50, account=account,
+                transaction_type=value("type"), date_from=value("from"), date_to=value("to"),
+                min_amount=value("min"), max_amount=value("max"), code=value("code"),
+            )
+        return {"transactions": rows, "next": next_cursor}
+
+    def report(self, query):
+        """A streaming report for the query string filters, its format and its read-only connections"""
+        # The report writer is only imported once a report is asked for
+        from report_export import FORMATS
+
+        def value(name):
+            return query_value(query, name)
+
+        fmt = value("format") or "csv"
+        if fmt not in FORMATS:
+            raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+        account = value("account")
+        # Transactions still waiting for a group commit are flushed into the report, and
+        # reading on separate connections keeps a long download from holding the locks
+        with self.locked(self.shards.select(account)):
+            report, conns = self.shards.report(
+                account, date_from=value("from"), date_to=value("to"), transaction_type=value("type"),
+                counterparty=value("party"), subtotals=value("subtotals") in ("1", "true", "yes"))
+        return report, fmt, conns
+
+
+class IngestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections open between posts; every reply sets Content-Length
+    protocol_version = "HTTP/1.1"
+    # Idle keep-alive connections are closed after this many seconds
+    timeout = 60
+
+    def log_message(self, format, *args):
+        # IngestServer.ingest logs one summary line per request instead
+        pass
+
+    def _send_cors(self):
+        """Let an allowlisted origin (e.g. "null" for the page opened from disk) read the reply"""
+        if not self.server.allowed_origins:
+            return
+        self.send_header("Vary", "Origin")
+        origin = self.headers.get("Origin")
+        if origin in self.server.allowed_origins:
+            self.send_header("Access-Control-Allow-Origin", origin)
+
+    def _send(self, status, body, content_type, headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self._send_cors()
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, payload, headers=()):
+        self._send(status, json.dumps(payload).encode("utf-8"), "application/json", headers)
+
+    def _check_token(self):
+        """Reply 401 and return False unless the request may be served"""
+        if self.server.authorized(self._token()):
+            return True
+        self._send_json(401, {"error": "token required"}, [("WWW-Authenticate", "Bearer")])
+        return False
+
+    def _same_origin(self, origin):
+        """Whether an Origin header names this server's own page"""
+        try:
+            parts = urlsplit(origin)
+            port = parts.port or 80
+        except ValueError:
+            return False
+        if parts.scheme != "http" or port != self.server.server_address[1]:
+            return False
+        if self.server.require_token:
+            # Callers need a token anyway, and the page is opened by whatever name the host has
+            return parts.netloc == self.headers.get("Host")
+        # A foreign name rebound to 127.0.0.1 would match its own Host header, so only loopback names count
+        return is_loopback(parts.hostname)
+
+    def _check_origin(self):
+        """Reply 403 and return False to a browser post that did not come from a trusted page"""
+        origin = self.headers.get("Origin")
+        if origin is None:
+            # Not sent by a browser (curl, Tasker and the like)
+            return True
+        if origin not in self.server.allowed_origins and not self._same_origin(origin):
+            self._send_json(403, {"error": f"posts from {origin} are not allowed"})
+            return False
+        if media_type(self.headers.get("Content-Type")) in SIMPLE_TYPES:
+            # A page can send these to any origin without a preflight, e.g. from a sandboxed frame as "null"
+            self._send_json(403, {"error": "posts from a browser must be application/json or NDJSON"})
+            return False
+        return True
+
+    def _send_chunked(self, chunks, content_type, filename):
+        """Send a download of unknown length with chunked transfer encoding"""
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
+        self.send_header("Transfer-Encoding", "chunked")
+        self._send_cors()
+        self.end_headers()
+        for chunk in chunks:
+            if chunk:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send_report(self, query):
+        from report_export import CONTENT_TYPES
+
+        try:
+            report, fmt, conns = self.server.report(query)
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        try:
+            self._send_chunked(report.chunks(fmt), CONTENT_TYPES[fmt], f"mpesa_report.{fmt}")
+            log.info("Sent a %s report of %d transactions", fmt, report.transactions)
+        except (BrokenPipeError, ConnectionResetError):
+            # The browser cancelled the download; the reply cannot be finished
+            self.close_connection = True
+        finally:
+            for conn in conns:
+                conn.close()
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self._send_cors()
+        if self.headers.get("Origin") in self.server.allowed_origins:
+            self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+            self.send_header("Access-Control-Allow-Headers", "Content-Type, Authorization")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path in PUBLIC_PATHS:
+            with open(WEB_INTERFACE, "rb") as f:
+                self._send(200, f.read(), "text/html; charset=utf-8")
+        elif not self._check_token():
+            return
+        elif path == "/stats":
+            try:
+                self._send_json(200, self.server.stats(parse_qs(urlsplit(self.path).query)))
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+        elif path == "/transactions":
+            try:
+                self._send_json(200, self.server.search(parse_qs(urlsplit(self.path).query)))
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+        elif path == "/report":
+            self._send_report(parse_qs(urlsplit(self.path).query))
+        elif path == "/metrics":
+            self._send(200, REGISTRY.render().encode("utf-8"), PROMETHEUS_CONTENT_TYPE)
+        elif path == "/metrics.json":
+            self._send_json(200, REGISTRY.snapshot())
+        elif path == "/health":
+            shards = self.server.shards
+            with self.server.locked(shards.loggers):
+                counts = {account: logger.store.count() for account, logger in shards.loggers.items()}
+            self._send_json(200, {"status": "ok", "transactions": sum(counts.values()), "accounts": counts})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if urlsplit(self.path).path != "/messages":
+            self._send_json(404, {"error": "not found"})
+            return
+        if not self._check_origin() or not self._check_token():
+            # The unread body would be taken for the next request
+            self.close_connection = True
+            return
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self._send_json(411, {"error": "Content-Length required"})
+            return
+        try:
+            length = int(length)
+            if length < 0:
+                raise ValueError
+        except ValueError:
+            # Where the body ends is unknown, so the connection cannot be reused
+            self.close_connection = True
+            self._send_json(400, {"error": f"invalid Content-Length {length!r}"})
+            return
+        if length > MAX_BODY:
+            self.close_connection = True
+            self._send_json(413, {"error": f"body larger than {MAX_BODY} bytes"})
+            return
+
+        body = self.rfile.read(length)
+        try:
+            messages = parse_body(body, self.headers.get("Content-Type"))
+        except (ValueError, UnicodeDecodeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        # One trace per request, so its summary and any errors can be tied together
+        with traced():
+            self._send_json(200, self.server.ingest(messages, self._token()))
+
+    def _token(self):
+        """The account token of a post, from its Authorization header or ?token="""
+        authorization = self.headers.get("Authorization", "")
+        if authorization.lower().startswith("bearer "):
+            return authorization[7:].strip()
+        return parse_qs(urlsplit(self.path).query).get("token", [None])[0]
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="HTTP endpoint for pushing M-PESA messages")
+    parser.add_argument("--excel", default="mpesa_transactions.xlsx", help="Excel export file")
+    parser.add_argument("--host", default="127.0.0.1", help="Use 0.0.0.0 to accept posts from the phone over Wi-Fi")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--no-mirror", action="store_true",
+                        help="Only write the store on each post; the output sinks are exported on exit")
+    add_sink_argument(parser)
+    parser.add_argument("--accounts", help="JSON file mapping post tokens to accounts, each with its own store "
+                                           "(default: $MPESA_ACCOUNTS)")
+    parser.add_argument("--token", action="append", default=[],
+                        help="Token accepted as 'Authorization: Bearer <token>' or ?token= (repeatable); "
+                             "required when --host is not a loopback address")
+    parser.add_argument("--allow-origin", action="append", default=[],
+                        help="Origin whose pages may read replies (repeatable); 'null' for the page opened from disk")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    try:
+        accounts = load_accounts(args.accounts)
+    except ValueError as e:
+        parser.error(str(e))
+    if not is_loopback(args.host) and not args.token and not any(kind == "token" for kind, _ in accounts.routes):
+        parser.error(f"--host {args.host} accepts connections from other machines; give a --token")
+
+    configure_logging(args.log_level, json_format=args.log_format == "json")
+    logger = ShardedLogger(args.excel, accounts, sinks=args.sink)
+    server = IngestServer((args.host, args.port), logger, mirror=not args.no_mirror, tokens=args.token,
+                          allowed_origins=args.allow_origin)
+    print(f"🌐 Listening on http://{args.host}:{args.port} (POST /messages, web page at /)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n⏹️ HTTP ingest stopped")
+    finally:
+        server.server_close()
+        logger.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+"""
+asyncio ingestion service: several SMS sources feeding one writer per account.
+
+Each source (an ADB device, a tailed file, stdin) is a producer task putting
+messages on its account's bounded queue; when the writer falls behind,
+producers wait on the queue instead of piling up memory. A consumer task per
+account owns parsing, duplicate detection and the batch writer, and runs them
+on the account's own thread so slow disk or Excel writes never stall source
+polling. With --accounts, devices and files are mapped to accounts (see
+account_shards.py), each with its own store and writer, so accounts commit in
+parallel and a busy agent line never queues ahead of a personal one. Sources queue
+a checkpoint after their messages; it runs once everything before it is durable,
+which is when cursors are saved. Accepted messages are appended to a fsynced
+journal (message_journal.py) with one fsync per burst, so checkpoints need not
+wait for the group commit; --no-journal waits for the commit instead. With
+--all-devices every phone in `adb devices` gets its own worker, cursor and
+counters, and phones can be plugged in or removed while the service runs.
+
+Every message gets a trace ID when it is read, and each stage it passes
+through (poll, queue, filter, parse, dedup, write, flush) is timed into the
+metrics registry from instrumentation.py; --metrics-port serves them for
+Prometheus and --metrics-file writes a JSON snapshot every few seconds.
+
+Usage: python ingest_service.py --all-devices --file /sdcard/mpesa_messages.txt --stdin --metrics-port 9108
+       python ingest_service.py --accounts accounts.json --all-devices
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from account_shards import DEFAULT_ACCOUNT, ShardedLogger, load_accounts
+from adb_inbox import (SENDERS, AdaptiveInterval, AdbInboxReader, InboxCursor, device_cursor_file,
+                       list_devices, sender_allowlist)
+from android_sms_monitor import is_mpesa_message
+from balance_reconciler import refetch_gaps
+from file_tailer import FileTailer, cursor_file, watch
+from instrumentation import (REGISTRY, SnapshotWriter, add_logging_arguments, configure_logging,
+                             new_trace_id, serve_metrics, stage, traced)
+from mpesa_logger import add_sink_argument
+
+log = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class DeviceState:
+    """Health and throughput of one device's inbox worker"""
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.status = "starting"
+        self.messages = 0
+        self.polls = 0
+        self.errors = 0
+        self.last_error = None
+        self.started = time.monotonic()
+
+    def messages_per_minute(self):
+        elapsed = time.monotonic() - self.started
+        return self.messages * 60 / elapsed if elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            "serial": self.serial,
+            "status": self.status,
+            "messages": self.messages,
+            "polls": self.polls,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "messages_per_minute": round(self.messages_per_minute(), 2),
+        }
+
+
+class AccountLane:
+    """One account's queue, counters and writer thread"""
+
+    def __init__(self, account, logger, queue_size):
+        self.account = account
+        self.logger = logger
+        self.queue = asyncio.Queue(queue_size)
+        self.stats = {"received": 0, "processed": 0, "ignored": 0}
+        # Every call on this account's logger happens on this one thread
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"ingest-writer-{account}")
+
+
+class IngestService:
+    """Runs message sources concurrently into one writer per account"""
+
+    def __init__(self, logger, queue_size=1000, batch_size=200, accept=is_mpesa_message):
+        # A ShardedLogger, or a single MPESATransactionLogger as the default account
+        self.shards = logger if isinstance(logger, ShardedLogger) else ShardedLogger.single(logger)
+        self.logger = self.shards.default
+        self.lanes = {account: AccountLane(account, shard, queue_size)
+                      for account, shard in self.shards.loggers.items()}
+        self.batch_size = batch_size
+        self.accept = accept
+        self.sources = []
+        self.devices = {}
+        self._stop = None
+
+    @property
+    def stats(self):
+        """Messages received, processed and ignored, over every account"""
+        totals = {"received": 0, "processed": 0, "ignored": 0}
+        for lane in self.lanes.values():
+            for name, count in lane.stats.items():
+                totals[name] += count
+        return totals
+
+    def account_for(self, kind, key):
+        """The account a source belongs to (see account_shards.AccountMap)"""
+        return self.shards.accounts.account_for(kind, key)
+
+    def add_source(self, name, source):
+        """Register a coroutine function taking the service; it runs as a producer task"""
+        self.sources.append((name, source))
+
+    async def submit(self, message, source="unknown", arrived=None, account=DEFAULT_ACCOUNT):
+        """Queue a message for an account, waiting while its queue is full
+
+        arrived is the Unix time the message was sent or received (now by
+        default); the commit lag metric is measured from it.
+        """
+        lane = self.lanes[account]
+        lane.stats["received"] += 1
+        REGISTRY.inc("mpesa_messages_received_total", source=source)
+        trace_id = new_trace_id()
+        with traced(trace_id):
+            log.debug("Received from %s: %s...", source, message[:50])
+        await lane.queue.put((message, trace_id, time.perf_counter(),
+                              time.time() if arrived is None else arrived))
+        REGISTRY.set("mpesa_queue_depth", lane.queue.qsize(), account=account)
+
+    async def checkpoint(self, callback, account=DEFAULT_ACCOUNT):
+        """Queue a callback to run once every message queued before it for the account is journaled or committed"""
+        await self.lanes[account].queue.put(callback)
+
+    def stop(self):
+        """Ask the service to drain the queue and shut down"""
+        if self._stop:
+            self._stop.set()
+
+    async def _run_source(self, name, source):
+        try:
+            await source(self)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Source %s stopped", name)
+            REGISTRY.inc("mpesa_errors_total", stage="source")
+
+    async def _consume(self, lane):
+        loop = asyncio.get_running_loop()
+        queue = lane.queue
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            REGISTRY.set("mpesa_queue_depth", queue.qsize(), account=lane.account)
+            await loop.run_in_executor(lane.writer, self._write, lane, batch, queue.empty())
+            if batch[-1] is _STOP:
+                return
+
+    def _write(self, lane, batch, idle=False):
+        """Parse, dedup and queue a batch for writing (runs on the account's writer thread)
+
+        idle says nothing else was waiting in the queue: the burst is over, so its
+        commit starts now instead of after the batch writer's delay.
+        """
+        logger = lane.logger
+        accepted = []
+        for item in batch:
+            if item is _STOP or callable(item):
+                # Journaled in one append, so a burst costs a single fsync
+                self._process(lane, accepted)
+                accepted = []
+                if item is _STOP or logger.journal is None:
+                    logger.flush()
+                if callable(item):
+                    # With a journal, messages are safe once appended and need not wait for the commit
+                    item()
+                continue
+            message, trace_id, enqueued, arrived = item
+            REGISTRY.observe("mpesa_stage_seconds", time.perf_counter() - enqueued, stage="queue")
+            with stage("filter"):
+                ok = self.accept(message)
+            if ok:
+                accepted.append((message, arrived, trace_id))
+            else:
+                lane.stats["ignored"] += 1
+                REGISTRY.inc("mpesa_messages_total", outcome="ignored")
+        self._process(lane, accepted)
+        if idle:
+            logger.flush_soon()
+
+    def _process(self, lane, entries):
+        if entries:
+            lane.stats["processed"] += lane.logger.process_durably(entries)
+
+    async def run(self):
+        """Run every source until stopped (or until all of them finish), then drain"""
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # Windows, or not on the main thread: Ctrl+C raises instead
+                pass
+
+        consumers = [asyncio.create_task(self._consume(lane)) for lane in self.lanes.values()]
+        producers = [asyncio.create_task(self._run_source(name, source)) for name, source in self.sources]
+        finished = asyncio.gather(*producers, return_exceptions=True)
+        stopping = asyncio.create_task(self._stop.wait())
+        await asyncio.wait({finished, stopping}, return_when=asyncio.FIRST_COMPLETED)
+
+        log.info("Draining queued messages...")
+        stopping.cancel()
+        for task in producers:
+            task.cancel()
+        await finished
+        # Everything queued before the sentinel is written before shutdown
+        for lane in self.lanes.values():
+            await lane.queue.put(_STOP)
+        await asyncio.gather(*consumers)
+        for lane in self.lanes.values():
+            lane.writer.shutdown()
+        stats = self.stats
+        log.info("Ingest stopped: %d received, %d processed, %d not M-PESA",
+                 stats["received"], stats["processed"], stats["ignored"])
+        if len(self.lanes) > 1:
+            for lane in self.lanes.values():
+                log.info("Account %s: %d received, %d processed, %d not M-PESA", lane.account,
+                         lane.stats["received"], lane.stats["processed"], lane.stats["ignored"])
+        for device in self.devices.values():
+            log.info("Device %s: %d messages, %d errors (%s)",
+                     device.serial, device.messages, device.errors, device.status)
+
+
+def adb_source(cursor_path, serial=None, min_interval=0.5, max_interval=3.0, state=None, senders=SENDERS):
+    """Source polling a device's SMS inbox past a persisted cursor, for the allowlisted senders"""
+    async def run(service):
+        loop = asyncio.get_running_loop()
+        device = state or service.devices.setdefault(serial or "default", DeviceState(serial or "default"))
+        account = service.account_for("adb", serial)
+        cursor = InboxCursor(cursor_path)
+        reader = AdbInboxReader(cursor, serial=serial, senders=senders)
+        interval = AdaptiveInterval(min_interval, max_interval)
+        # The device's shell session is only ever used from this one thread, and
+        # devices never wait on each other for a free thread
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"adb-{serial or 'default'}")
+        try:
+            while True:
+                try:
+                    with stage("poll"):
+                        rows = await loop.run_in_executor(executor, reader.fetch)
+                except (ConnectionError, RuntimeError) as e:
+                    if device.status != "error":
+                        log.warning("ADB %s unavailable (%s), retrying...", device.serial, e)
+                    REGISTRY.inc("mpesa_errors_total", stage="poll")
+                    device.status = "error"
+                    device.errors += 1
+                    device.last_error = str(e)
+                    await asyncio.sleep(interval.fail())
+                    continue
+                device.status = "online"
+                device.polls += 1
+                for row in rows:
+                    # The inbox date is when the SMS reached the phone, in milliseconds
+                    await service.submit(row["body"], source=f"adb:{device.serial}", account=account,
+                                         arrived=int(row["date"]) / 1000 if row.get("date") else None)
+                    device.messages += 1
+                if rows:
+                    cursor.advance(rows)
+                    await service.checkpoint(partial(cursor.save, cursor.snapshot()), account=account)
+                await refetch(service, device, loop, executor, reader, account)
+                await asyncio.sleep(interval.next(bool(rows)))
+        finally:
+            # Closing the session also ends a fetch still blocked on the device
+            reader.close()
+            executor.shutdown(wait=False)
+    return run
+
+
+async def refetch(service, device, loop, executor, reader, account=DEFAULT_ACCOUNT):
+    """Submit inbox rows from the time window of a gap in the account's balance chain, if one is due"""
+    logger = service.lanes[account].logger
+    try:
+        rows = await loop.run_in_executor(executor, refetch_gaps, logger.reconciler, reader, logger.code_index)
+    except (ConnectionError, RuntimeError) as e:
+        # The gap is fetched again on its next retry
+        log.warning("Re-fetch on %s failed (%s)", device.serial, e)
+        REGISTRY.inc("mpesa_errors_total", stage="refetch")
+        return
+    for row in rows:
+        # Not counted as device messages; ones already stored are dropped as duplicates
+        await service.submit(row["body"], source=f"adb:{device.serial}:refetch", account=account,
+                             arrived=int(row["date"]) / 1000 if row.get("date") else None)
+
+
+def devices_source(base_name, discover_interval=5.0, **poll_options):
+    """Source running one adb_source per attached device, following hot-plug events"""
+    async def run(service):
+        workers = {}
+        try:
+            while True:
+                try:
+                    attached = await asyncio.get_running_loop().run_in_executor(None, list_devices)
+                except (RuntimeError, subprocess.TimeoutExpired) as e:
+                    log.warning("adb devices failed (%s), retrying...", e)
+                    attached = {}
+
+                for serial, status in attached.items():
+                    worker = workers.get(serial)
+                    if status == "device" and (worker is None or worker.done()):
+                        log.info("Device %s connected", serial)
+                        device = service.devices.setdefault(serial, DeviceState(serial))
+                        source = adb_source(device_cursor_file(base_name, serial), serial,
+                                            state=device, **poll_options)
+                        workers[serial] = asyncio.create_task(service._run_source(f"adb:{serial}", source))
+                    elif status != "device":
+                        # e.g. "unauthorized" until the phone accepts the debugging prompt
+                        service.devices.setdefault(serial, DeviceState(serial)).status = status
+
+                for serial in [serial for serial in workers if attached.get(serial) != "device"]:
+                    log.info("Device %s disconnected", serial)
+                    workers.pop(serial).cancel()
+                    service.devices[serial].status = attached.get(serial, "disconnected")
+
+                await asyncio.sleep(discover_interval)
+        finally:
+            for worker in workers.values():
+                worker.cancel()
+            await asyncio.gather(*workers.values(), return_exceptions=True)
+    return run
+
+
+def file_source(path, cursor_path, poll_interval=5.0):
+    """Source tailing an append-only file, woken by inotify where available"""
+    async def run(service):
+        loop = asyncio.get_running_loop()
+        tailer = FileTailer(path, cursor_path)
+        account = service.account_for("file", path)
+        watcher = watch(path)
+        changed = asyncio.Event()
+        if watcher:
+            loop.add_reader(watcher.fileno(), changed.set)
+        try:
+            while True:
+                with stage("poll"):
+                    lines = await loop.run_in_executor(None, tailer.read_lines)
+                for line in lines:
+                    line = line.strip()
+                    if line:
+                        await service.submit(line, source=f"file:{path}", account=account)
+                if lines:
+                    await service.checkpoint(partial(tailer.commit, tailer.snapshot()), account=account)
+                    continue
+                try:
+                    await asyncio.wait_for(changed.wait(), poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                if watcher:
+                    changed.clear()
+                    watcher.drain()
+        finally:
+            if watcher:
+                loop.remove_reader(watcher.fileno())
+                watcher.close()
+            tailer.close()
+    return run
+
+
+async def stdin_source(service, stream=None):
+    """Source reading one message per line from stdin until end of file"""
+    stream = stream or sys.stdin
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+
+    # A daemon thread, because a blocked readline cannot be cancelled and would
+    # otherwise hold up shutdown
+    def pump():
+        try:
+            for line in stream:
+                line = line.strip()
+                if line:
+                    asyncio.run_coroutine_threadsafe(service.submit(line, source="stdin"), loop).result()
+        except Exception:
+            # The loop shut down while we were waiting for queue space
+            return
+        loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(None))
+
+    threading.Thread(target=pump, name="stdin-source", daemon=True).start()
+    await finished
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run several SMS sources into one transaction store")
+    parser.add_argument("--excel", default="mpesa_transactions.xlsx", help="Excel export file")
+    parser.add_argument("--adb", action="store_true", help="Poll the default device's SMS inbox")
+    parser.add_argument("--serial", action="append", default=[], help="Poll this device's SMS inbox (repeatable)")
+    parser.add_argument("--all-devices", action="store_true", help="Poll every attached device, following hot-plug")
+    parser.add_argument("--file", action="append", default=[], help="Tail a message file (repeatable)")
+    parser.add_argument("--stdin", action="store_true", help="Read messages from stdin, one per line")
+    parser.add_argument("--senders", help="Comma-separated sender addresses to fetch over ADB, SQL LIKE "
+                                          "patterns allowed, or * for every SMS (default: $MPESA_SENDERS or MPESA)")
+    parser.add_argument("--accounts", help="JSON file mapping device serials and files to accounts, each with "
+                                           "its own store and writer (default: $MPESA_ACCOUNTS)")
+    parser.add_argument("--queue-size", type=int, default=1000, help="Messages buffered per account before sources wait")
+    parser.add_argument("--no-mirror", "--no-excel-mirror", action="store_true",
+                        help="Only write the store on each commit; the output sinks are exported on exit")
+    add_sink_argument(parser)
+    parser.add_argument("--no-journal", action="store_true",
+                        help="Acknowledge messages only after the store commit instead of journaling them")
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on this port (/metrics)")
+    parser.add_argument("--metrics-file", help="Write a JSON metrics snapshot to this file periodically")
+    parser.add_argument("--metrics-interval", type=float, default=10.0, help="Seconds between snapshots")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+
+    if not (args.adb or args.serial or args.all_devices or args.file or args.stdin):
+        parser.error("choose at least one source: --adb, --serial, --all-devices, --file or --stdin")
+    try:
+        senders = sender_allowlist(args.senders)
+        accounts = load_accounts(args.accounts)
+    except ValueError as e:
+        parser.error(str(e))
+
+    configure_logging(args.log_level, json_format=args.log_format == "json")
+    metrics_server = serve_metrics(args.metrics_port) if args.metrics_port else None
+    snapshots = SnapshotWriter(args.metrics_file, args.metrics_interval) if args.metrics_file else None
+
+    shards = ShardedLogger(args.excel, accounts, sinks=args.sink)
+    shards.start_batching(mirror=not args.no_mirror, journal=not args.no_journal)
+    base_name = os.path.splitext(args.excel)[0]
+
+    service = IngestService(shards, queue_size=args.queue_size)
+    if args.adb:
+        service.add_source("adb", adb_source(base_name + ".adb_cursor.json", senders=senders))
+    for serial in args.serial:
+        service.add_source(f"adb:{serial}", adb_source(device_cursor_file(base_name, serial), serial,
+                                                       senders=senders))
+    if args.all_devices:
+        service.add_source("devices", devices_source(base_name, senders=senders))
+    for path in args.file:
+        service.add_source(f"file:{path}", file_source(path, cursor_file(base_name, path)))
+    if args.stdin:
+        service.add_source("stdin", stdin_source)
+
+    try:
+        asyncio.run(service.run())
+    finally:
+        shards.close()
+        if snapshots:
+            snapshots.close()
+        if metrics_server:
+            metrics_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
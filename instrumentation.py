@@ -0,0 +1,304 @@
+"""
+Metrics, logging setup and per-message trace IDs for the ingestion pipeline.
+
+Each stage a message passes through reports its latency into one histogram,
+mpesa_stage_seconds{stage=...}:
+
+    poll    one ADB inbox query or file read          (is ADB the bottleneck?)
+    queue   waiting in the ingest queue for the writer
+    filter  the M-PESA confirmation check
+    parse   mpesa_parser.parse_message                (is parsing?)
+    dedup   code index / pending batch lookups
+    write   storing one message, or queueing it for the batch writer
+    flush   one group commit                          (is the disk?)
+    sink    appending a flushed batch to an output sink (workbook, CSV, ...)
+
+mpesa_pipeline_lag_seconds measures how far behind real time commits are:
+from the moment a message arrived (the SMS timestamp for ADB rows) to the
+commit that stored it. Counters track messages by outcome and errors by stage.
+
+The registry renders as Prometheus text (GET /metrics on http_ingest.py, or
+ingest_service.py --metrics-port) or as a JSON snapshot written periodically
+(--metrics-file). Log records carry the trace ID of the message being handled,
+so one message can be followed from its source to its commit.
+"""
+
+import contextvars
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram, as Prometheus expects"""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One slot per bucket plus +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (None when empty)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Registry:
+    """Thread-safe set of counters, gauges and histograms, keyed by name and labels"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> [kind, help, buckets, {sorted label items: value or Histogram}]
+        self.families = {}
+
+    def describe(self, name, kind, help_text, buckets=LATENCY_BUCKETS):
+        with self.lock:
+            self.families.setdefault(name, [kind, help_text, buckets, {}])
+
+    def _series(self, name):
+        family = self.families.get(name)
+        if family is None:
+            raise KeyError(f"metric {name} was not described")
+        return family
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self._series(name)[3]
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self._series(name)[3][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self._series(name)
+            histogram = family[3].get(key)
+            if histogram is None:
+                histogram = family[3][key] = Histogram(family[2])
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        """Prometheus text exposition format"""
+        def label_text(key, extra=()):
+            items = list(key) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{str(v)}"' for k, v in items) + "}"
+
+        lines = []
+        with self.lock:
+            for name, (kind, help_text, buckets, series) in sorted(self.families.items()):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(series.items()):
+                    if kind != "histogram":
+                        lines.append(f"{name}{label_text(key)} {value}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(buckets) + ["+Inf"], value.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{label_text(key, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{label_text(key)} {value.sum}")
+                    lines.append(f"{name}_count{label_text(key)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """JSON-friendly view: counters and gauges as numbers, histograms summarised"""
+        result = {"timestamp": time.time()}
+        with self.lock:
+            for name, (kind, _, _, series) in self.families.items():
+                entries = []
+                for key, value in series.items():
+                    entry = dict(key)
+                    if kind == "histogram":
+                        entry.update(count=value.count, sum=round(value.sum, 6),
+                                     p50=value.quantile(0.5), p95=value.quantile(0.95), p99=value.quantile(0.99))
+                    else:
+                        entry["value"] = value
+                    entries.append(entry)
+                result[name] = entries
+        return result
+
+
+REGISTRY = Registry()
+REGISTRY.describe("mpesa_stage_seconds", "histogram", "Latency of each pipeline stage")
+REGISTRY.describe("mpesa_pipeline_lag_seconds", "histogram",
+                  "Seconds from a message arriving (SMS timestamp for ADB) to its commit", LAG_BUCKETS)
+REGISTRY.describe("mpesa_messages_received_total", "counter", "Messages read from each source")
+REGISTRY.describe("mpesa_messages_total", "counter", "Messages handled by the logger, by outcome")
+REGISTRY.describe("mpesa_rows_written_total", "counter", "Transactions committed to the store")
+REGISTRY.describe("mpesa_errors_total", "counter", "Errors by pipeline stage")
+REGISTRY.describe("mpesa_queue_depth", "gauge", "Messages waiting in an account's ingest queue")
+REGISTRY.describe("mpesa_last_commit_timestamp_seconds", "gauge", "Unix time of the last group commit")
+
+
+def stage(name):
+    """Context manager timing one pipeline stage"""
+    return REGISTRY.timer("mpesa_stage_seconds", stage=name)
+
+
+def record_commit(arrivals):
+    """Record a commit of messages that arrived at the given Unix times (None if unknown)"""
+    now = time.time()
+    for arrived in arrivals:
+        if arrived is not None:
+            REGISTRY.observe("mpesa_pipeline_lag_seconds", max(0.0, now - arrived))
+    REGISTRY.set("mpesa_last_commit_timestamp_seconds", now)
+
+
+_trace = contextvars.ContextVar("trace", default="-")
+_trace_ids = itertools.count(1)
+_TRACE_PREFIX = f"{os.getpid():x}"
+
+
+def new_trace_id():
+    """Short process-unique ID for following one message through the logs"""
+    return f"{_TRACE_PREFIX}-{next(_trace_ids):06x}"
+
+
+@contextmanager
+def traced(trace_id=None):
+    """Attach a trace ID (a new one by default) to log records in this context"""
+    token = _trace.set(trace_id or new_trace_id())
+    try:
+        yield _trace.get()
+    finally:
+        _trace.reset(token)
+
+
+def current_trace():
+    return _trace.get()
+
+
+class _TraceFilter(logging.Filter):
+    def filter(self, record):
+        record.trace = _trace.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "trace": getattr(record, "trace", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["error"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def configure_logging(level="INFO", json_format=False):
+    """Send log records to stderr with their trace IDs; call once from a command-line entry point"""
+    handler = logging.StreamHandler()
+    handler.addFilter(_TraceFilter())
+    if json_format:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s [%(trace)s] %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+
+def add_logging_arguments(parser):
+    """Add --log-level and --log-format to an argparse parser"""
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--log-format", default="text", choices=["text", "json"])
+
+
+def serve_metrics(port, host="127.0.0.1"):
+    """Serve /metrics (Prometheus) and /metrics.json from a daemon thread; returns the server"""
+    # http.server pulls in the email package, so processes without a metrics port skip it
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] == "/metrics":
+                body, content_type = REGISTRY.render().encode("utf-8"), PROMETHEUS_CONTENT_TYPE
+            elif self.path.split("?")[0] == "/metrics.json":
+                body, content_type = json.dumps(REGISTRY.snapshot()).encode("utf-8"), "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+class SnapshotWriter:
+    """Writes the JSON snapshot to a file every interval seconds from a daemon thread"""
+
+    def __init__(self, path, interval=10.0):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="metrics-snapshot", daemon=True)
+        self.thread.start()
+
+    def write(self):
+        temp_file = self.path + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(REGISTRY.snapshot(), f)
+        os.replace(temp_file, self.path)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def close(self):
+        """Stop the thread and write a final snapshot"""
+        self.stopped.set()
+        self.thread.join()
+        self.write()
@@ -0,0 +1,192 @@
+"""
+Seeded generator of synthetic M-PESA SMS messages for benchmarks.
+
+Produces send, receive, paybill, buy goods and withdraw messages in the
+formats understood by mpesa_parser, with unique transaction codes. Optionally
+mixes in malformed messages (truncated, failed transactions, promotions,
+corrupted codes) and re-deliveries of recent messages, as phones produce,
+and can produce the bank, loan and shop SMS from other senders that share an
+inbox with them.
+"""
+
+import random
+import string
+from collections import deque
+from datetime import datetime, timedelta
+
+CODE_CHARS = string.ascii_uppercase + string.digits
+FIRST_NAMES = ["JOHN", "JANE", "MARY", "PETER", "GRACE", "JAMES", "FAITH", "BRIAN", "MERCY", "KEVIN"]
+LAST_NAMES = ["KAMAU", "WANJIKU", "OTIENO", "ACHIENG", "MWANGI", "NJERI", "KIPROTICH", "CHEBET"]
+BILLERS = [("KPLC PREPAID", 8), ("NAIROBI WATER", 6), ("ZUKU", 9), ("DSTV", 10), ("SAFARICOM HOME", 7)]
+MERCHANTS = ["NAIVAS SUPERMARKET", "QUICKMART", "CARREFOUR", "JAVA HOUSE", "MAMA MBOGA STALL", "TOTAL ENERGIES"]
+AGENTS = ["EQUITY AGENT", "KCB AGENT", "MAMA MBOGA SHOP", "CITY CENTRE MPESA", "JUJA SHOPPING CENTRE"]
+PROMOTIONS = [
+    "Dear Customer, get 1GB data valid for 1 hour at Ksh19. Dial *544# to buy.",
+    "M-PESA is now available 24/7. Dial *334# to check your balance. Terms apply.",
+    "Your Fuliza M-PESA limit is Ksh1,500.00. Dial *234*0# to opt in.",
+    "Safaricom: You have 3 missed calls. Call back now at normal rates.",
+]
+# (sender, template) of SMS from other senders that also talk about Ksh and balances
+OTHER_SMS = [
+    ("EQUITYBANK", "Dear Customer, your account ****{digits} has been debited with Ksh{amount}. "
+                   "Available balance Ksh{balance}. Transaction Ref {ref}."),
+    ("KCB", "Confirmed: Ksh{amount} deposited to A/C ****{digits} on {when}. Your balance is Ksh{balance}."),
+    ("TALA", "Your loan of Ksh{amount} is due on {when}. Repay via M-PESA Paybill 851900 to keep your limit."),
+    ("Safaricom", "Dear Customer, your airtime balance is Ksh{amount}. Transaction successful. Dial *544# for bundles."),
+    ("NAIVAS", "Thank you for shopping at NAIVAS. You earned points worth Ksh{amount}. Points balance Ksh{balance}."),
+]
+
+
+def _money(value):
+    return f"{value:,.2f}"
+
+
+def _when(moment):
+    return f"{moment.day}/{moment.month}/{moment.year % 100:02d} at {moment.hour % 12 or 12}:{moment.minute:02d} {'PM' if moment.hour >= 12 else 'AM'}"
+
+
+class MessageGenerator:
+    """Generates a stream of realistic M-PESA messages from a seed"""
+
+    def __init__(self, seed=42, start=datetime(2025, 1, 1, 8, 0), balance=5000.0, malformed=0.0, duplicates=0.0):
+        self.rng = random.Random(seed)
+        self.moment = start
+        self.balance = balance
+        # Fractions of the output that are malformed messages and re-deliveries
+        self.malformed = malformed
+        self.duplicates = duplicates
+        self.recent = deque(maxlen=1000)
+
+    def code(self):
+        """Return a random 10-character transaction code"""
+        return "".join(self.rng.choices(CODE_CHARS, k=10))
+
+    def person(self):
+        """Return a random name with a phone number"""
+        phone = "07" + "".join(self.rng.choices(string.digits, k=8))
+        return f"{self.rng.choice(FIRST_NAMES)} {self.rng.choice(LAST_NAMES)} {phone}"
+
+    def _advance(self):
+        self.moment += timedelta(minutes=self.rng.randint(1, 240))
+        return _when(self.moment)
+
+    def _debit(self, high, cost):
+        """Pick an amount the balance can cover and deduct it with its cost"""
+        if self.balance < 10 + cost:
+            return None
+        amount = float(self.rng.randint(10, int(min(high, self.balance - cost))))
+        self.balance -= amount + cost
+        return amount
+
+    def send(self):
+        cost = 13.0
+        amount = self._debit(5000, cost)
+        if amount is None:
+            return self.receive()
+        return (f"{self.code()} Confirmed. Ksh{_money(amount)} sent to {self.person()} on {self._advance()}. "
+                f"New M-PESA balance is Ksh{_money(self.balance)}. Transaction cost, Ksh{_money(cost)}. "
+                f"Amount you can transact within the day is {_money(500000 - amount)}.")
+
+    def receive(self):
+        amount = float(self.rng.randint(50, 20000))
+        self.balance += amount
+        if self.rng.random() < 0.5:
+            return (f"{self.code()} Confirmed.You have received Ksh{_money(amount)} from {self.person()} "
+                    f"on {self._advance()}  New M-PESA balance is Ksh{_money(self.balance)}. "
+                    f"Earn interest daily on Ziidi MMF,Dial *334#")
+        return (f"{self.code()} Confirmed. Ksh{_money(amount)} received from {self.person()} on {self._advance()}. "
+                f"New M-PESA balance is Ksh{_money(self.balance)}. Transaction cost, Ksh0.00.")
+
+    def paybill(self):
+        biller, digits = self.rng.choice(BILLERS)
+        account = "".join(self.rng.choices(string.digits, k=digits))
+        amount = self._debit(8000, 23.0)
+        if amount is None:
+            return self.receive()
+        return (f"{self.code()} Confirmed. Ksh{_money(amount)} sent to {biller} for account {account} "
+                f"on {self._advance()} New M-PESA balance is Ksh{_money(self.balance)}. "
+                f"Transaction cost, Ksh23.00.Amount you can transact within the day is {_money(500000 - amount)}.")
+
+    def buy_goods(self):
+        amount = self._debit(3000, 0.0)
+        if amount is None:
+            return self.receive()
+        return (f"{self.code()} Confirmed. Ksh{_money(amount)} paid to {self.rng.choice(MERCHANTS)}. "
+                f"on {self._advance()}.New M-PESA balance is Ksh{_money(self.balance)}. "
+                f"Transaction cost, Ksh0.00. Amount you can transact within the day is {_money(500000 - amount)}.")
+
+    def withdraw(self):
+        amount = self._debit(10000, 29.0)
+        if amount is None:
+            return self.receive()
+        agent_number = "".join(self.rng.choices(string.digits, k=6))
+        return (f"{self.code()} Confirmed.on {self._advance()}Withdraw Ksh{_money(amount)} from "
+                f"{agent_number} - {self.rng.choice(AGENTS)} New M-PESA balance is Ksh{_money(self.balance)}. "
+                f"Transaction cost, Ksh29.00. Amount you can transact within the day is {_money(500000 - amount)}.")
+
+    def transaction(self):
+        """Return one well-formed message of a randomly chosen type"""
+        kind = self.rng.choices(
+            (self.send, self.receive, self.paybill, self.buy_goods, self.withdraw),
+            weights=(30, 25, 15, 20, 10),
+        )[0]
+        return kind()
+
+    def malformed_message(self):
+        """Return a message the parser should reject or only partly understand"""
+        kind = self.rng.randrange(4)
+        if kind == 0:
+            # Cut short, as multi-part SMS sometimes arrive
+            message = self.transaction()
+            return message[:self.rng.randint(12, len(message) - 20)]
+        if kind == 1:
+            return (f"Failed. You do not have enough money in your M-PESA account to send "
+                    f"Ksh{_money(self.rng.randint(1000, 50000))}. Your M-PESA balance is Ksh{_money(self.balance)}.")
+        if kind == 2:
+            return self.rng.choice(PROMOTIONS)
+        # Transaction code mangled by a copy-paste or OCR
+        message = self.transaction()
+        return message[:10].lower() + message[10:]
+
+    def other_sms(self):
+        """Return (sender, body) of an SMS from another sender that mentions money"""
+        sender, template = self.rng.choice(OTHER_SMS)
+        return sender, template.format(
+            amount=_money(self.rng.randint(50, 20000)), balance=_money(self.rng.randint(100, 500000)),
+            digits="".join(self.rng.choices(string.digits, k=4)), ref=self.code(), when=_when(self.moment))
+
+    def message(self):
+        """Return one message: usually a new transaction, sometimes malformed or a re-delivery"""
+        if self.malformed or self.duplicates:
+            roll = self.rng.random()
+            if roll < self.duplicates and self.recent:
+                return self.rng.choice(self.recent)
+            if roll < self.duplicates + self.malformed:
+                return self.malformed_message()
+        message = self.transaction()
+        if self.duplicates:
+            self.recent.append(message)
+        return message
+
+    def messages(self, count):
+        """Yield count messages"""
+        for _ in range(count):
+            yield self.message()
+
+
+def generate_messages(count, seed=42, malformed=0.0, duplicates=0.0):
+    """Yield count synthetic M-PESA messages for the given seed"""
+    return MessageGenerator(seed, malformed=malformed, duplicates=duplicates).messages(count)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Write synthetic M-PESA messages, one per line")
+    parser.add_argument("count", type=int)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--malformed", type=float, default=0.0, help="Fraction of malformed messages")
+    parser.add_argument("--duplicates", type=float, default=0.0, help="Fraction of re-delivered messages")
+    args = parser.parse_args()
+    for message in generate_messages(args.count, args.seed, args.malformed, args.duplicates):
+        print(message)
@@ -0,0 +1,139 @@
+"""
+Write-ahead journal of accepted messages.
+
+Live sources append each batch of accepted messages here with one write and
+one fsync before anything is parsed, so a message is safe as soon as append()
+returns and the source can acknowledge it (save its cursor) without waiting
+for the store's group commit. Records are JSON lines:
+
+    {"seq": 17, "message": "THK04TF1W4 Confirmed. ...", "arrived": 1755675300.0}
+
+Once the batch writer has committed every processed message and the store has
+been synced, compact() drops them: the file is truncated when nothing newer is
+waiting, or rewritten to temp and renamed over the original when it grows
+past max_bytes mid-burst. On startup any records still in the file are handed
+back as recovered and replayed; a half-written last line (a crash during the
+append, before it was acknowledged) is cut off. Replay goes through the normal
+duplicate checks, so records that had already reached the store are skipped.
+"""
+
+import json
+import logging
+import os
+import threading
+
+from instrumentation import REGISTRY, stage
+
+log = logging.getLogger(__name__)
+
+REGISTRY.describe("mpesa_journal_bytes", "gauge", "Size of the message journal awaiting compaction")
+
+
+def _fsync_directory(path):
+    """Make a rename in path's directory durable (a no-op where directories cannot be opened)"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class MessageJournal:
+    """Append-only, fsynced log of accepted messages not yet compacted into the store"""
+
+    def __init__(self, path, max_bytes=8 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.recovered = self._recover()
+        self.last_seq = self.recovered[-1]["seq"] if self.recovered else 0
+        # Highest seq handed to the logger; everything up to it is stored or queued
+        self.processed_seq = 0
+        self.file = open(path, "ab")
+        self.size = self.file.tell()
+        REGISTRY.set("mpesa_journal_bytes", self.size)
+
+    def _recover(self):
+        """Read the records left by an earlier run, cutting off a torn last line"""
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        good = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+                good += len(line)
+            torn = f.seek(0, os.SEEK_END) > good
+        if torn:
+            log.warning("Discarding a partly written journal record in %s", self.path)
+            with open(self.path, "r+b") as f:
+                f.truncate(good)
+                os.fsync(f.fileno())
+        return records
+
+    def append(self, entries):
+        """Durably record (message, arrived) pairs with one fsync; returns their seqs"""
+        if not entries:
+            return []
+        with self.lock, stage("journal"):
+            seqs = range(self.last_seq + 1, self.last_seq + 1 + len(entries))
+            data = b"".join(
+                json.dumps({"seq": seq, "message": message, "arrived": arrived}, ensure_ascii=False).encode("utf-8") + b"\n"
+                for seq, (message, arrived) in zip(seqs, entries)
+            )
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.last_seq = seqs[-1]
+            self.size += len(data)
+            REGISTRY.set("mpesa_journal_bytes", self.size)
+            return list(seqs)
+
+    def processed(self, seq):
+        """Note that the message with this seq has been stored, queued or skipped"""
+        self.processed_seq = max(self.processed_seq, seq)
+
+    def compact(self, upto, store):
+        """Drop records up to seq upto, which the caller has just committed to store"""
+        with self.lock:
+            if not self.size or not upto:
+                return
+            if upto < self.last_seq and self.size <= self.max_bytes:
+                # Mid-burst: wait for a quiet moment rather than rewriting the file every flush
+                return
+            # The store's commits must survive a power cut before the journal forgets them
+            store.sync()
+            if upto >= self.last_seq:
+                os.ftruncate(self.file.fileno(), 0)
+                self.size = 0
+            else:
+                self._rewrite(upto)
+            REGISTRY.set("mpesa_journal_bytes", self.size)
+
+    def _rewrite(self, upto):
+        """Keep only records after upto, via a temp file renamed over the journal"""
+        self.file.close()
+        temp_file = self.path + ".tmp"
+        with open(self.path, "rb") as source, open(temp_file, "wb") as target:
+            for line in source:
+                if json.loads(line)["seq"] > upto:
+                    target.write(line)
+            target.flush()
+            os.fsync(target.fileno())
+        os.replace(temp_file, self.path)
+        _fsync_directory(self.path)
+        self.file = open(self.path, "ab")
+        self.size = self.file.tell()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,295 @@
+"""
+Declarative templates for M-PESA confirmation formats.
+
+Each format is written as the text that follows "<code> Confirmed." with
+{field} placeholders, for example
+
+    Ksh{amount} sent to {party} on {date} at {time}
+
+and compiled to one anchored regex. A space in a pattern matches any run of
+whitespace (or none, next to punctuation) and a '.' or ',' may be missing,
+since spacing and punctuation vary between app versions. Text in [brackets]
+is optional. Fields:
+
+    amount balance cost limit   a Ksh figure such as 1,500.00
+    number                      any other figure, not kept
+    date time                   20/8/25 and 10:15 AM
+    ref                         another transaction code (reversals)
+    account                     a Pay Bill account number (see account_type)
+    party                       the counterparty, up to the text after it
+    skip                        text to pass over
+
+The balance, cost and daily limit usually sit in a tail that every format
+shares, so mpesa_parser finds them by anchor after the match unless a
+template captures them. Templates are keyed on the first two words after
+"Confirmed." (figures skipped, lower-cased), taken from each template's
+example message. Parsing a message is then one dict lookup and, unless several
+formats share its key, one match. Templates that share a key are tried in
+registry order, so the more specific one goes first; a failed match scans the
+whole message, so close variants are better written as one template with an
+optional part.
+
+Extra templates, such as those proposed by template_miner.py, are read from
+the JSON file named by MPESA_TEMPLATES: a list of {"name", "type", "pattern",
+"example"} objects with an optional fixed "party" and "account_type".
+"""
+
+import json
+import logging
+import os
+import re
+
+log = logging.getLogger(__name__)
+
+TEMPLATES_ENV = "MPESA_TEMPLATES"
+
+_NUMBER = r'\d[\d,]*(?:\.\d+)?'
+FIELD_PATTERNS = {
+    "amount": rf'\s?(?P<amount>{_NUMBER})',
+    "balance": rf'\s?(?P<balance>{_NUMBER})',
+    "cost": rf'\s?(?P<cost>{_NUMBER})',
+    "limit": rf'\s?(?P<limit>{_NUMBER})',
+    "number": rf'\s?{_NUMBER}',
+    "date": r'(?P<day>\d{1,2})/(?P<month>\d{1,2})/(?P<year>\d{2,4})',
+    "time": r'(?P<hour>\d{1,2}):(?P<minute>\d{2})\s?(?P<meridiem>[AP])M',
+    "ref": r'(?P<ref>[A-Z0-9]{10})',
+    "account": r'(?P<account>[^\s.]+)',
+    "party": r'(?P<party>.+?)',
+    "skip": r'.*?',
+}
+# Fields that match as little as they can, so a pattern must not end with one
+_LAZY_FIELDS = ("party", "skip")
+_PLACEHOLDER_RE = re.compile(r'\{(\w+)\}')
+_LITERAL_RE = re.compile(r'(\s+)|([.,])|(\[|\])|([^\s.,\[\]]+)')
+# Words with a digit (figures, dates, times, codes) and a bare "Ksh" are left out of keys
+_SKIPPED = r'(?:[^\s\d]*\d\S*|Ksh)\s+'
+# Each word runs to the next space, so the only backtracking that could change a key is
+# taking a skipped "Ksh" back as a word; the lookahead rules that out
+_WORD = r'(?!Ksh\s)([^\s\d]+)'
+_KEY = rf'(?:{_SKIPPED})*{_WORD}(?:\s+(?:{_SKIPPED})*{_WORD})?(?=\s|$)'
+# "<code> Confirmed." and the space after it, where the format's own text starts.
+# Bank and promo SMS that mention Ksh never open like this.
+_PREFIX = r'\s*[A-Z0-9]{10}\s+Confirmed\b\.?\s*'
+_PREFIX_RE = re.compile(_PREFIX)
+# The prefix and the key words after it, in one match
+_BODY_RE = re.compile(rf'({_PREFIX})(?:{_KEY})?')
+_PUNCTUATION = '.,:;'
+
+
+def _key(first, second):
+    if first is None:
+        return ""
+    first = first.strip(_PUNCTUATION)
+    return f"{first} {second.strip(_PUNCTUATION)}".lower() if second else first.lower()
+
+
+def body_start(message):
+    """Position after a confirmation's "<code> Confirmed.", or None if it has none"""
+    match = _PREFIX_RE.match(message)
+    return match.end() if match else None
+
+
+def dispatch_key(message):
+    """The first two words after "Confirmed.", lower-cased, skipping figures, dates and 'Ksh'"""
+    match = _BODY_RE.match(message)
+    return _key(match.group(2), match.group(3)) if match else ""
+
+
+def _literal(text):
+    tokens = _LITERAL_RE.findall(text)
+    parts = []
+    for i, (space, punctuation, bracket, word) in enumerate(tokens):
+        if space:
+            # Words need the space between them ("Simon on 5/9/25" must not end the name at "Sim");
+            # next to punctuation it may be missing ("SHOP. on", "PM.New")
+            beside_punctuation = (i > 0 and tokens[i - 1][1]) or (i + 1 < len(tokens) and tokens[i + 1][1])
+            parts.append(r'\s*' if beside_punctuation else r'\s+')
+        elif punctuation:
+            parts.append(re.escape(punctuation) + '?')
+        elif bracket:
+            parts.append('(?:' if bracket == '[' else ')?')
+        else:
+            parts.append(re.escape(word))
+    return "".join(parts)
+
+
+def compile_pattern(pattern):
+    """Compile a template pattern to a regex; raises ValueError for a pattern that cannot work"""
+    parts = []
+    position = 0
+    field = None
+    for match in _PLACEHOLDER_RE.finditer(pattern):
+        parts.append(_literal(pattern[position:match.start()]))
+        field = match.group(1)
+        if field not in FIELD_PATTERNS:
+            raise ValueError(f"unknown field {{{field}}} in template {pattern!r}")
+        parts.append(FIELD_PATTERNS[field])
+        position = match.end()
+    tail = pattern[position:]
+    parts.append(_literal(tail))
+    if field in _LAZY_FIELDS and not tail.strip():
+        raise ValueError(f"template {pattern!r} must not end with {{{field}}}")
+    try:
+        return re.compile("".join(parts))
+    except re.error as e:
+        raise ValueError(f"bad template {pattern!r}: {e}") from None
+
+
+class Template:
+    """One confirmation format: its transaction type, pattern and an example message"""
+
+    __slots__ = ("name", "transaction_type", "pattern", "example", "party", "account_type", "regex", "key")
+
+    def __init__(self, name, transaction_type, pattern, example, party=None, account_type=None):
+        self.name = name
+        self.transaction_type = transaction_type
+        self.pattern = pattern
+        self.example = example
+        # Counterparty for formats that name none, e.g. airtime for yourself
+        self.party = party
+        # Transaction type instead when an optional {account} is present ("sent to X for account Y")
+        self.account_type = account_type
+        self.regex = compile_pattern(pattern)
+        start = body_start(example)
+        if start is None or not self.regex.match(example, start):
+            raise ValueError(f"template {name!r} does not match its example")
+        self.key = dispatch_key(example)
+
+    def as_dict(self):
+        data = {"name": self.name, "type": self.transaction_type, "pattern": self.pattern, "example": self.example}
+        if self.party:
+            data["party"] = self.party
+        if self.account_type:
+            data["account_type"] = self.account_type
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["name"], data["type"], data["pattern"], data["example"], data.get("party"),
+                   data.get("account_type"))
+
+    def __repr__(self):
+        return f"Template({self.name!r}, {self.transaction_type!r}, key={self.key!r})"
+
+
+class TemplateRegistry:
+    """Templates compiled into a dispatch table keyed on their first words"""
+
+    def __init__(self, templates=()):
+        self.templates = []
+        self.dispatch = {}
+        for template in templates:
+            self.register(template)
+
+    def register(self, template):
+        self.templates.append(template)
+        self.dispatch.setdefault(template.key, []).append(template)
+
+    def match(self, message):
+        """Return (template, match) for the format of a confirmation, or (None, None)"""
+        body = _BODY_RE.match(message)
+        if body is None:
+            return None, None
+        start = body.end(1)
+        for template in self.dispatch.get(_key(body.group(2), body.group(3)), ()):
+            match = template.regex.match(message, start)
+            if match:
+                return template, match
+        return None, None
+
+    def load(self, path):
+        """Register the templates in a JSON file; returns how many were added"""
+        with open(path, encoding="utf-8") as f:
+            entries = json.load(f)
+        added = 0
+        for entry in entries:
+            try:
+                self.register(Template.from_dict(entry))
+                added += 1
+            except (KeyError, TypeError, ValueError) as e:
+                # One bad entry should not stop the others, or the built-in formats, from parsing
+                log.error("Skipping template %s from %s: %s", entry.get("name") if isinstance(entry, dict) else entry, path, e)
+        return added
+
+
+BUILTIN_TEMPLATES = [
+    # Pay Bill reads "sent to <business> for account <number>"
+    Template("send", "Send Money",
+             "Ksh{amount} sent to {party}[ for account {account}] on {date} at {time}",
+             "THK04TF1W4 Confirmed. Ksh250.00 sent to Antony Kiumbe on 20/8/25 at 10:15 AM. "
+             "New M-PESA balance is Ksh93.09. Transaction cost, Ksh7.00.",
+             account_type="Pay Bill/Buy Goods"),
+    Template("buy_goods", "Pay Bill/Buy Goods",
+             "Ksh{amount} paid to {party} on {date} at {time}",
+             "DEF456GHI8 Confirmed. Ksh100.00 paid to KPLC PREPAID on 21/8/25 at 3:45 PM. "
+             "New M-PESA balance is Ksh493.09. Transaction cost, Ksh0.00."),
+    Template("receive", "Receive Money",
+             "Ksh{amount} received from {party} on {date} at {time}",
+             "ABC123XYZ7 Confirmed. Ksh500.00 received from John Doe on 21/8/25 at 2:30 PM. "
+             "New M-PESA balance is Ksh593.09."),
+    Template("receive_app", "Receive Money",
+             "You have received Ksh{amount} from {party} on {date} at {time}",
+             "SIK2AB3CD4 Confirmed.You have received Ksh1,500.00 from JANE WANJIKU 0712345678 on 3/9/25 at 7:05 AM  "
+             "New M-PESA balance is Ksh4,005.09."),
+    Template("withdraw", "Withdraw",
+             "Ksh{amount} withdrawn from {party} on {date} at {time}",
+             "GHI789JKL9 Confirmed. Ksh200.00 withdrawn from Agent on 22/8/25 at 11:20 AM. "
+             "New M-PESA balance is Ksh293.09. Transaction cost, Ksh33.00."),
+    Template("withdraw_atm", "Withdraw",
+             "Ksh{amount} withdrawn on {date} at {time}",
+             "SJA1BC2DE3 Confirmed. Ksh2,000.00 withdrawn on 6/9/25 at 9:40 AM. "
+             "New M-PESA balance is Ksh1,421.09. Transaction cost, Ksh34.00.",
+             party="ATM/Agent"),
+    Template("withdraw_agent", "Withdraw",
+             "on {date} at {time}Withdraw Ksh{amount} from {party} New M-PESA balance is Ksh{balance}",
+             "SIN5DE6FG7 Confirmed.on 5/9/25 at 1:15 PMWithdraw Ksh1,000.00 from 012345 - MAMA MBOGA SHOP Thika "
+             "New M-PESA balance is Ksh1,455.09. Transaction cost, Ksh29.00."),
+    Template("deposit", "Deposit",
+             "On {date} at {time} Give Ksh{amount} cash to {party} New M-PESA balance is Ksh{balance}",
+             "SJB2CD3EF4 Confirmed. On 6/9/25 at 4:30 PM Give Ksh2,000.00 cash to 012345 - MAMA MBOGA SHOP Thika "
+             "New M-PESA balance is Ksh3,421.09. Amount you can transact within the day is 498,000.00."),
+    # Airtime for yourself names no number
+    Template("airtime", "Airtime",
+             "You bought Ksh{amount} of airtime[ for {party}] on {date} at {time}",
+             "SJC3DE4FG5 Confirmed.You bought Ksh50.00 of airtime for 254712345678 on 6/9/25 at 5:02 PM. "
+             "New M-PESA balance is Ksh3,371.09. Transaction cost, Ksh0.00.",
+             party="Safaricom"),
+    Template("fuliza", "Fuliza",
+             "Fuliza M-Pesa amount is Ksh{amount}. {skip} charged Ksh{cost}.",
+             "SJE5FG6HI7 Confirmed. Fuliza M-Pesa amount is Ksh 150.00. Access Fee charged Ksh 1.50. "
+             "Total Fuliza M-Pesa outstanding amount is Ksh 151.50 due on 6/10/25.",
+             party="Fuliza M-Pesa"),
+    Template("reversal", "Reversal",
+             "Reversal of transaction {ref} has been successfully reversed on {date} at {time} and Ksh{amount} "
+             "is credited to your M-PESA account. New M-PESA account balance is Ksh{balance}",
+             "SJF6GH7IJ8 Confirmed. Reversal of transaction SJA1BC2DE9 has been successfully reversed  on 6/9/25  "
+             "at 6:45 PM and Ksh250.00 is credited to your M-PESA account. New M-PESA account balance is Ksh3,521.09."),
+    Template("balance", "Balance Inquiry",
+             "Your account balance was: M-PESA Account : Ksh{balance}{skip} on {date} at {time}",
+             "SJG7HI8JK9 Confirmed. Your account balance was: M-PESA Account : Ksh3,521.09 "
+             "Business Account : Ksh0.00 on 6/9/25 at 7:00 PM. Transaction cost, Ksh0.00.",
+             party="M-PESA"),
+    Template("mshwari_deposit", "M-Shwari Deposit",
+             "Ksh{amount} transferred to M-Shwari account on {date} at {time}. M-PESA balance is Ksh{balance}",
+             "SJH8IJ9KL0 Confirmed. Ksh1,000.00 transferred to M-Shwari account on 6/9/25 at 8:15 PM. "
+             "M-PESA balance is Ksh2,521.09 .New M-Shwari saving account balance is Ksh11,000.00.",
+             party="M-Shwari"),
+    Template("mshwari_withdraw", "M-Shwari Withdraw",
+             "Ksh{amount} transferred from M-Shwari account on {date} at {time}. M-Shwari balance is Ksh{number} ."
+             "M-PESA balance is Ksh{balance}",
+             "SJI9JK0LM1 Confirmed. Ksh500.00 transferred from M-Shwari account on 7/9/25 at 8:05 AM. "
+             "M-Shwari balance is Ksh10,500.00 .M-PESA balance is Ksh3,021.09 .",
+             party="M-Shwari"),
+]
+
+
+def load_registry(path=None):
+    """The built-in templates plus those in path (defaults to $MPESA_TEMPLATES, if set)"""
+    registry = TemplateRegistry(BUILTIN_TEMPLATES)
+    path = path or os.environ.get(TEMPLATES_ENV)
+    if path:
+        try:
+            registry.load(path)
+        except (OSError, ValueError) as e:
+            log.error("Cannot read templates from %s: %s", path, e)
+    return registry
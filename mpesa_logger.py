@@ -1,286 +1,542 @@
-import re
-import pandas as pd
-from datetime import datetime
-import openpyxl
-from openpyxl import Workbook
 import os
 import time
-import json
+import logging
+from transaction_store import TransactionStore, FIELDS
+from code_index import TransactionCodeIndex
+from analytics import RollupEngine, current_periods
+from balance_reconciler import BalanceReconciler
+from batch_writer import BatchWriter
+from mpesa_parser import MPESATransaction, NOT_AVAILABLE, is_confirmation, parse_message
+from instrumentation import REGISTRY, add_logging_arguments, configure_logging, record_commit, stage, traced
+from output_sinks import SINK_TYPES, open_sinks, sink_for_path
+from message_journal import MessageJournal
+
+log = logging.getLogger(__name__)
 
 class MPESATransactionLogger:
-    def __init__(self, excel_file="mpesa_transactions.xlsx"):
+    def __init__(self, excel_file="mpesa_transactions.xlsx", db_file=None, sinks=None):
         self.excel_file = excel_file
-        self.setup_excel_file()
+        # Files mirroring the store: "xlsx,csv", a list of specs, or None for $MPESA_SINKS
+        self.sinks = open_sinks(sinks, excel_file)
+        # Sinks behind the store (xlsx, or one whose append failed), exported on close
+        self.stale_sinks = []
+        # The SQLite store is the system of record; the Excel file is an export
+        base_name = os.path.splitext(excel_file)[0]
+        self.db_file = db_file or base_name + ".db"
+        self.store = TransactionStore(self.db_file)
+        self.code_index = None
+        self.rollups = None
+        self.reconciler = None
+        self.setup_store()
+        # Loaded once so duplicate checks never touch the store or the workbook
+        self.code_index = TransactionCodeIndex(base_name + ".codes").load(self.store)
+        self.rollups = RollupEngine(base_name + ".rollups.json").load(self.store)
+        # Checks each new transaction's balance against the one before it
+        self.reconciler = BalanceReconciler(base_name + ".balance.json").load(self.store)
+        self.writer = None
+        self.journal = None
         
-    def setup_excel_file(self):
-        """Initialize the Excel file with headers if it doesn't exist"""
-        if not os.path.exists(self.excel_file):
-            # Create new workbook with headers
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "M-PESA Transactions"
-            
-            # Define headers
-            headers = [
-                "Transaction Code", "Amount (KSh)", "Transaction Type", 
-                "Recipient/Sender", "Date", "Time", "New Balance (KSh)",
-                "Transaction Cost (KSh)", "Daily Limit Remaining (KSh)",
-                "Raw Message", "Processed DateTime"
-            ]
-            
-            # Add headers to first row
-            for col, header in enumerate(headers, 1):
-                ws.cell(row=1, column=col, value=header)
-            
-            wb.save(self.excel_file)
-            print(f"Created new Excel file: {self.excel_file}")
-        else:
-            print(f"Using existing Excel file: {self.excel_file}")
+    def setup_store(self):
+        """Open the transaction store, migrating an existing Excel file on first use"""
+        if self.store.count() == 0 and os.path.exists(self.excel_file):
+            imported, duplicates = self.migrate_from_excel(self.excel_file)
+            print(f"📦 Migrated {imported} transactions from {self.excel_file} "
+                  f"({duplicates} duplicates skipped)")
+        log.info("Using transaction store: %s (%d transactions)", self.db_file, self.store.count())
     
-    def parse_mpesa_message(self, message):
-        """Parse M-PESA transaction message and extract key information"""
-        data = {}
+    def migrate_from_excel(self, excel_file, batch_size=1000):
+        """One-shot import of an existing Excel workbook into the transaction store"""
+        import openpyxl
         
-        # Extract transaction code (usually at the beginning)
-        code_match = re.search(r'^([A-Z0-9]{10})', message)
-        data['transaction_code'] = code_match.group(1) if code_match else "N/A"
+        wb = openpyxl.load_workbook(excel_file, read_only=True)
+        ws = wb.active
+        imported = 0
+        total = 0
+        batch = []
+        count_before = self.store.count()
+        first_id = self.store.max_id()
         
-        # Extract amount
-        amount_match = re.search(r'Ksh([\d,]+\.?\d*)', message)
-        data['amount'] = amount_match.group(1).replace(',', '') if amount_match else "0"
+        for row in ws.iter_rows(min_row=2, max_col=len(FIELDS), values_only=True):
+            if not row or row[0] is None:
+                continue
+            values = [None if value is None else str(value) for value in row]
+            batch.append(MPESATransaction.from_row(values))
+            if len(batch) >= batch_size:
+                imported += self.store.add_many(batch)
+                total += len(batch)
+                batch = []
         
-        # Determine transaction type and recipient/sender
-        if 'sent to' in message.lower():
-            data['transaction_type'] = 'Send Money'
-            recipient_match = re.search(r'sent to ([^on]+)', message, re.IGNORECASE)
-            data['recipient_sender'] = recipient_match.group(1).strip() if recipient_match else "N/A"
-        elif 'received from' in message.lower():
-            data['transaction_type'] = 'Receive Money'
-            sender_match = re.search(r'received from ([^on]+)', message, re.IGNORECASE)
-            data['recipient_sender'] = sender_match.group(1).strip() if sender_match else "N/A"
-        elif 'paid to' in message.lower():
-            data['transaction_type'] = 'Pay Bill/Buy Goods'
-            merchant_match = re.search(r'paid to ([^\.]+)', message, re.IGNORECASE)
-            data['recipient_sender'] = merchant_match.group(1).strip() if merchant_match else "N/A"
-        elif 'withdrawn' in message.lower():
-            data['transaction_type'] = 'Withdraw'
-            data['recipient_sender'] = 'ATM/Agent'
-        else:
-            data['transaction_type'] = 'Other'
-            data['recipient_sender'] = 'N/A'
+        if batch:
+            imported += self.store.add_many(batch)
+            total += len(batch)
         
-        # Extract date and time
-        date_time_match = re.search(r'on (\d{1,2}/\d{1,2}/\d{2,4}) at (\d{1,2}:\d{2} [AP]M)', message)
-        if date_time_match:
-            data['date'] = date_time_match.group(1)
-            data['time'] = date_time_match.group(2)
-        else:
-            data['date'] = "N/A"
-            data['time'] = "N/A"
+        wb.close()
         
-        # Extract new balance
-        balance_match = re.search(r'New M-PESA balance is Ksh([\d,]+\.?\d*)', message)
-        data['new_balance'] = balance_match.group(1).replace(',', '') if balance_match else "N/A"
+        if self.rollups is not None:
+            # The first-use migration runs before these are loaded; later ones update them here
+            self.code_index.add_many(self.store.iter_codes(offset=count_before))
+            self.rollups.catch_up(self.store, first_id)
+            self.reconciler.catch_up(self.store, first_id)
+        if imported:
+            self.mark_sinks_stale()
+        return imported, total - imported
+    
+    def export(self, target):
+        """Write every stored transaction to a file whose format follows its extension"""
+        self.flush()
+        count = sink_for_path(target).export(self.store, target)
+        print(f"📤 Exported {count} transactions to {target}")
+        return count
+    
+    def export_to_excel(self, excel_file=None):
+        """Write every stored transaction to an Excel file"""
+        return self.export(excel_file or self.excel_file)
+    
+    def export_sinks(self):
+        """Bring every configured sink up to date with the store"""
+        self.flush()
+        for sink in self.sinks:
+            # Monthly sinks only rewrite the months that changed
+            count = sink.export(self.store)
+            print(f"📤 Exported {count} transactions to {sink!r}")
+        self.stale_sinks = []
+    
+    def export_archive(self, archive_path=None):
+        """Write the store as a columnar archive for analysis (see transaction_archive)"""
+        # numpy is only needed for archives, so it is imported on first use
+        from transaction_archive import write_archive
         
-        # Extract transaction cost
-        cost_match = re.search(r'Transaction cost[,.]? Ksh([\d,]+\.?\d*)', message)
-        data['transaction_cost'] = cost_match.group(1).replace(',', '') if cost_match else "0"
+        archive_path = archive_path or os.path.splitext(self.excel_file)[0] + ".archive"
+        self.flush()
+        count = write_archive(self.store, archive_path)
+        print(f"🗃️ Archived {count} transactions to {archive_path}")
+        return count
+    
+    def export_report(self, target, subtotals=False, **filters):
+        """Stream a filtered report to an .xlsx or .csv file (see report_export)
         
-        # Extract daily limit remaining
-        limit_match = re.search(r'Amount you can transact within the day is ([\d,]+\.?\d*)', message)
-        data['daily_limit_remaining'] = limit_match.group(1).replace(',', '') if limit_match else "N/A"
+        Filters are those of report_export.Report: date_from, date_to,
+        transaction_type and counterparty.
+        """
+        # Only report runs need the report writer
+        from report_export import Report
         
-        # Store raw message and processing time
-        data['raw_message'] = message
-        data['processed_datetime'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.flush()
+        conn = self.store.open_reader()
+        try:
+            count = Report(conn, subtotals=subtotals, **filters).write(target)
+        finally:
+            conn.close()
+        print(f"📊 Wrote a report of {count} transactions to {target}")
+        return count
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+    
+    def write_sinks(self, transactions):
+        """Append committed transactions to every live sink, each with a single write
         
-        return data
+        Sinks that can only be rewritten whole (xlsx) are marked stale instead,
+        and exported once by refresh_sinks() when the logger closes.
+        """
+        for sink in self.sinks:
+            if not sink.live:
+                self._mark_stale(sink)
+                continue
+            try:
+                with stage("sink"):
+                    sink.append(transactions, self.store)
+            except Exception:
+                # The rows are safe in the store and the sink is re-exported on close, so the others still run
+                log.exception("Error writing %d transactions to %r", len(transactions), sink)
+                REGISTRY.inc("mpesa_errors_total", stage="sink")
+                self._mark_stale(sink)
+
+    def _mark_stale(self, sink):
+        if sink not in self.stale_sinks:
+            self.stale_sinks.append(sink)
+
+    def mark_sinks_stale(self):
+        """Have every sink exported on close, for rows committed without being appended to them"""
+        for sink in self.sinks:
+            self._mark_stale(sink)
+
+    def refresh_sinks(self):
+        """Export the sinks left behind the store"""
+        stale, self.stale_sinks = self.stale_sinks, []
+        for sink in stale:
+            try:
+                with stage("sink"):
+                    count = sink.export(self.store)
+                log.info("Exported %d transactions to %r", count, sink)
+            except Exception:
+                log.exception("Error exporting %r", sink)
+                REGISTRY.inc("mpesa_errors_total", stage="sink")
     
-    def add_transaction_to_excel(self, transaction_data):
-        """Add parsed transaction data to Excel file"""
+    def start_batching(self, max_rows=50, max_delay_ms=1000, mirror=True, journal=False):
+        """Route new transactions through a BatchWriter that group-commits them
+        
+        With mirror, each commit is appended to the sinks; without it they are
+        only exported on close.
+        
+        With journal, process_durably() records messages in a fsynced journal
+        before they are queued, and messages a crash left there are replayed now.
+        """
+        if journal:
+            self.journal = MessageJournal(os.path.splitext(self.db_file)[0] + ".journal")
+        self.writer = BatchWriter(self, max_rows=max_rows, max_delay_ms=max_delay_ms, mirror=mirror)
+        if journal:
+            self.replay_journal()
+        return self.writer
+    
+    def replay_journal(self):
+        """Process messages journaled by an earlier run that never reached the store"""
+        records, self.journal.recovered = self.journal.recovered, []
+        if not records:
+            return 0
+        log.warning("Replaying %d journaled messages left by an earlier run", len(records))
+        for record in records:
+            self.process_message(record["message"], arrived=record.get("arrived"))
+            self.journal.processed(record["seq"])
+        self.flush()
+        return len(records)
+    
+    def process_durably(self, entries):
+        """Journal (message, arrived, trace_id) entries with one fsync, then process each
+        
+        Once this returns the messages survive a crash even before their group
+        commit, so sources can acknowledge them (save their cursors) right away.
+        Returns the number processed without an error.
+        """
+        seqs = self.journal.append([(message, arrived) for message, arrived, _ in entries]) if self.journal else None
+        processed = 0
+        for i, (message, arrived, trace_id) in enumerate(entries):
+            try:
+                self.process_message(message, arrived=arrived, trace_id=trace_id)
+                processed += 1
+            except Exception:
+                # One bad message must not hold up the rest of the batch
+                with traced(trace_id):
+                    log.exception("Error processing message")
+                REGISTRY.inc("mpesa_errors_total", stage="process")
+            if seqs:
+                # A message that raised would raise again on replay, so it counts as handled
+                self.journal.processed(seqs[i])
+        return processed
+    
+    def flush(self):
+        """Write any transactions queued in the batch writer"""
+        if self.writer:
+            return self.writer.flush()
+        return 0
+    
+    def flush_soon(self):
+        """Start writing queued transactions in the background (for journaled messages, which are already safe)"""
+        if self.writer:
+            self.writer.flush_soon()
+    
+    def close(self):
+        """Flush queued transactions and release the store and index"""
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+        self.refresh_sinks()
+        self.rollups.save(self.store.max_id())
+        self.reconciler.save(self.store.max_id())
+        self.code_index.close()
+        for sink in self.sinks:
+            sink.close()
+        self.store.close()
+    
+    def record_inserted(self, transactions):
+        """Update the code index, rollups and balance chain for transactions just written to the store"""
+        self.code_index.add_many(t.transaction_code for t in transactions)
+        self.rollups.add_many(transactions)
+        self.reconciler.add_many(transactions)
+    
+    def search(self, text=None, before=None, limit=50, **filters):
+        """Query stored transactions newest first; returns (rows, next_cursor)
+        
+        Filters are those of TransactionStore.search: transaction_type,
+        date_from, date_to, min_amount, max_amount and code.
+        """
+        # Transactions still waiting for a group commit should show up too
+        self.flush()
+        return self.store.search(text, before=before, limit=limit, **filters)
+    
+    def is_duplicate(self, transaction_code):
+        """Check the code index and any queued batch for a transaction code"""
+        if transaction_code in self.code_index:
+            return True
+        return self.writer is not None and self.writer.is_pending(transaction_code)
+    
+    def add_transaction(self, transaction, arrived=None):
+        """Add a parsed transaction to the transaction store
+        
+        arrived is the Unix time the message reached us (or was sent, for
+        phone inbox rows); it is used to measure how far commits lag behind.
+        """
         try:
-            # Load existing workbook
-            wb = openpyxl.load_workbook(self.excel_file)
-            ws = wb.active
-
-            # Check for duplicate transaction code
-            for row in ws.iter_rows(min_row=2, max_col=1, values_only=True):
-                if row[0] == transaction_data['transaction_code']:
-                    print(f"⚠️ Duplicate transaction code {transaction_data['transaction_code']} found. Skipping entry.")
-                    return
+            code = transaction.transaction_code
+            with stage("dedup"):
+                duplicate = self.is_duplicate(code)
+            if duplicate:
+                log.warning("Duplicate transaction code %s found. Skipping entry.", code)
+                REGISTRY.inc("mpesa_messages_total", outcome="duplicate")
+                return False
             
-            # Find the next empty row
-            next_row = ws.max_row + 1
+            if self.writer:
+                # Stored on the next group commit
+                with stage("write"):
+                    self.writer.add(transaction, arrived=arrived)
+                # Counted as imported or duplicate when the batch is flushed
+                log.debug("Transaction %s queued for writing", code)
+                return True
             
-            # Data to write (in order matching headers)
-            row_data = [
-                transaction_data['transaction_code'],
-                transaction_data['amount'],
-                transaction_data['transaction_type'],
-                transaction_data['recipient_sender'],
-                transaction_data['date'],
-                transaction_data['time'],
-                transaction_data['new_balance'],
-                transaction_data['transaction_cost'],
-                transaction_data['daily_limit_remaining'],
-                transaction_data['raw_message'],
-                transaction_data['processed_datetime']
-            ]
+            with stage("write"):
+                added = self.store.add(transaction)
+            if not added:
+                log.warning("Duplicate transaction code %s found. Skipping entry.", code)
+                REGISTRY.inc("mpesa_messages_total", outcome="duplicate")
+                return False
             
-            # Write data to Excel
-            for col, value in enumerate(row_data, 1):
-                ws.cell(row=next_row, column=col, value=value)
+            self.record_inserted([transaction])
+            self.write_sinks([transaction])
+            record_commit([arrived])
+            REGISTRY.inc("mpesa_messages_total", outcome="imported")
+            REGISTRY.inc("mpesa_rows_written_total")
+            log.info("Transaction %s logged successfully", code)
+            return True
             
-            # Save the workbook
-            wb.save(self.excel_file)
-            print(f"✅ Transaction {transaction_data['transaction_code']} added to Excel successfully!")
-            
-        except Exception as e:
-            print(f"❌ Error adding transaction to Excel: {str(e)}")
+        except Exception:
+            log.exception("Error adding transaction to store")
+            REGISTRY.inc("mpesa_errors_total", stage="write")
+            return False
 
     def parse_mpesa_message(self, message):
         """Parse M-PESA transaction message and extract key information"""
-        data = {}
+        return parse_message(message)
+    
+    def process_message(self, message, arrived=None, trace_id=None):
+        """Main method to process a single M-PESA message
+        
+        Log records for the message carry trace_id (a new one by default), so
+        it can be followed from its source through to the commit.
+        """
+        with traced(trace_id):
+            log.debug("Processing message: %s...", message[:50])
+            
+            # Cheap duplicate check on the leading code before doing any parsing
+            with stage("dedup"):
+                duplicate = self.is_duplicate(message[:10])
+            if duplicate:
+                log.warning("Duplicate transaction code %s found. Skipping entry.", message[:10])
+                REGISTRY.inc("mpesa_messages_total", outcome="duplicate")
+                return None
+            
+            # Parse the message
+            with stage("parse"):
+                transaction = self.parse_mpesa_message(message)
+            if transaction.transaction_code == NOT_AVAILABLE:
+                # Stored under "N/A" it would make every later unparsed message a duplicate
+                log.warning("Could not parse a transaction code from: %s...", message[:50])
+                REGISTRY.inc("mpesa_messages_total", outcome="unparsed")
+                return None
+            
+            # Add to the transaction store
+            self.add_transaction(transaction, arrived=arrived)
+            
+            log.info("KSh %s %s on %s %s, code %s", transaction.amount, transaction.transaction_type,
+                     transaction.date, transaction.time, transaction.transaction_code)
+            return transaction
+
+    def process_messages(self, messages, batch_size=1000, workers=1):
+        """Bulk-process an iterable of messages with batched writes and no per-message output
         
-        # Extract transaction code (usually at the beginning)
-        code_match = re.search(r'^([A-Z0-9]{10})', message)
-        data['transaction_code'] = code_match.group(1) if code_match else "N/A"
+        Each committed batch is appended to the sinks; an xlsx sink is exported once on close.
+        """
+        # Queued live transactions go first so the store keeps arrival order
+        self.flush()
         
-        # Extract amount
-        amount_match = re.search(r'Ksh([\d,]+\.?\d*)', message)
-        data['amount'] = amount_match.group(1).replace(',', '') if amount_match else "0"
+        stats = {'messages': 0, 'imported': 0, 'duplicates': 0, 'unparsed': 0}
+        start = time.perf_counter()
+        first_id = self.store.max_id()
+        batch = []
         
-        # Determine transaction type and recipient/sender
-        if 'sent to' in message.lower():
-            data['transaction_type'] = 'Send Money'
-            recipient_match = re.search(r'sent to ([^on]+)', message, re.IGNORECASE)
-            data['recipient_sender'] = recipient_match.group(1).strip() if recipient_match else "N/A"
-        elif 'received from' in message.lower():
-            data['transaction_type'] = 'Receive Money'
-            sender_match = re.search(r'received from ([^on]+)', message, re.IGNORECASE)
-            data['recipient_sender'] = sender_match.group(1).strip() if sender_match else "N/A"
-        elif 'paid to' in message.lower():
-            data['transaction_type'] = 'Pay Bill/Buy Goods'
-            merchant_match = re.search(r'paid to ([^\.]+)', message, re.IGNORECASE)
-            data['recipient_sender'] = merchant_match.group(1).strip() if merchant_match else "N/A"
-        elif 'withdrawn' in message.lower():
-            data['transaction_type'] = 'Withdraw'
-            data['recipient_sender'] = 'ATM/Agent'
+        candidates = self._new_messages(messages, stats)
+        if workers > 1:
+            # multiprocessing is only imported when it is used
+            from parallel_parser import parse_messages_parallel
+            
+            # Results come back in input order, so dedup and ordering match a serial run
+            transactions = parse_messages_parallel(candidates, workers=workers)
         else:
-            data['transaction_type'] = 'Other'
-            data['recipient_sender'] = 'N/A'
+            transactions = map(self.parse_mpesa_message, candidates)
         
-        # Extract date and time
-        date_time_match = re.search(r'on (\d{1,2}/\d{1,2}/\d{2,4}) at (\d{1,2}:\d{2} [AP]M)', message)
-        if date_time_match:
-            data['date'] = date_time_match.group(1)
-            data['time'] = date_time_match.group(2)
-        else:
-            data['date'] = "N/A"
-            data['time'] = "N/A"
+        for transaction in transactions:
+            if transaction.transaction_code == NOT_AVAILABLE:
+                stats['unparsed'] += 1
+                continue
+            
+            batch.append(transaction)
+            if len(batch) >= batch_size:
+                self._write_import_batch(batch, stats)
+                batch = []
         
-        # Extract new balance
-        balance_match = re.search(r'New M-PESA balance is Ksh([\d,]+\.?\d*)', message)
-        data['new_balance'] = balance_match.group(1).replace(',', '') if balance_match else "N/A"
+        if batch:
+            self._write_import_batch(batch, stats)
         
-        # Extract transaction cost
-        cost_match = re.search(r'Transaction cost[,.]? Ksh([\d,]+\.?\d*)', message)
-        data['transaction_cost'] = cost_match.group(1).replace(',', '') if cost_match else "0"
+        # One vectorized pass over the imported rows instead of per-row rollup updates
+        self.rollups.catch_up(self.store, first_id)
+        self.reconciler.catch_up(self.store, first_id)
         
-        # Extract daily limit remaining
-        limit_match = re.search(r'Amount you can transact within the day is ([\d,]+\.?\d*)', message)
-        data['daily_limit_remaining'] = limit_match.group(1).replace(',', '') if limit_match else "N/A"
+        REGISTRY.inc("mpesa_messages_total", stats['imported'], outcome="imported")
+        REGISTRY.inc("mpesa_messages_total", stats['duplicates'], outcome="duplicate")
+        REGISTRY.inc("mpesa_messages_total", stats['unparsed'], outcome="unparsed")
+        REGISTRY.inc("mpesa_rows_written_total", stats['imported'])
+        stats['seconds'] = time.perf_counter() - start
+        stats['messages_per_second'] = stats['messages'] / stats['seconds'] if stats['seconds'] else 0.0
+        return stats
+    
+    def ingest_messages(self, messages, arrived=None, mirror=True):
+        """Parse and store messages with one commit
         
-        # Store raw message and processing time
-        data['raw_message'] = message
-        data['processed_datetime'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        Returns (results, inserted): results holds a (transaction, status) pair
+        per message in input order, status being "imported", "duplicate" or
+        "unparsed"; inserted lists the newly stored transactions. arrived is
+        the Unix time the messages were received, for the lag metric. With
+        mirror the new rows are appended to the sinks; without it the sinks
+        are exported on close.
+        """
+        # Queued live transactions go first so the store keeps arrival order
+        self.flush()
         
-        return data
-
-    def parse_mpesa_message(self, message):
-        """Parse M-PESA transaction message and extract key information"""
-        data = {}
-
-        # Extract transaction code (usually at the beginning)
-        code_match = re.search(r'^([A-Z0-9]{10})', message)
-        data['transaction_code'] = code_match.group(1) if code_match else "N/A"
-
-        # Extract amount
-        amount_match = re.search(r'Ksh([\d,]+\.?\d*)', message)
-        data['amount'] = amount_match.group(1).replace(',', '') if amount_match else "0"
-
-        # Determine transaction type and recipient/sender
-        lower_msg = message.lower()
-        if 'sent to' in lower_msg:
-            data['transaction_type'] = 'Send Money'
-            # Improved regex to capture recipient name until 'on' or end of sentence
-            recipient_match = re.search(r'sent to (.+?)(?: on |\.|$)', message, re.IGNORECASE)
-            data['recipient_sender'] = recipient_match.group(1).strip() if recipient_match else "N/A"
-        elif 'received from' in lower_msg:
-            data['transaction_type'] = 'Receive Money'
-            sender_match = re.search(r'received from (.+?)(?: on |\.|$)', message, re.IGNORECASE)
-            data['recipient_sender'] = sender_match.group(1).strip() if sender_match else "N/A"
-        elif 'paid to' in lower_msg:
-            data['transaction_type'] = 'Pay Bill/Buy Goods'
-            merchant_match = re.search(r'paid to (.+?)(?: on |\.|$)', message, re.IGNORECASE)
-            data['recipient_sender'] = merchant_match.group(1).strip() if merchant_match else "N/A"
-        elif 'withdrawn' in lower_msg:
-            data['transaction_type'] = 'Withdraw'
-            data['recipient_sender'] = 'ATM/Agent'
-        else:
-            data['transaction_type'] = 'Other'
-            data['recipient_sender'] = 'N/A'
+        results = []
+        batch = []
+        batch_codes = set()
+        for message in messages:
+            with stage("parse"):
+                transaction = self.parse_mpesa_message(message.strip())
+            code = transaction.transaction_code
+            if code == NOT_AVAILABLE:
+                results.append([transaction, 'unparsed'])
+            elif code in batch_codes or self.is_duplicate(code):
+                results.append([transaction, 'duplicate'])
+            else:
+                batch.append(transaction)
+                batch_codes.add(code)
+                results.append([transaction, None])
+        
+        inserted = []
+        if batch:
+            with stage("flush"):
+                inserted = self.store.add_batch(batch)
+            record_commit([arrived] * len(inserted))
+        self.record_inserted(inserted)
+        if inserted:
+            if mirror:
+                self.write_sinks(inserted)
+            else:
+                self.mark_sinks_stale()
+        inserted_codes = {t.transaction_code for t in inserted}
+        for result in results:
+            if result[1] is None:
+                result[1] = 'imported' if result[0].transaction_code in inserted_codes else 'duplicate'
+            REGISTRY.inc("mpesa_messages_total", outcome=result[1])
+        REGISTRY.inc("mpesa_rows_written_total", len(inserted))
+        return [tuple(result) for result in results], inserted
+    
+    def _new_messages(self, messages, stats):
+        """Yield stripped messages whose code has not been seen, counting the rest"""
+        for message in messages:
+            message = message.strip()
+            if not message:
+                continue
+            stats['messages'] += 1
+            
+            if self.is_duplicate(message[:10]):
+                stats['duplicates'] += 1
+                continue
+            
+            yield message
+    
+    def _write_import_batch(self, batch, stats):
+        inserted = self.store.add_batch(batch)
+        self.code_index.add_many(t.transaction_code for t in inserted)
+        if inserted:
+            self.write_sinks(inserted)
+        stats['imported'] += len(inserted)
+        stats['duplicates'] += len(batch) - len(inserted)
 
-        # Extract date and time
-        date_time_match = re.search(r'on (\d{1,2}/\d{1,2}/\d{2,4}) at (\d{1,2}:\d{2} [AP]M)', message)
-        if date_time_match:
-            data['date'] = date_time_match.group(1)
-            data['time'] = date_time_match.group(2)
-        else:
-            data['date'] = "N/A"
-            data['time'] = "N/A"
+def add_sink_argument(parser):
+    """Add --sink to an argparse parser"""
+    parser.add_argument("--sink", help=f"Comma-separated sinks to mirror the store to: {', '.join(SINK_TYPES)} "
+                                       "or none, each optionally kind:path, with kind@month for one file per month "
+                                       "(default: $MPESA_SINKS or xlsx)")
 
-        # Extract new balance
-        balance_match = re.search(r'New M-PESA balance is Ksh([\d,]+\.?\d*)', message)
-        data['new_balance'] = balance_match.group(1).replace(',', '') if balance_match else "N/A"
+def print_import_stats(stats):
+    """Print the summary returned by process_messages"""
+    print(f"📦 Processed {stats['messages']} messages in {stats['seconds']:.2f}s "
+          f"({stats['messages_per_second']:.0f} msg/s)")
+    print(f"   ✅ Imported: {stats['imported']}")
+    print(f"   ⚠️ Duplicates: {stats['duplicates']}")
+    print(f"   ❓ Unparsed: {stats['unparsed']}")
 
-        # Extract transaction cost
-        cost_match = re.search(r'Transaction cost[,.]? Ksh([\d,]+\.?\d*)', message)
-        data['transaction_cost'] = cost_match.group(1).replace(',', '') if cost_match else "0"
+def print_summary(rollups, period):
+    """Print totals by type and the top counterparties for a period"""
+    print(f"📊 Summary for {period}")
+    for transaction_type, cell in sorted(rollups.by_type(period).items()):
+        totals = cell.as_dict()
+        print(f"   {transaction_type:<20} {totals['count']:>6} × KSh {totals['total']:>14} (fees KSh {totals['fees']})")
+    print("   Top counterparties by spend:")
+    for party, cell in rollups.by_counterparty(period, limit=10):
+        print(f"   {party[:40]:<40} KSh {cell.as_dict()['total']:>14} ({cell.count})")
 
-        # Extract daily limit remaining
-        limit_match = re.search(r'Amount you can transact within the day is ([\d,]+\.?\d*)', message)
-        data['daily_limit_remaining'] = limit_match.group(1).replace(',', '') if limit_match else "N/A"
+def print_search_results(rows, next_cursor):
+    """Print one page of search results"""
+    for row in rows:
+        print(f"   {row['transaction_code']}  {row['date']:>8} {row['time']:>8}  {row['transaction_type']:<20} "
+              f"KSh {row['amount']:>12}  {row['recipient_sender'][:40]}")
+    if not rows:
+        print("   No matching transactions")
+    elif next_cursor:
+        print(f"   More results: add --before {next_cursor}")
 
-        # Store raw message and processing time
-        data['raw_message'] = message
-        data['processed_datetime'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+def print_gaps(gaps):
+    """Print the open breaks in the balance chain"""
+    for gap in gaps:
+        info = gap.as_dict()
+        print(f"   {info['after']} → {info['before']}  {info['start']} to {info['end']}  "
+              f"KSh {info['missing']:>12} unaccounted for ({info['attempts']} fetches)")
+    if not gaps:
+        print("   ✅ Every balance follows from the one before it")
 
-        return data
+def recover_gaps(logger, serial=None):
+    """Fetch every open gap's time window from the phone and store what was missing"""
+    # adb is only needed when recovering
+    from adb_inbox import AdbInboxReader, sender_allowlist
     
-    def process_message(self, message):
-        """Main method to process a single M-PESA message"""
-        print(f"\n📱 Processing message: {message[:50]}...")
-        
-        # Parse the message
-        transaction_data = self.parse_mpesa_message(message)
-        
-        # Add to Excel
-        self.add_transaction_to_excel(transaction_data)
-        
-        # Print summary
-        print(f"💰 Amount: KSh {transaction_data['amount']}")
-        print(f"📅 Date/Time: {transaction_data['date']} {transaction_data['time']}")
-        print(f"👤 Type: {transaction_data['transaction_type']}")
-        print(f"🆔 Code: {transaction_data['transaction_code']}")
-        
-        return transaction_data
+    reader = AdbInboxReader(None, serial=serial, senders=sender_allowlist())
+    try:
+        utc_offset = reader.utc_offset()
+        for gap in logger.reconciler.due(limit=None, force=True):
+            # Recovered transactions narrow the gap in place
+            after, before = gap.after, gap.before
+            rows = reader.fetch_range(*gap.window(utc_offset=utc_offset))
+            _, inserted = logger.ingest_messages(row["body"] for row in rows if is_confirmation(row["body"]))
+            print(f"   📥 {after} → {before}: {len(rows)} inbox rows, {len(inserted)} recovered")
+    finally:
+        reader.close()
 
-# Example usage and testing
-if __name__ == "__main__":
-    # Initialize the logger
-    logger = MPESATransactionLogger("mpesa_transactions.xlsx")
-    
+def run_demo(logger):
+    """Process the sample messages and export the configured sinks"""
     # Test message (your example)
     test_message = "THK04TF1W4 Confirmed. Ksh250.00 sent to Antony Kiumbe on 20/8/25 at 10:15 AM. New M-PESA balance is Ksh93.09. Transaction cost, Ksh7.00. Amount you can transact within the day is 499,700.00. Sign up for Lipa Na M-PESA Till online https://m-pesaforbusiness.co.ke"
     
@@ -289,7 +545,7 @@ if __name__ == "__main__":
     
     print("\n" + "="*60)
     print("🚀 M-PESA Transaction Logger is ready!")
-    print("📁 Excel file location:", os.path.abspath(logger.excel_file))
+    print("🗄️ Transaction store location:", os.path.abspath(logger.db_file))
     print("="*60)
     
     # For real-time processing, you would integrate this with:
@@ -305,6 +561,133 @@ if __name__ == "__main__":
     ]
     
     print("\n📊 Processing sample messages...")
-    for msg in sample_messages:
-        logger.process_message(msg)
-        time.sleep(1)  # Small delay for demonstration
\ No newline at end of file
+    print_import_stats(logger.process_messages(sample_messages))
+    
+    logger.export_sinks()
+
+# Example usage and testing
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="M-PESA Transaction Logger")
+    parser.add_argument("--excel", default="mpesa_transactions.xlsx", help="Excel export file")
+    parser.add_argument("--db", default=None, help="Transaction store (defaults to the Excel name with .db)")
+    parser.add_argument("--account", help="Use this account's files, e.g. mpesa_transactions.agent.db (see account_shards)")
+    parser.add_argument("--accounts", help="JSON file of accounts (default: $MPESA_ACCOUNTS)")
+    add_sink_argument(parser)
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("demo", help="Process sample messages (default)")
+    migrate_parser = subparsers.add_parser("migrate", help="Import an existing Excel file into the store")
+    migrate_parser.add_argument("source", nargs="?", help="Excel file to import (defaults to --excel)")
+    import_parser = subparsers.add_parser("import", help="Bulk import an SMS backup (XML, CSV or text)")
+    import_parser.add_argument("source", help="SMS Backup & Restore XML, CSV or one-message-per-line text file")
+    import_parser.add_argument("--format", choices=["xml", "csv", "text"], help="Input format (detected from the extension by default)")
+    import_parser.add_argument("--batch-size", type=int, default=1000, help="Transactions per commit")
+    import_parser.add_argument("--workers", type=int, default=1, help="Parser processes (1 parses inline)")
+    summary_parser = subparsers.add_parser("summary", help="Spending by type and counterparty for a period")
+    summary_parser.add_argument("period", nargs="?", help="YYYY-MM-DD, YYYY-MM or all (defaults to this month)")
+    summary_parser.add_argument("--rebuild", action="store_true", help="Recompute the rollups from the store first")
+    search_parser = subparsers.add_parser("search", help="Search stored transactions, newest first")
+    search_parser.add_argument("text", nargs="?", help="Words to find in the counterparty or message")
+    search_parser.add_argument("--type", dest="transaction_type", help="Transaction type, e.g. 'Send Money'")
+    search_parser.add_argument("--from", dest="date_from", help="First day, YYYY-MM-DD")
+    search_parser.add_argument("--to", dest="date_to", help="Last day, YYYY-MM-DD")
+    search_parser.add_argument("--min", dest="min_amount", help="Smallest amount in KSh")
+    search_parser.add_argument("--max", dest="max_amount", help="Largest amount in KSh")
+    search_parser.add_argument("--code", help="Transaction code")
+    search_parser.add_argument("--before", type=int, help="Cursor printed at the end of the previous page")
+    search_parser.add_argument("--limit", type=int, default=20)
+    export_parser = subparsers.add_parser("export", help="Export the store to an Excel, CSV, JSONL or SQLite file")
+    export_parser.add_argument("target", nargs="?", help="File to write, format from its extension (defaults to --excel)")
+    report_parser = subparsers.add_parser("report", help="Stream a filtered report to an Excel or CSV file")
+    report_parser.add_argument("target", help="File to write, .xlsx or .csv")
+    report_parser.add_argument("--from", dest="date_from", help="First day, YYYY-MM-DD")
+    report_parser.add_argument("--to", dest="date_to", help="Last day, YYYY-MM-DD")
+    report_parser.add_argument("--type", dest="transaction_type", help="Transaction type, e.g. 'Send Money'")
+    report_parser.add_argument("--party", dest="counterparty", help="Part of the recipient or sender name")
+    report_parser.add_argument("--subtotals", action="store_true", help="Add a total row after each day and at the end")
+    report_parser.add_argument("--all-accounts", action="store_true",
+                               help="Merge every account into one report, with an Account column")
+    archive_parser = subparsers.add_parser("archive", help="Write the store as a memory-mapped columnar archive")
+    archive_parser.add_argument("target", nargs="?", help="Archive directory (defaults to the Excel name with .archive)")
+    reconcile_parser = subparsers.add_parser("reconcile", help="List breaks in the balance chain and optionally recover them")
+    reconcile_parser.add_argument("--rebuild", action="store_true", help="Recheck the whole store first")
+    reconcile_parser.add_argument("--fetch", action="store_true", help="Query the phone over ADB for each gap's time window")
+    reconcile_parser.add_argument("--serial", help="Device to query (defaults to the only one attached)")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_logging(args.log_level, json_format=args.log_format == "json")
+    
+    all_accounts = getattr(args, "all_accounts", False)
+    if args.account or all_accounts:
+        # Accounts are only looked up when one is asked for
+        from account_shards import ShardedLogger, load_accounts, shard_file, shard_sinks
+        
+        try:
+            accounts = load_accounts(args.accounts)
+            if args.account and args.account not in accounts.names():
+                raise ValueError(f"unknown account {args.account!r}; choose from {', '.join(accounts.names())}")
+        except ValueError as e:
+            parser.error(str(e))
+        if args.account and all_accounts:
+            parser.error("--account and --all-accounts cannot be combined")
+    
+    # Initialize the logger
+    if all_accounts:
+        logger = ShardedLogger(args.excel, accounts, sinks=args.sink)
+    elif args.account:
+        logger = MPESATransactionLogger(shard_file(args.excel, args.account), db_file=args.db,
+                                        sinks=shard_sinks(args.sink, args.account))
+    else:
+        logger = MPESATransactionLogger(args.excel, db_file=args.db, sinks=args.sink)
+    
+    try:
+        if args.command == "migrate":
+            imported, duplicates = logger.migrate_from_excel(args.source or args.excel)
+            print(f"📦 Imported {imported} transactions ({duplicates} duplicates skipped)")
+        elif args.command == "import":
+            from sms_backup_reader import read_messages
+            
+            stats = logger.process_messages(read_messages(args.source, args.format),
+                                            batch_size=args.batch_size, workers=args.workers)
+            print_import_stats(stats)
+        elif args.command == "summary":
+            if args.rebuild:
+                logger.rollups.rebuild(logger.store)
+            print_summary(logger.rollups, args.period or current_periods()[1])
+        elif args.command == "search":
+            print_search_results(*logger.search(
+                args.text, before=args.before, limit=args.limit, transaction_type=args.transaction_type,
+                date_from=args.date_from, date_to=args.date_to, min_amount=args.min_amount,
+                max_amount=args.max_amount, code=args.code))
+        elif args.command == "reconcile":
+            if args.rebuild:
+                logger.reconciler.rebuild(logger.store)
+            if args.fetch:
+                try:
+                    recover_gaps(logger, args.serial)
+                except FileNotFoundError:
+                    print("❌ ADB not found. Please install Android SDK platform-tools")
+                except (ConnectionError, RuntimeError) as e:
+                    print(f"❌ ADB query failed: {e}")
+            print(f"🔗 Balance chain gaps: {len(logger.reconciler.open_gaps())}")
+            print_gaps(logger.reconciler.open_gaps())
+        elif args.command == "report":
+            try:
+                logger.export_report(args.target, subtotals=args.subtotals, date_from=args.date_from,
+                                     date_to=args.date_to, transaction_type=args.transaction_type,
+                                     counterparty=args.counterparty)
+            except ValueError as e:
+                parser.error(str(e))
+        elif args.command == "archive":
+            logger.export_archive(args.target)
+        elif args.command == "export":
+            try:
+                logger.export(args.target or args.excel)
+            except ValueError as e:
+                parser.error(str(e))
+        else:
+            run_demo(logger)
+    finally:
+        # Persists the rollup snapshot so the next start does not re-aggregate
+        logger.close()
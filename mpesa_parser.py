@@ -0,0 +1,348 @@
+import re
+import time
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from message_templates import body_start, load_registry
+from transaction_store import FIELDS
+
+NOT_AVAILABLE = "N/A"
+
+# Known formats are parsed by their template (see message_templates): one keyed
+# lookup on the words after "Confirmed." and one match for the head of the message.
+_TEMPLATES = load_registry()
+
+# Messages no template matches (cut short, or a format nobody has described yet)
+# fall back to the anchor pass below. Every field sits behind a fixed literal ("Ksh", "New M-PESA balance is Ksh", ...),
+# so the parser jumps between anchors with str.find and runs short precompiled
+# matches at each one, moving left to right through the message.
+_NUMBER = r'\d[\d,]*(?:\.\d+)?'
+_NUMBER_RE = re.compile(rf'\s?({_NUMBER})')
+_COST_RE = re.compile(rf'[,.]?\s?Ksh\s?({_NUMBER})')
+_DATE_RE = re.compile(r'(\d{1,2})/(\d{1,2})/(\d{2,4})\s+at\s+(\d{1,2}):(\d{2})\s?([AP])M')
+_CODE_RE = re.compile(r'[A-Z0-9]{10}')
+
+_AMOUNT_ANCHOR = 'Ksh'
+_BALANCE_ANCHOR = 'New M-PESA balance is Ksh'
+_COST_ANCHOR = 'Transaction cost'
+_LIMIT_ANCHOR = 'Amount you can transact within the day is'
+
+# The transaction keyword sits right next to the amount, so it is matched in place
+# rather than searched for: "Ksh250.00 sent to ...", "You have received Ksh500.00 from ..."
+_KEYWORD_AFTER_RE = re.compile(r'\s*(sent to|paid to|received from|withdrawn from|withdrawn)\b')
+_KEYWORD_BEFORE = ('You have received', 'Withdraw')
+
+# The counterparty runs from the keyword up to the first of these that follows it
+_PARTY_STOPS = (' for account ', ' on ', 'New M-PESA', '. ')
+# "You have received Ksh500.00 from X" and "Withdraw Ksh500.00 from X" put the amount first
+_AMOUNT_FROM_RE = re.compile(rf'Ksh\s?{_NUMBER}\s+from\s')
+_ACCOUNT_RE = re.compile(r'\s+for account\s+([^\s.]+)')
+
+# Keyword -> (transaction type, prefix to skip before the counterparty starts)
+_DISPATCH = {
+    'sent to': ('Send Money', None),
+    'paid to': ('Pay Bill/Buy Goods', None),
+    'received from': ('Receive Money', None),
+    'You have received': ('Receive Money', _AMOUNT_FROM_RE),
+    'withdrawn from': ('Withdraw', None),
+    'withdrawn': ('Withdraw', None),
+    'Withdraw': ('Withdraw', _AMOUNT_FROM_RE),
+}
+
+
+def is_confirmation(message):
+    """Check that a message has the shape of an M-PESA confirmation: a code, then 'Confirmed'"""
+    return body_start(message) is not None
+
+
+def parse_decimal(text):
+    """Convert an M-PESA number such as '2,505.09' to a Decimal, or None"""
+    if text is None:
+        return None
+    try:
+        return Decimal(text.replace(',', ''))
+    except InvalidOperation:
+        return None
+
+
+def parse_datetime(date_text, time_text):
+    """Convert '20/8/25' and '10:15 AM' to a datetime, or None if invalid"""
+    try:
+        day, month, year = (int(part) for part in date_text.split('/'))
+        clock, meridiem = time_text[:-2].strip(), time_text[-2:].upper()
+        hour, minute = (int(part) for part in clock.split(':'))
+        if year < 100:
+            year += 2000
+        hour = hour % 12 + (12 if meridiem == 'PM' else 0)
+        return datetime(year, month, day, hour, minute)
+    except (AttributeError, ValueError):
+        return None
+
+
+_clock_cache = [None, None]
+
+
+def _now():
+    """Current time truncated to seconds, cached so bulk parsing avoids a datetime per message"""
+    second = int(time.time())
+    if _clock_cache[0] != second:
+        _clock_cache[0] = second
+        _clock_cache[1] = datetime.fromtimestamp(second)
+    return _clock_cache[1]
+
+
+def _decimal_or_zero(text):
+    value = parse_decimal(text)
+    return Decimal(0) if value is None else value
+
+
+def _format_decimal(value, default=NOT_AVAILABLE):
+    return default if value is None else str(value)
+
+
+class MPESATransaction:
+    """A parsed M-PESA transaction with typed fields"""
+
+    __slots__ = (
+        'transaction_code', 'amount', 'transaction_type', 'recipient_sender',
+        'transaction_datetime', 'new_balance', 'transaction_cost',
+        'daily_limit_remaining', 'raw_message', 'processed_datetime',
+    )
+
+    def __init__(self, transaction_code, amount, transaction_type, recipient_sender,
+                 transaction_datetime, new_balance, transaction_cost,
+                 daily_limit_remaining, raw_message, processed_datetime=None):
+        self.transaction_code = transaction_code
+        self.amount = amount
+        self.transaction_type = transaction_type
+        self.recipient_sender = recipient_sender
+        self.transaction_datetime = transaction_datetime
+        self.new_balance = new_balance
+        self.transaction_cost = transaction_cost
+        self.daily_limit_remaining = daily_limit_remaining
+        self.raw_message = raw_message
+        self.processed_datetime = processed_datetime or _now()
+
+    @property
+    def date(self):
+        """Transaction date in M-PESA format, e.g. '20/8/25'"""
+        dt = self.transaction_datetime
+        if dt is None:
+            return NOT_AVAILABLE
+        return f"{dt.day}/{dt.month}/{dt.year % 100:02d}"
+
+    @property
+    def time(self):
+        """Transaction time in M-PESA format, e.g. '10:15 AM'"""
+        dt = self.transaction_datetime
+        if dt is None:
+            return NOT_AVAILABLE
+        return f"{dt.hour % 12 or 12}:{dt.minute:02d} {'PM' if dt.hour >= 12 else 'AM'}"
+
+    def as_row(self):
+        """Return the transaction as strings in FIELDS (Excel column) order"""
+        return [
+            self.transaction_code,
+            _format_decimal(self.amount, "0"),
+            self.transaction_type,
+            self.recipient_sender,
+            self.date,
+            self.time,
+            _format_decimal(self.new_balance),
+            _format_decimal(self.transaction_cost, "0"),
+            _format_decimal(self.daily_limit_remaining),
+            self.raw_message,
+            self.processed_datetime.isoformat(sep=" ", timespec="seconds"),
+        ]
+
+    def as_dict(self):
+        """Return the transaction as a dict of strings keyed by FIELDS"""
+        return dict(zip(FIELDS, self.as_row()))
+
+    @classmethod
+    def from_row(cls, row):
+        """Rebuild a transaction from a row of strings in FIELDS order"""
+        values = dict(zip(FIELDS, row))
+        processed = values.get('processed_datetime')
+        try:
+            processed = datetime.strptime(processed, "%Y-%m-%d %H:%M:%S") if processed else None
+        except ValueError:
+            processed = None
+        return cls(
+            transaction_code=values.get('transaction_code') or NOT_AVAILABLE,
+            amount=_decimal_or_zero(values.get('amount')),
+            transaction_type=values.get('transaction_type') or 'Other',
+            recipient_sender=values.get('recipient_sender') or NOT_AVAILABLE,
+            transaction_datetime=parse_datetime(values.get('date'), values.get('time')),
+            new_balance=parse_decimal(values.get('new_balance')),
+            transaction_cost=_decimal_or_zero(values.get('transaction_cost')),
+            daily_limit_remaining=parse_decimal(values.get('daily_limit_remaining')),
+            raw_message=values.get('raw_message') or "",
+            processed_datetime=processed,
+        )
+
+    def __repr__(self):
+        return (f"MPESATransaction({self.transaction_code!r}, {self.transaction_type!r}, "
+                f"amount={self.amount}, party={self.recipient_sender!r})")
+
+
+def _number_after(message, anchor, start, pattern=_NUMBER_RE):
+    """Return the number following the next occurrence of anchor, or None"""
+    position = message.find(anchor, start)
+    if position < 0:
+        return None
+    match = pattern.match(message, position + len(anchor))
+    return match.group(1) if match else None
+
+
+def _find_datetime(message, start, end=None):
+    """Search for the transaction date, jumping between '/' characters"""
+    end = len(message) if end is None else end
+    slash = message.find('/', start, end)
+    while slash >= 0:
+        match = _DATE_RE.search(message, max(slash - 2, start), min(slash + 30, len(message)))
+        if match:
+            return match
+        slash = message.find('/', slash + 1, end)
+    return None
+
+
+def _match_datetime(match):
+    """Build a datetime from a _DATE_RE match, or None if the date is invalid"""
+    day, month, year, hour, minute, meridiem = match.groups()
+    year = int(year)
+    if year < 100:
+        year += 2000
+    hour = int(hour) % 12 + (12 if meridiem == 'P' else 0)
+    try:
+        return datetime(year, int(month), int(day), hour, int(minute))
+    except ValueError:
+        return None
+
+
+def _find_keyword(message, anchor, amount):
+    """Return (keyword, position where the text after it starts), or (None, None)"""
+    match = _KEYWORD_AFTER_RE.match(message, amount.end())
+    if match:
+        return match.group(1), match.end()
+    before = message[:anchor].rstrip()
+    for keyword in _KEYWORD_BEFORE:
+        if before.endswith(keyword):
+            return keyword, anchor
+    return None, None
+
+
+def _party_end(message, start):
+    """Return the position where the counterparty name ends"""
+    end = len(message)
+    for stop in _PARTY_STOPS:
+        position = message.find(stop, start, end)
+        # " on " only ends the name when a date follows ("Mama Mboga on 5/9/25")
+        while stop == ' on ' and position >= 0 and not message[position + 4:position + 5].isdigit():
+            position = message.find(stop, position + 1, end)
+        if position >= 0:
+            end = position
+    return end
+
+
+def _counterparty(message, keyword, start):
+    """Return (transaction type, counterparty) for a keyword whose tail begins at start"""
+    transaction_type, prefix_re = _DISPATCH[keyword]
+    if prefix_re is not None:
+        prefix = prefix_re.match(message, start)
+        if prefix is None:
+            return transaction_type, NOT_AVAILABLE
+        start = prefix.end()
+    elif keyword == 'withdrawn':
+        return transaction_type, 'ATM/Agent'
+
+    end = _party_end(message, start)
+    party = message[start:end].strip().rstrip('.')
+    if not party:
+        return transaction_type, NOT_AVAILABLE
+
+    account = _ACCOUNT_RE.match(message, end)
+    if account:
+        # Pay Bill messages read "sent to <business> for account <number>"
+        return 'Pay Bill/Buy Goods', f"{party} ({account.group(1)})"
+    return transaction_type, party
+
+
+def _fields_datetime(fields):
+    """Build a datetime from a template match's date and time fields, or None"""
+    day, hour = fields.get('day'), fields.get('hour')
+    if day is None or hour is None:
+        # A date on its own is not when the transaction happened (Fuliza's "due on")
+        return None
+    year = int(fields['year'])
+    if year < 100:
+        year += 2000
+    hour = int(hour) % 12 + (12 if fields['meridiem'] == 'P' else 0)
+    try:
+        return datetime(year, int(fields['month']), int(day), hour, int(fields['minute']))
+    except ValueError:
+        return None
+
+
+def _from_template(message, code, template, match):
+    """Build the transaction for a message its format's template matched"""
+    fields = match.groupdict()
+    end = match.end()
+    party = (fields.get('party') or '').strip().rstrip('.')
+    if not party:
+        party = fields.get('ref') or template.party or NOT_AVAILABLE
+    transaction_type = template.transaction_type
+    account = fields.get('account')
+    if account:
+        party = f"{party} ({account})"
+        transaction_type = template.account_type or transaction_type
+    return MPESATransaction(
+        code,
+        _decimal_or_zero(fields.get('amount')),
+        transaction_type,
+        party,
+        _fields_datetime(fields),
+        parse_decimal(fields.get('balance') or _number_after(message, _BALANCE_ANCHOR, end)),
+        _decimal_or_zero(fields.get('cost') or _number_after(message, _COST_ANCHOR, end, _COST_RE)),
+        parse_decimal(fields.get('limit') or _number_after(message, _LIMIT_ANCHOR, end)),
+        message,
+    )
+
+
+def parse_message(message):
+    """Parse an M-PESA SMS into an MPESATransaction, by template or else in one left-to-right pass"""
+    code = message[:10] if _CODE_RE.match(message) else NOT_AVAILABLE
+    template, match = _TEMPLATES.match(message)
+    if match:
+        return _from_template(message, code, template, match)
+
+    # The transaction amount is the first Ksh figure; every other field follows it,
+    # except the date, which the agent withdrawal format puts first
+    amount = None
+    position = message.find(_AMOUNT_ANCHOR)
+    if position >= 0:
+        amount = _NUMBER_RE.match(message, position + len(_AMOUNT_ANCHOR))
+
+    transaction_type, party = 'Other', NOT_AVAILABLE
+    start = 0
+    if amount:
+        keyword, tail = _find_keyword(message, position, amount)
+        if keyword:
+            transaction_type, party = _counterparty(message, keyword, tail)
+        start = amount.end()
+
+    when = _find_datetime(message, start)
+    if when is None and start:
+        when = _find_datetime(message, 0, start)
+
+    return MPESATransaction(
+        code,
+        _decimal_or_zero(amount.group(1) if amount else None),
+        transaction_type,
+        party,
+        _match_datetime(when) if when else None,
+        parse_decimal(_number_after(message, _BALANCE_ANCHOR, start)),
+        _decimal_or_zero(_number_after(message, _COST_ANCHOR, start, _COST_RE)),
+        parse_decimal(_number_after(message, _LIMIT_ANCHOR, start)),
+        message,
+    )
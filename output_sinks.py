@@ -0,0 +1,367 @@
+"""
+Output sinks: files that mirror the transaction store.
+
+The SQLite store is the system of record; a sink is a copy of it in another
+format, kept up to date by appending each committed batch. Available kinds:
+
+    xlsx     Excel workbook (the logger's --excel file by default), export only
+    csv      CSV with the Excel headers
+    jsonl    one JSON object per transaction, keyed by FIELDS
+    sqlite   a separate SQLite database, e.g. one shared with another tool
+
+Sinks are chosen with a comma-separated spec such as "xlsx,csv" or
+"jsonl:out/feed.jsonl,sqlite:/srv/mpesa.db" (kind, then an optional path), from
+--sink on the command line or the MPESA_SINKS environment variable; "none"
+keeps the store only. Each backend imports its library on first use, so a
+process that never writes a workbook never loads openpyxl.
+
+A workbook cannot be appended to without loading and saving the whole file,
+so xlsx is not "live": commits only mark it stale, and the logger exports it
+once, when it closes or export_sinks() runs, instead of on every batch.
+
+A file kind followed by "@month" ("xlsx@month", "csv@month:out/feed.csv")
+writes one file per month of transaction date instead of one ever-growing
+file, with a manifest mapping months to files (see MonthlySink).
+
+Usage: MPESA_SINKS=csv,jsonl python android_sms_monitor.py
+"""
+
+import csv
+import json
+import logging
+import os
+import stat
+
+from transaction_store import FIELDS
+
+log = logging.getLogger(__name__)
+
+HEADERS = [
+    "Transaction Code", "Amount (KSh)", "Transaction Type",
+    "Recipient/Sender", "Date", "Time", "New Balance (KSh)",
+    "Transaction Cost (KSh)", "Daily Limit Remaining (KSh)",
+    "Raw Message", "Processed DateTime"
+]
+DEFAULT_SINKS = "xlsx"
+SINKS_ENV = "MPESA_SINKS"
+
+
+def _trim_partial_line(path, terminator, window=1 << 16):
+    """Cut off a last line that a crash left half-written, so appends start on a fresh line"""
+    with open(path, "r+b") as f:
+        end = f.seek(0, os.SEEK_END)
+        start = max(0, end - window)
+        f.seek(start)
+        tail = f.read()
+        if not tail or tail.endswith(terminator):
+            return
+        cut = tail.rfind(terminator)
+        if cut < 0 and start > 0:
+            # No line break in the window: leave the file alone rather than guess
+            return
+        log.warning("Removing a partly written last line from %s", path)
+        f.truncate(start + cut + len(terminator) if cut >= 0 else 0)
+
+
+class Sink:
+    """A file mirroring the store; subclasses write rows as tuples in FIELDS order"""
+
+    kind = None
+    extension = None
+    # False for formats that can only be rewritten whole: they are exported instead of appended to
+    live = True
+
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, transactions, store):
+        """Add newly committed transactions, exporting the whole store if the file is missing"""
+        if not os.path.exists(self.path):
+            # The store already holds these rows, so a full export covers them
+            return self.export(store)
+        self.write_rows([t.as_row() for t in transactions], append=True)
+        return len(transactions)
+
+    def export(self, store, path=None):
+        """Rewrite the file from every stored transaction; returns the row count"""
+        return self.write_file(store.iter_rows(), path or self.path)
+
+    def write_file(self, rows, target):
+        """Write rows to a new file at target through a temp file; returns the row count"""
+        temp_file = target + ".tmp"
+        count = type(self)(temp_file).write_rows(rows, append=False)
+        os.replace(temp_file, target)
+        return count
+
+    def write_rows(self, rows, append):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return f"{self.kind}:{self.path}"
+
+
+class ExcelSink(Sink):
+    kind = "xlsx"
+    extension = ".xlsx"
+    live = False
+
+    def write_rows(self, rows, append):
+        # openpyxl costs a few hundred milliseconds to import, so only writers pay it
+        import openpyxl
+
+        if append:
+            wb = openpyxl.load_workbook(self.path)
+            ws = wb.active
+            target = self.path + ".tmp"
+        else:
+            # Write-only mode streams rows to disk instead of building the sheet in memory
+            wb = openpyxl.Workbook(write_only=True)
+            ws = wb.create_sheet("M-PESA Transactions")
+            ws.append(HEADERS)
+            target = self.path
+        count = 0
+        for row in rows:
+            ws.append(list(row))
+            count += 1
+        wb.save(target)
+        if target != self.path:
+            # Saved beside the workbook and renamed over it, so a crash mid-save leaves the old one intact
+            os.replace(target, self.path)
+        return count
+
+
+class CsvSink(Sink):
+    kind = "csv"
+    extension = ".csv"
+
+    def write_rows(self, rows, append):
+        if append:
+            _trim_partial_line(self.path, b"\r\n")
+        count = 0
+        with open(self.path, "a" if append else "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            if not append:
+                writer.writerow(HEADERS)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        return count
+
+
+class JsonlSink(Sink):
+    kind = "jsonl"
+    extension = ".jsonl"
+
+    def write_rows(self, rows, append):
+        if append:
+            _trim_partial_line(self.path, b"\n")
+        count = 0
+        with open(self.path, "a" if append else "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False) + "\n")
+                count += 1
+        return count
+
+
+class SqliteSink(Sink):
+    kind = "sqlite"
+    extension = ".mirror.db"
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.store = None
+
+    def _open(self):
+        if self.store is None:
+            from transaction_store import TransactionStore
+
+            self.store = TransactionStore(self.path)
+        return self.store
+
+    def append(self, transactions, store):
+        # Inserts skip codes the mirror already has, so a new mirror can simply copy everything
+        mirror = self._open()
+        if mirror.count() == 0:
+            return self.export(store)
+        return len(mirror.add_batch(transactions))
+
+    def export(self, store, path=None):
+        if path and path != self.path:
+            sink = SqliteSink(path)
+            try:
+                return sink.export(store)
+            finally:
+                sink.close()
+        return self.write_rows(store.iter_rows(), append=True)
+
+    def write_rows(self, rows, append):
+        from mpesa_parser import MPESATransaction
+
+        mirror = self._open()
+        count = 0
+        batch = []
+        for row in rows:
+            batch.append(MPESATransaction.from_row(list(row)))
+            if len(batch) >= 1000:
+                count += mirror.add_many(batch)
+                batch = []
+        if batch:
+            count += mirror.add_many(batch)
+        return count
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+
+def month_of(transaction):
+    """Partition of a transaction: the month of its date, else of when it was processed"""
+    # The same fallback as the store's day column, which exports select months by
+    moment = transaction.transaction_datetime or transaction.processed_datetime
+    return f"{moment.year:04d}-{moment.month:02d}"
+
+
+class MonthlySink(Sink):
+    """A file sink split into one file per month of transaction date, listed in a manifest
+
+    mpesa_transactions.xlsx becomes mpesa_transactions-2025-08.xlsx and so on,
+    with mpesa_transactions.xlsx.manifest.json mapping each month to its file, row
+    count and state. An append only touches the months it contains, normally
+    the current one, so its cost follows the size of a month, not the history,
+    and even an xlsx@month sink takes live appends.
+    Once a later month has rows, a month is sealed: its file is made read-only
+    and never written again, so it can be cached or archived. A late
+    transaction for a sealed month (e.g. one recovered by the balance
+    reconciler) rewrites that month to a new versioned file and repoints the
+    manifest.
+    """
+
+    def __init__(self, sink_type, path):
+        if sink_type is SqliteSink:
+            raise ValueError("sqlite sinks cannot be partitioned by month")
+        super().__init__(path)
+        self.sink_type = sink_type
+        self.kind = f"{sink_type.kind}@month"
+        ext = sink_type.extension
+        self.base = path[:-len(ext)] if path.endswith(ext) else os.path.splitext(path)[0]
+        self.manifest_file = self.base + ext + ".manifest.json"
+        self.directory = os.path.dirname(os.path.abspath(self.manifest_file))
+        # {month: {"file", "rows", "version", "sealed"}}, file names relative to the manifest
+        self.partitions = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, encoding="utf-8") as f:
+                self.partitions = json.load(f)["partitions"]
+
+    def file_of(self, month):
+        """Path of a month's current file"""
+        return os.path.join(self.directory, self.partitions[month]["file"])
+
+    def append(self, transactions, store):
+        """Add committed transactions to their months' files"""
+        rows = {}
+        for t in transactions:
+            rows.setdefault(month_of(t), []).append(t.as_row())
+        superseded = []
+        for month, month_rows in sorted(rows.items()):
+            partition = self.partitions.get(month)
+            if partition and not partition["sealed"] and os.path.exists(self.file_of(month)):
+                self.sink_type(self.file_of(month)).write_rows(month_rows, append=True)
+                partition["rows"] += len(month_rows)
+            else:
+                # A new, sealed or lost month is written whole from the store, which has these rows
+                superseded += self._export_month(store, month)
+        self._commit(superseded)
+        return len(transactions)
+
+    def export(self, store, path=None):
+        """Bring every month up to date with the store, leaving complete months alone"""
+        if path and path != self.path:
+            return MonthlySink(self.sink_type, path).export(store)
+        counts = store.month_counts()
+        superseded = []
+        for month, count in sorted(counts.items()):
+            partition = self.partitions.get(month)
+            if partition is None or partition["rows"] != count or not os.path.exists(self.file_of(month)):
+                superseded += self._export_month(store, month)
+        self._commit(superseded)
+        return sum(counts.values())
+
+    def _export_month(self, store, month):
+        """Write a month from the store; returns the file it replaces, if any"""
+        partition = self.partitions.get(month)
+        version = 1
+        if partition:
+            # Sealed files are never rewritten; the month moves to a new version
+            version = partition["version"] + 1 if partition["sealed"] else partition["version"]
+        suffix = f".v{version}" if version > 1 else ""
+        path = f"{self.base}-{month}{suffix}{self.sink_type.extension}"
+        count = self.sink_type(path).write_file(store.iter_rows(month=month), path)
+        self.partitions[month] = {"file": os.path.basename(path), "rows": count,
+                                  "version": version, "sealed": False}
+        if partition and partition["sealed"]:
+            log.info("Rewrote sealed month %s as %s", month, path)
+            return [os.path.join(self.directory, partition["file"])]
+        return []
+
+    def _commit(self, superseded):
+        """Seal every month before the newest, save the manifest, then drop replaced files"""
+        active = max(self.partitions, default=None)
+        for month, partition in self.partitions.items():
+            if month != active and not partition["sealed"]:
+                partition["sealed"] = True
+                path = self.file_of(month)
+                if os.path.exists(path):
+                    os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+                log.info("Sealed month %s (%s)", month, path)
+        temp_file = self.manifest_file + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump({"kind": self.sink_type.kind, "active": active, "partitions": self.partitions}, f, indent=1)
+        os.replace(temp_file, self.manifest_file)
+        # Only once the manifest no longer points at them
+        for path in superseded:
+            try:
+                os.chmod(path, stat.S_IWUSR | stat.S_IRUSR)
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+SINK_TYPES = {sink.kind: sink for sink in (ExcelSink, CsvSink, JsonlSink, SqliteSink)}
+
+
+def sink_for_path(path):
+    """A sink of the kind matching a file's extension (used by the export command)"""
+    for sink_type in SINK_TYPES.values():
+        if path.endswith(sink_type.extension):
+            return sink_type(path)
+    if path.endswith(".db"):
+        return SqliteSink(path)
+    raise ValueError(f"cannot export to {path}: use a .xlsx, .csv, .jsonl or .db file")
+
+
+def open_sinks(spec, excel_file):
+    """Build the sinks named in a spec; default paths sit next to the Excel file"""
+    if spec is None:
+        spec = os.environ.get(SINKS_ENV) or DEFAULT_SINKS
+    if isinstance(spec, str):
+        spec = spec.split(",")
+    base_name = os.path.splitext(excel_file)[0]
+    sinks = []
+    for entry in spec:
+        kind, _, path = entry.strip().partition(":")
+        kind, _, partition = kind.partition("@")
+        if not kind or kind == "none":
+            continue
+        sink_type = SINK_TYPES.get(kind)
+        if sink_type is None:
+            raise ValueError(f"unknown sink {kind!r}; choose from {', '.join(SINK_TYPES)} or none")
+        if partition and partition != "month":
+            raise ValueError(f"unknown partitioning {partition!r} for {kind}; use {kind}@month")
+        if not path:
+            path = excel_file if kind == "xlsx" else base_name + sink_type.extension
+        sinks.append(MonthlySink(sink_type, path) if partition else sink_type(path))
+    return sinks
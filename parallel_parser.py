@@ -0,0 +1,81 @@
+"""
+Multi-process parsing for large imports.
+
+Messages are cut into chunks, parsed by a process pool with the same
+mpesa_parser.parse_message used on the live path, and yielded back in input
+order so the single writer sees exactly the sequence a serial import would.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+from itertools import islice
+
+from mpesa_parser import MPESATransaction, parse_message
+
+
+def _pack(transaction):
+    # Plain strings and tuples pickle an order of magnitude faster than Decimal and
+    # datetime objects, and the raw message is already held by the parent
+    moment = transaction.transaction_datetime
+    return (
+        transaction.transaction_code,
+        str(transaction.amount),
+        transaction.transaction_type,
+        transaction.recipient_sender,
+        moment.timetuple()[:5] if moment else None,
+        None if transaction.new_balance is None else str(transaction.new_balance),
+        str(transaction.transaction_cost),
+        None if transaction.daily_limit_remaining is None else str(transaction.daily_limit_remaining),
+    )
+
+
+def _unpack(state, message):
+    code, amount, transaction_type, party, moment, balance, cost, limit = state
+    return MPESATransaction(
+        code,
+        Decimal(amount),
+        transaction_type,
+        party,
+        datetime(*moment) if moment else None,
+        None if balance is None else Decimal(balance),
+        Decimal(cost),
+        None if limit is None else Decimal(limit),
+        message,
+    )
+
+
+def parse_chunk(messages):
+    """Parse a list of messages into packed transactions (runs inside a worker process)"""
+    return [_pack(parse_message(message)) for message in messages]
+
+
+def _chunks(messages, chunk_size):
+    iterator = iter(messages)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _collect(chunk, future):
+    return map(_unpack, future.result(), chunk)
+
+
+def parse_messages_parallel(messages, workers=None, chunk_size=2000):
+    """Yield parsed transactions in input order, parsing chunks across a process pool"""
+    workers = workers or os.cpu_count() or 1
+    # A couple of chunks per worker in flight keeps every core busy while
+    # bounding memory to a few chunks regardless of input size
+    max_in_flight = workers * 2
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for chunk in _chunks(messages, chunk_size):
+            in_flight.append((chunk, pool.submit(parse_chunk, chunk)))
+            if len(in_flight) >= max_in_flight:
+                yield from _collect(*in_flight.popleft())
+        while in_flight:
+            yield from _collect(*in_flight.popleft())
@@ -0,0 +1,266 @@
+"""
+Streaming transaction reports in xlsx or CSV.
+
+A report reads the store through one cursor in day order and writes each row
+as it arrives, so peak memory does not depend on how many transactions it
+covers: CSV goes out in chunks of CHUNK_SIZE bytes, and workbooks use
+openpyxl's write-only mode, which streams rows to a temporary file and writes
+strings inline. A year-end report of a million transactions needs no more
+memory than one of a hundred.
+
+Filters are an inclusive day range, a transaction type and a counterparty
+substring. With subtotals, a total row (count, money in and out, fees and the
+closing balance) follows each day and a grand total ends the report. Types
+whose direction is not known (Fuliza, balance inquiries, Other) put their
+amount in a column of its own, so they count as neither money in nor out.
+http_ingest.py serves reports as chunked downloads at GET /report.
+
+An AccountsReport covers several accounts' stores (see account_shards): their
+cursors are merged in day order and each row names its account. Closing
+balances in its totals add up the accounts' latest balances.
+
+Usage: python mpesa_logger.py report year.xlsx --from 2025-01-01 --to 2025-12-31 --subtotals
+"""
+
+import csv
+import heapq
+import io
+import os
+import tempfile
+from datetime import date
+from decimal import Decimal
+
+from balance_reconciler import DIRECTIONS
+from transaction_store import amount_cents
+
+REPORT_HEADERS = [
+    "Date", "Time", "Transaction Code", "Transaction Type", "Recipient/Sender",
+    "Money In (KSh)", "Money Out (KSh)", "Other Amount (KSh)", "Transaction Cost (KSh)", "New Balance (KSh)",
+]
+FORMATS = ("csv", "xlsx")
+CONTENT_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+CHUNK_SIZE = 64 * 1024
+DAY_TOTAL = "Day total"
+GRAND_TOTAL = "Total"
+
+
+def _money(cents):
+    return None if cents is None else Decimal(cents).scaleb(-2)
+
+
+def report_format(path):
+    """The format of a report file from its extension; raises ValueError for others"""
+    extension = os.path.splitext(path)[1].lower().lstrip(".")
+    if extension not in FORMATS:
+        raise ValueError(f"cannot write a report to {path}: use a .xlsx or .csv file")
+    return extension
+
+
+class _Totals:
+    """Running count, money in, out and of unknown direction, fees and closing balance, in cents"""
+
+    __slots__ = ("count", "money_in", "money_out", "other", "fees", "closing")
+
+    def __init__(self):
+        self.count = self.money_in = self.money_out = self.other = self.fees = 0
+        # Latest balance of each account
+        self.closing = {}
+
+    def add(self, money_in, money_out, other, fee, balance, account=None):
+        self.count += 1
+        self.money_in += money_in or 0
+        self.money_out += money_out or 0
+        self.other += other or 0
+        self.fees += fee or 0
+        if balance is not None:
+            self.closing[account] = balance
+
+    def row(self, day, label):
+        closing = sum(self.closing.values()) if self.closing else None
+        return [day, None, None, label, f"{self.count} transactions", _money(self.money_in),
+                _money(self.money_out), _money(self.other), _money(self.fees), _money(closing)]
+
+
+class Report:
+    """Filtered transactions in day order, read with a single cursor each time it is iterated
+
+    conn is a connection to the store (TransactionStore.open_reader() keeps a
+    long report off the writer's connection). Days are inclusive 'YYYY-MM-DD'
+    strings and counterparty matches any part of the name, ignoring case.
+    """
+
+    headers = REPORT_HEADERS
+
+    def __init__(self, conn, date_from=None, date_to=None, transaction_type=None, counterparty=None,
+                 subtotals=False, batch_size=1000):
+        self.conn = conn
+        self.date_from = date_from
+        self.date_to = date_to
+        self.transaction_type = transaction_type
+        self.counterparty = counterparty
+        self.subtotals = subtotals
+        self.batch_size = batch_size
+        # Transactions in the last iteration, not counting total rows
+        self.transactions = 0
+
+    def _cursor(self, conn):
+        conditions, params = [], []
+        if self.date_from:
+            conditions.append("day >= ?")
+            params.append(self.date_from)
+        if self.date_to:
+            conditions.append("day <= ?")
+            params.append(self.date_to)
+        if self.transaction_type:
+            conditions.append("transaction_type = ?")
+            params.append(self.transaction_type)
+        if self.counterparty:
+            conditions.append("recipient_sender LIKE ? ESCAPE '\\'")
+            escaped = self.counterparty.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params.append(f"%{escaped}%")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        # The (day, id) index already holds rows in report order, so SQLite never sorts
+        return conn.execute(
+            "SELECT day, time, transaction_code, transaction_type, recipient_sender, amount_cents, "
+            f"transaction_cost, new_balance FROM transactions INDEXED BY idx_transactions_day {where} "
+            "ORDER BY day, id", params,
+        )
+
+    def _rows(self, conn, account=None):
+        """Yield (account, row) for the store behind conn, in day order"""
+        cursor = self._cursor(conn)
+        while True:
+            rows = cursor.fetchmany(self.batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield account, row
+
+    def _all_rows(self):
+        return self._rows(self.conn)
+
+    def __iter__(self):
+        """Yield rows in headers order, money as Decimal and the day as a date"""
+        self.transactions = 0
+        day_totals, totals = _Totals(), _Totals()
+        current = None
+        for account, (day, clock, code, transaction_type, party, amount, cost, balance) in self._all_rows():
+            day = date.fromisoformat(day) if day else None
+            if self.subtotals and day != current:
+                if day_totals.count:
+                    yield day_totals.row(current, DAY_TOTAL)
+                day_totals, current = _Totals(), day
+            direction = DIRECTIONS.get(transaction_type)
+            money_in = money_out = other = None
+            if direction is None:
+                other = amount
+            elif direction > 0:
+                money_in = amount
+            else:
+                money_out = amount
+            fee, balance = amount_cents(cost), amount_cents(balance)
+            if self.subtotals:
+                day_totals.add(money_in, money_out, other, fee, balance, account)
+                totals.add(money_in, money_out, other, fee, balance, account)
+            self.transactions += 1
+            row = [day, clock, code, transaction_type, party, _money(money_in), _money(money_out),
+                   _money(other), _money(fee), _money(balance)]
+            if account is not None:
+                row.append(account)
+            yield row
+        if self.subtotals and totals.count:
+            yield day_totals.row(current, DAY_TOTAL)
+            yield totals.row(None, GRAND_TOTAL)
+
+    def csv_chunks(self, chunk_size=CHUNK_SIZE):
+        """Yield the report as UTF-8 CSV in chunks of about chunk_size bytes"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(self.headers)
+        for row in self:
+            writer.writerow(row)
+            if buffer.tell() >= chunk_size:
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode("utf-8")
+
+    def write_xlsx(self, target):
+        """Write the report as a workbook to a path or binary file"""
+        # openpyxl is only imported by workbook reports
+        import openpyxl
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.styles import Font
+
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet("M-PESA Report")
+        bold = Font(bold=True)
+        header = []
+        for title in self.headers:
+            cell = WriteOnlyCell(ws, title)
+            cell.font = bold
+            header.append(cell)
+        ws.append(header)
+        for row in self:
+            if row[3] in (DAY_TOTAL, GRAND_TOTAL) and row[2] is None:
+                cells = []
+                for value in row:
+                    cell = WriteOnlyCell(ws, value)
+                    cell.font = bold
+                    cells.append(cell)
+                row = cells
+            ws.append(row)
+        wb.save(target)
+
+    def xlsx_chunks(self, chunk_size=CHUNK_SIZE):
+        """Yield the report as a workbook in chunks, built in a temporary file first"""
+        # A zip file's directory comes last, so the workbook is finished before sending
+        with tempfile.TemporaryFile() as f:
+            self.write_xlsx(f)
+            f.seek(0)
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def chunks(self, fmt, chunk_size=CHUNK_SIZE):
+        """Yield the report in a format from FORMATS"""
+        if fmt == "xlsx":
+            return self.xlsx_chunks(chunk_size)
+        return self.csv_chunks(chunk_size)
+
+    def write(self, path, fmt=None):
+        """Write the report to a file, through a temp file; returns the number of transactions"""
+        fmt = fmt or report_format(path)
+        temp_file = path + ".tmp"
+        if fmt == "xlsx":
+            self.write_xlsx(temp_file)
+        else:
+            with open(temp_file, "wb") as f:
+                for chunk in self.csv_chunks():
+                    f.write(chunk)
+        os.replace(temp_file, path)
+        return self.transactions
+
+
+class AccountsReport(Report):
+    """A report over several accounts' stores, merged in day order with an Account column
+
+    conns maps each account name to a connection to its store. A day's total
+    row adds up the closing balances of the accounts that moved that day.
+    """
+
+    headers = REPORT_HEADERS + ["Account"]
+
+    def __init__(self, conns, **options):
+        super().__init__(None, **options)
+        self.conns = conns
+
+    def _all_rows(self):
+        # Each store's cursor is already in day order, so merging them needs no sort
+        streams = [self._rows(conn, account) for account, conn in self.conns.items()]
+        return heapq.merge(*streams, key=lambda item: item[1][0] or "")
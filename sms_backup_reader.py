@@ -0,0 +1,81 @@
+"""
+Streaming readers for SMS exports.
+
+Each reader yields message bodies one at a time so imports run in constant
+memory regardless of backup size. Supported formats:
+- SMS Backup & Restore XML (<smses><sms body="..." .../></smses>)
+- CSV with a body/message/text column
+- Plain text with one message per line (e.g. the Tasker file)
+"""
+
+import csv
+import os
+import xml.etree.ElementTree as ET
+
+BODY_COLUMNS = ("body", "message", "text", "sms", "content")
+
+
+def read_backup_xml(path):
+    """Yield message bodies from an SMS Backup & Restore XML file"""
+    context = ET.iterparse(path, events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if event == "end" and elem.tag == "sms":
+            body = elem.get("body")
+            if body:
+                yield body
+            # Drop parsed elements so memory stays flat for huge backups
+            root.clear()
+
+
+def read_backup_csv(path):
+    """Yield message bodies from a CSV export"""
+    with open(path, newline="", encoding="utf-8", errors="replace") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        names = [name.strip().lower() for name in header]
+        body_index = next((names.index(name) for name in BODY_COLUMNS if name in names), None)
+        if body_index is None:
+            # No recognisable header: treat the first row as data and use the last column
+            body_index = len(header) - 1
+            if header[body_index].strip():
+                yield header[body_index].strip()
+        for row in reader:
+            if len(row) > body_index and row[body_index].strip():
+                yield row[body_index].strip()
+
+
+def read_text(path):
+    """Yield one message per non-empty line of a text file"""
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+READERS = {
+    "xml": read_backup_xml,
+    "csv": read_backup_csv,
+    "text": read_text,
+}
+
+
+def detect_format(path):
+    """Guess the export format from the file extension"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".xml":
+        return "xml"
+    if extension == ".csv":
+        return "csv"
+    return "text"
+
+
+def read_messages(path, fmt=None):
+    """Yield message bodies from an SMS export in the given (or detected) format"""
+    fmt = fmt or detect_format(path)
+    if fmt not in READERS:
+        raise ValueError(f"Unsupported format: {fmt}")
+    return READERS[fmt](path)
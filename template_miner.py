@@ -0,0 +1,211 @@
+"""
+Proposes parser templates for the confirmations stored as 'Other'.
+
+Reads the raw message of every stored 'Other' transaction and drops those a
+template already matches (stored before the template existed). The rest are
+grouped by dispatch key, the first two words after "Confirmed.". Within a key
+they are grouped again by skeleton: the lower-case words and the figures,
+dates, times and codes, each replaced by a field. Names vary between
+messages, so they are not part of the skeleton.
+
+The messages in a group are aligned word by word. Words that every message
+shares at the start and at the end stay literal, and the run in between that
+differs becomes {party}. The first Ksh figure becomes {amount}. Each proposal
+is compiled and checked against every message in its group, then printed with
+how many it matches. --write adds the proposals to a template file for
+MPESA_TEMPLATES (see message_templates). Give each proposal a real
+transaction type before loading the file, and use `mpesa_logger.py report
+--type Other` to see what is left.
+
+Usage: python template_miner.py [--db mpesa_transactions.db] [--min-count 2] [--write templates.json]
+"""
+
+import argparse
+import json
+import os
+import re
+from collections import Counter, defaultdict
+
+from message_templates import Template, body_start, dispatch_key, load_registry
+from transaction_store import TransactionStore
+
+# The tail every format shares, which the parser reads by anchor: a message's head
+# ends at the first of these, and a pattern that would end with {party} ends with it
+TAIL_ANCHORS = (
+    ("New M-PESA balance is Ksh", "New M-PESA balance is Ksh{balance}"),
+    ("Transaction cost", "Transaction cost, Ksh{cost}"),
+    ("Amount you can transact within the day is", "Amount you can transact within the day is {limit}"),
+)
+# Figures in a head and the field each becomes, replaced in this order
+_FIGURES = (
+    (re.compile(r'\d{1,2}:\d{2}\s?[AP]M'), "{time}"),
+    (re.compile(r'\d{1,2}/\d{1,2}/\d{2,4}'), "{date}"),
+    (re.compile(r'Ksh\s?\d[\d,]*(?:\.\d+)?'), "Ksh{figure}"),
+    (re.compile(r'\b(?=[A-Z0-9]*\d)(?=[A-Z0-9]*[A-Z])[A-Z0-9]{10}\b'), "{ref}"),
+    (re.compile(r'\d[\d,]*(?:\.\d+)?'), "{number}"),
+)
+# Fields a pattern can hold once; later occurrences are passed over
+_ONCE_RE = re.compile(r'Ksh\{figure\}|\{ref\}|\{date\}|\{time\}')
+_FIRST = {"Ksh{figure}": "Ksh{amount}", "{ref}": "{ref}", "{date}": "{date}", "{time}": "{time}"}
+_LATER = {"Ksh{figure}": "Ksh{number}", "{ref}": "{skip}", "{date}": "{skip}", "{time}": "{skip}"}
+
+
+def head_tokens(message, start):
+    """Split the head of a message into words with its figures as fields; returns (tokens, tail anchor)"""
+    end, anchor = len(message), None
+    for i, (text, _) in enumerate(TAIL_ANCHORS):
+        position = message.find(text, start)
+        if 0 <= position < end:
+            end, anchor = position, i
+    head = message[start:end]
+    for pattern, field in _FIGURES:
+        head = pattern.sub(field, head)
+    return head.split(), anchor
+
+
+def skeleton(tokens):
+    """The words and fields that do not vary with the counterparty's name"""
+    return tuple(token for token in tokens
+                 if token != "{number}" and ("{" in token or token.strip(".,:;").islower()))
+
+
+def _name_fields(pattern):
+    seen = set()
+
+    def rename(match):
+        field = match.group()
+        names = _LATER if field in seen else _FIRST
+        seen.add(field)
+        return names[field]
+
+    return _ONCE_RE.sub(rename, pattern)
+
+
+def align(token_lists):
+    """Return (prefix, suffix, has_party) shared by every message in a group"""
+    prefix = []
+    for column in zip(*token_lists):
+        if any(token != column[0] for token in column):
+            break
+        prefix.append(column[0])
+    suffix = []
+    room = min(len(tokens) for tokens in token_lists) - len(prefix)
+    for column in zip(*(reversed(tokens) for tokens in token_lists)):
+        if len(suffix) >= room or any(token != column[0] for token in column):
+            break
+        suffix.append(column[0])
+    suffix.reverse()
+    # Phone and agent numbers belong to the name next to them
+    while prefix and prefix[-1] == "{number}":
+        prefix.pop()
+    while suffix and suffix[0] == "{number}":
+        suffix.pop(0)
+    has_party = any(len(tokens) > len(prefix) + len(suffix) for tokens in token_lists)
+    return prefix, suffix, has_party
+
+
+def propose(name, messages):
+    """Build and check a template for a group of (message, tokens, anchor); returns (template, matched)"""
+    prefix, suffix, has_party = align([tokens for _, tokens, _ in messages])
+    if not prefix:
+        return None, 0
+    words = prefix + (["{party}"] if has_party else []) + suffix
+    if has_party and not suffix:
+        anchors = Counter(anchor for _, _, anchor in messages if anchor is not None)
+        if not anchors:
+            return None, 0
+        words.append(TAIL_ANCHORS[anchors.most_common(1)[0][0]][1])
+    pattern = _name_fields(" ".join(words))
+    key = dispatch_key(messages[0][0])
+    type_name = key.title() or "Unknown"
+    try:
+        template = Template(name, type_name, pattern, messages[0][0])
+    except ValueError:
+        return None, 0
+    matched = sum(1 for message, _, _ in messages if template.regex.match(message, body_start(message)))
+    return template, matched
+
+
+def mine(rows, registry, min_count=2):
+    """Propose templates for the 'Other' messages in rows; returns (proposals, covered, unmatched)
+
+    proposals is a list of (template, group size, messages matched).
+    """
+    groups = defaultdict(list)
+    covered = 0
+    for message, in rows:
+        start = body_start(message or "")
+        if start is None:
+            continue
+        if registry.match(message)[1]:
+            covered += 1
+            continue
+        tokens, anchor = head_tokens(message, start)
+        groups[(dispatch_key(message), skeleton(tokens))].append((message, tokens, anchor))
+
+    proposals = []
+    names = {template.name for template in registry.templates}
+    unmatched = 0
+    for (key, _), messages in sorted(groups.items(), key=lambda item: -len(item[1])):
+        if len(messages) < min_count:
+            unmatched += len(messages)
+            continue
+        base = re.sub(r'\W+', '_', key).strip('_') or "format"
+        name, n = base, 1
+        while name in names:
+            n += 1
+            name = f"{base}_{n}"
+        template, matched = propose(name, messages)
+        if template is None:
+            unmatched += len(messages)
+            continue
+        names.add(name)
+        proposals.append((template, len(messages), matched))
+        unmatched += len(messages) - matched
+    return proposals, covered, unmatched
+
+
+def write_templates(path, templates):
+    """Add templates to a template file, keeping those already in it; returns how many were added"""
+    entries = []
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            entries = json.load(f)
+    existing = {entry.get("name") for entry in entries}
+    added = [template.as_dict() for template in templates if template.name not in existing]
+    temp_file = path + ".tmp"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        json.dump(entries + added, f, indent=2, ensure_ascii=False)
+    os.replace(temp_file, path)
+    return len(added)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Propose parser templates for messages stored as 'Other'")
+    parser.add_argument("--db", default="mpesa_transactions.db", help="Transaction store")
+    parser.add_argument("--min-count", type=int, default=2, help="Smallest group to propose a template for")
+    parser.add_argument("--write", help="Add the proposals to this template file")
+    args = parser.parse_args()
+
+    store = TransactionStore(args.db)
+    try:
+        rows = store.conn.execute("SELECT raw_message FROM transactions WHERE transaction_type = 'Other'")
+        proposals, covered, unmatched = mine(rows, load_registry(), args.min_count)
+    finally:
+        store.close()
+
+    if covered:
+        print(f"✅ {covered} 'Other' messages already match a template (stored before it was added)")
+    for template, size, matched in proposals:
+        print(f"🧩 {template.name}: {size} messages, {matched} matched")
+        print(f"   type:    {template.transaction_type}")
+        print(f"   pattern: {template.pattern}")
+        print(f"   example: {template.example[:120]}")
+    print(f"❔ {unmatched} messages left without a template")
+    if args.write and proposals:
+        added = write_templates(args.write, [template for template, _, _ in proposals])
+        print(f"📝 Added {added} templates to {args.write}; set their types, then export MPESA_TEMPLATES={args.write}")
+
+
+if __name__ == "__main__":
+    main()
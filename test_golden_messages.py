@@ -0,0 +1,26 @@
+"""
+Golden-corpus test: every message in examples/golden_messages.json must parse
+to exactly its expected fields.
+
+Usage: python -m pytest -q test_golden_messages.py
+"""
+
+import json
+
+import pytest
+
+from benchmark_parser import GOLDEN_FILE
+from mpesa_parser import parse_message
+
+with open(GOLDEN_FILE, encoding="utf-8") as f:
+    CORPUS = json.load(f)
+
+
+@pytest.mark.parametrize("case", CORPUS, ids=[f"{case['format']}-{case['expected']['transaction_code']}"
+                                              for case in CORPUS])
+def test_golden_message(case):
+    actual = parse_message(case["message"]).as_dict()
+    # Only the processing time differs between runs
+    del actual["processed_datetime"]
+    assert actual.pop("raw_message") == case["message"]
+    assert actual == case["expected"]
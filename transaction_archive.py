@@ -0,0 +1,247 @@
+"""
+Columnar, memory-mapped archive of transaction history for analysis.
+
+An archive is a directory with one NumPy array per field:
+
+    meta.json                    row count, newest store id, column list
+    time.npy                     datetime64[m]; transaction time, or processing time when
+                                 the message had none. Rows are sorted by it
+    id.npy, code.npy             store id and transaction code
+    amount/fee/balance/limit.npy int64 cents, MISSING where the message had no value
+    processed.npy                datetime64[s] processing time
+    type.npy, counterparty.npy   dictionary codes into the types and counterparties tables
+    raw, types, counterparties   string tables: <name>.bin holds the UTF-8 text back to back
+                                 and <name>_index.npy the [start, end) of each entry
+
+Opening an archive parses nothing: columns are memory-mapped on first use, so
+a range query or aggregation only pages in the columns and rows it reads, and
+string tables (raw messages, dictionary labels) are only decoded for the
+entries that are actually looked up.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+from mpesa_parser import parse_datetime
+from transaction_store import amount_cents
+
+FORMAT_VERSION = 1
+MISSING = np.iinfo(np.int64).min
+MONEY_COLUMNS = ("amount", "fee", "balance", "limit")
+
+
+def _minutes(moment):
+    return np.datetime64(moment, "m") if moment else np.datetime64("NaT")
+
+
+def _write_strings(path, name, strings):
+    index = np.empty((len(strings), 2), "int64")
+    offset = 0
+    with open(os.path.join(path, name + ".bin"), "wb") as f:
+        for i, text in enumerate(strings):
+            data = (text or "").encode("utf-8")
+            f.write(data)
+            index[i] = (offset, offset + len(data))
+            offset += len(data)
+    np.save(os.path.join(path, name + "_index.npy"), index)
+
+
+class StringTable:
+    """Memory-mapped string column; entries are decoded when looked up"""
+
+    def __init__(self, path, name):
+        self.index = np.load(os.path.join(path, name + "_index.npy"), mmap_mode="r")
+        blob_file = os.path.join(path, name + ".bin")
+        # An empty file cannot be mapped
+        if os.path.getsize(blob_file):
+            self.blob = np.memmap(blob_file, dtype="uint8", mode="r")
+        else:
+            self.blob = np.empty(0, "uint8")
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        start, end = self.index[i]
+        return self.blob[start:end].tobytes().decode("utf-8")
+
+
+def write_archive(store, path, batch_size=50000):
+    """Write every stored transaction to an archive directory; returns the row count"""
+    rows = store.count()
+    columns = {
+        "time": np.empty(rows, "datetime64[m]"),
+        "id": np.empty(rows, "int64"),
+        "amount": np.empty(rows, "int64"),
+        "fee": np.empty(rows, "int64"),
+        "balance": np.empty(rows, "int64"),
+        "limit": np.empty(rows, "int64"),
+        "processed": np.empty(rows, "datetime64[s]"),
+        "type": np.empty(rows, "uint8"),
+        "counterparty": np.empty(rows, "uint32"),
+        "raw_index": np.empty((rows, 2), "int64"),
+    }
+    codes = []
+    types, parties = {}, {}
+
+    # Built next to the target and swapped in at the end, so readers never see half an archive
+    temp_path = path + ".tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+
+    cursor = store.conn.execute(
+        "SELECT id, transaction_code, amount_cents, transaction_type, recipient_sender, date, time, "
+        "new_balance, transaction_cost, daily_limit_remaining, raw_message, processed_datetime "
+        "FROM transactions ORDER BY id"
+    )
+    row = 0
+    offset = 0
+    with open(os.path.join(temp_path, "raw.bin"), "wb") as raw_file:
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch or row >= rows:
+                break
+            for (store_id, code, amount, transaction_type, party, date, clock,
+                 balance, fee, limit, raw_message, processed) in batch[:rows - row]:
+                columns["id"][row] = store_id
+                codes.append(code)
+                columns["amount"][row] = MISSING if amount is None else amount
+                for name, text in (("fee", fee), ("balance", balance), ("limit", limit)):
+                    cents = amount_cents(text)
+                    columns[name][row] = MISSING if cents is None else cents
+                columns["type"][row] = types.setdefault(transaction_type, len(types))
+                columns["counterparty"][row] = parties.setdefault(party, len(parties))
+                processed = np.datetime64(processed or "NaT", "s")
+                moment = _minutes(parse_datetime(date, clock))
+                columns["time"][row] = processed.astype("datetime64[m]") if np.isnat(moment) else moment
+                columns["processed"][row] = processed
+
+                data = (raw_message or "").encode("utf-8")
+                raw_file.write(data)
+                columns["raw_index"][row] = (offset, offset + len(data))
+                offset += len(data)
+                row += 1
+    if len(types) > 256:
+        raise ValueError("more than 256 transaction types do not fit the archive's type column")
+
+    columns["code"] = np.array(codes, dtype=f"S{max((len(c) for c in codes), default=1)}")
+    # Messages usually arrive in time order, so the sort rarely has to move anything
+    order = np.argsort(columns["time"], kind="stable")
+    if not np.all(order == np.arange(rows)):
+        columns = {name: values[order] for name, values in columns.items()}
+
+    for name, values in columns.items():
+        np.save(os.path.join(temp_path, name + ".npy"), values)
+    _write_strings(temp_path, "types", list(types))
+    _write_strings(temp_path, "counterparties", list(parties))
+    with open(os.path.join(temp_path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"version": FORMAT_VERSION, "rows": rows, "last_id": int(columns["id"].max(initial=0)),
+                   "columns": sorted(name for name in columns if name != "raw_index")}, f)
+
+    old_path = path + ".old"
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(temp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return rows
+
+
+class TransactionArchive:
+    """Read-only view of an archive; columns are memory-mapped on first use"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"unsupported archive version {self.meta.get('version')}")
+        self.rows = self.meta["rows"]
+        self._columns = {}
+        self._tables = {}
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, name):
+        """A column as a read-only memory-mapped array"""
+        values = self._columns.get(name)
+        if values is None:
+            if name not in self.meta["columns"]:
+                raise KeyError(name)
+            values = np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+            self._columns[name] = values
+        return values
+
+    def strings(self, name):
+        """A string table: raw, types or counterparties"""
+        if name not in self._tables:
+            self._tables[name] = StringTable(self.path, name)
+        return self._tables[name]
+
+    @property
+    def types(self):
+        return self.strings("types")
+
+    @property
+    def counterparties(self):
+        return self.strings("counterparties")
+
+    def between(self, start=None, end=None):
+        """Row slice for transactions with start <= time < end (datetimes or ISO strings)"""
+        times = self["time"]
+        low = 0 if start is None else int(np.searchsorted(times, np.datetime64(start, "m"), "left"))
+        high = self.rows if end is None else int(np.searchsorted(times, np.datetime64(end, "m"), "left"))
+        return slice(low, max(low, high))
+
+    def message(self, row):
+        """Raw message text of one row"""
+        return self.strings("raw")[row]
+
+    def _labels(self, name, codes):
+        """Distinct dictionary codes in codes, their labels and each row's position among them"""
+        table = self.strings("types" if name == "type" else "counterparties")
+        if len(table) <= len(codes):
+            # Cheaper than sorting the codes when the dictionary is the smaller side
+            distinct = np.flatnonzero(np.bincount(codes, minlength=len(table)))
+            lookup = np.zeros(len(table), dtype="int64")
+            lookup[distinct] = np.arange(len(distinct))
+            positions = lookup[codes]
+        else:
+            distinct, positions = np.unique(codes, return_inverse=True)
+        return [table[code] for code in distinct], positions
+
+    def totals(self, by="type", value="amount", start=None, end=None):
+        """{label: (count, total cents)} of a money column grouped by type or counterparty"""
+        rows = self.between(start, end)
+        keys = np.asarray(self[by][rows])
+        values = np.asarray(self[value][rows])
+        present = values != MISSING
+        labels, positions = self._labels(by, keys[present])
+        counts = np.bincount(positions, minlength=len(labels))
+        # float64 sums of cents are exact up to 2**53 cents (~90 trillion KSh)
+        sums = np.bincount(positions, weights=values[present], minlength=len(labels)).round().astype("int64")
+        return {label: (int(count), int(total)) for label, count, total in zip(labels, counts, sums)}
+
+    def to_frame(self, columns=("time", "code", "type", "counterparty", "amount", "fee", "balance"),
+                 start=None, end=None):
+        """pandas DataFrame of some columns for a time range; type/counterparty are categoricals"""
+        import pandas as pd
+
+        rows = self.between(start, end)
+        data = {}
+        for name in columns:
+            values = self[name][rows]
+            if name in ("type", "counterparty"):
+                labels, positions = self._labels(name, values)
+                data[name] = pd.Categorical.from_codes(positions, categories=labels)
+            elif name == "code":
+                data[name] = np.char.decode(values, "ascii")
+            elif name in MONEY_COLUMNS:
+                # Cents become KSh floats here; NaN where the message had no value
+                data[name] = np.where(values == MISSING, np.nan, values / 100)
+            else:
+                data[name] = values
+        return pd.DataFrame(data)
@@ -0,0 +1,307 @@
+import os
+import sqlite3
+from decimal import Decimal, InvalidOperation
+from urllib.parse import quote
+
+# Column order matches the Excel export headers in output_sinks.HEADERS
+FIELDS = [
+    "transaction_code", "amount", "transaction_type",
+    "recipient_sender", "date", "time", "new_balance",
+    "transaction_cost", "daily_limit_remaining",
+    "raw_message", "processed_datetime"
+]
+
+# Derived columns kept for querying; they are not part of the Excel export
+QUERY_FIELDS = ["amount_cents", "day"]
+SEARCH_LIMIT = 50
+MAX_SEARCH_LIMIT = 500
+# A filter matching fewer rows than this drives the search scan
+DRIVER_CAP = 10000
+
+
+def amount_cents(text):
+    """Convert a stored amount such as '2,505.09' to integer cents, or None"""
+    try:
+        return int(Decimal(text.replace(",", "")) * 100)
+    except (AttributeError, InvalidOperation):
+        return None
+
+
+def iso_day(date_text, processed_datetime=None):
+    """Convert an M-PESA date ('20/8/25') to 'YYYY-MM-DD', falling back to the processing date"""
+    try:
+        day, month, year = (int(part) for part in date_text.split("/"))
+        return f"{year + 2000 if year < 100 else year:04d}-{month:02d}-{day:02d}"
+    except (AttributeError, ValueError):
+        return processed_datetime[:10] if processed_datetime else None
+
+
+def match_query(text):
+    """Turn free text into an FTS5 query: every word must match as a prefix"""
+    words = text.split()
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in words) or None
+
+
+class TransactionStore:
+    """Append-only SQLite store that is the system of record for transactions"""
+
+    def __init__(self, db_file="mpesa_transactions.db"):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        # WAL keeps appends sequential and lets readers (exports) run alongside the writer;
+        # NORMAL sync is still durable across application crashes in WAL mode
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.setup_schema()
+
+    def setup_schema(self):
+        """Create the transactions table, its query indexes and the token index"""
+        columns = ", ".join(f"{field} TEXT" for field in FIELDS[1:])
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS transactions ("
+            f"id INTEGER PRIMARY KEY, transaction_code TEXT NOT NULL, {columns}, "
+            f"amount_cents INTEGER, day TEXT)"
+        )
+        # B-tree index makes duplicate detection and inserts O(log n)
+        self.conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_code "
+            "ON transactions (transaction_code)"
+        )
+        existing = {row[1] for row in self.conn.execute("PRAGMA table_info(transactions)")}
+        if "amount_cents" not in existing:
+            # Stores created before search existed get the derived columns backfilled once
+            self.conn.execute("ALTER TABLE transactions ADD COLUMN amount_cents INTEGER")
+            self.conn.execute("ALTER TABLE transactions ADD COLUMN day TEXT")
+            self.conn.create_function("amount_cents", 1, amount_cents, deterministic=True)
+            self.conn.create_function("iso_day", 2, iso_day, deterministic=True)
+            self.conn.execute(
+                "UPDATE transactions SET amount_cents = amount_cents(amount), "
+                "day = iso_day(date, processed_datetime)"
+            )
+
+        # Search results are newest first (by id), so each filter index ends in id
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_type ON transactions (transaction_type, id)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_day ON transactions (day, id)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_amount ON transactions (amount_cents, id)")
+
+        # Token index over counterparty and message text; prefix indexes serve search-as-you-type
+        has_tokens = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'transaction_tokens'"
+        ).fetchone()
+        self.conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS transaction_tokens USING fts5("
+            "recipient_sender, raw_message, content='transactions', content_rowid='id', "
+            "detail='column', prefix='2 3')"
+        )
+        self.conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS transactions_tokens_insert AFTER INSERT ON transactions BEGIN "
+            "INSERT INTO transaction_tokens (rowid, recipient_sender, raw_message) "
+            "VALUES (new.id, new.recipient_sender, new.raw_message); END"
+        )
+        if not has_tokens:
+            self.conn.execute("INSERT INTO transaction_tokens (transaction_tokens) VALUES ('rebuild')")
+        self.conn.commit()
+
+    def _insert_sql(self):
+        columns = FIELDS + QUERY_FIELDS
+        placeholders = ", ".join("?" for _ in columns)
+        return f"INSERT OR IGNORE INTO transactions ({', '.join(columns)}) VALUES ({placeholders})"
+
+    @staticmethod
+    def _values(transaction):
+        row = transaction.as_row()
+        return row + [amount_cents(row[1]), iso_day(row[4], row[10])]
+
+    def add(self, transaction):
+        """Insert one transaction; returns False if its code is already stored"""
+        with self.conn:
+            cursor = self.conn.execute(self._insert_sql(), self._values(transaction))
+        return cursor.rowcount == 1
+
+    def add_many(self, transactions):
+        """Insert many transactions in a single commit; returns the number inserted"""
+        before = self.max_id()
+        with self.conn:
+            self.conn.executemany(
+                self._insert_sql(),
+                (self._values(t) for t in transactions)
+            )
+        # total_changes would also count token index writes; rows are only ever appended
+        return self.max_id() - before
+
+    def add_batch(self, transactions):
+        """Insert transactions in a single commit; returns the ones that were not duplicates"""
+        sql = self._insert_sql()
+        inserted = []
+        with self.conn:
+            for transaction in transactions:
+                cursor = self.conn.execute(sql, self._values(transaction))
+                if cursor.rowcount == 1:
+                    inserted.append(transaction)
+        return inserted
+
+    def contains(self, transaction_code):
+        """Check whether a transaction code has already been stored"""
+        row = self.conn.execute(
+            "SELECT 1 FROM transactions WHERE transaction_code = ?", (transaction_code,)
+        ).fetchone()
+        return row is not None
+
+    def count(self):
+        """Return the number of stored transactions"""
+        return self.conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+
+    def max_id(self):
+        """Return the id of the newest stored row (0 when empty)"""
+        return self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM transactions").fetchone()[0]
+
+    def _count_up_to(self, sql, params, cap):
+        """Count a query's rows, stopping at cap so probing a broad filter stays cheap"""
+        return self.conn.execute(f"SELECT COUNT(*) FROM ({sql} LIMIT {cap})", params).fetchone()[0]
+
+    def search(self, text=None, transaction_type=None, date_from=None, date_to=None,
+               min_amount=None, max_amount=None, code=None, before=None, limit=SEARCH_LIMIT):
+        """Return (rows, next_cursor) for transactions matching every given filter, newest first.
+
+        text matches words (or word prefixes) in the counterparty and message; dates are
+        inclusive 'YYYY-MM-DD' strings and amounts are KSh. Rows are dicts keyed by FIELDS
+        plus id. Pass next_cursor back as before for the next page; it is None on the last one.
+        """
+        limit = max(1, min(int(limit), MAX_SEARCH_LIMIT))
+        match = match_query(text) if text else None
+        # Indexed filters as (index, column, lower bound, upper bound)
+        ranges = {}
+        if code:
+            code = code.strip().upper()
+            ranges["code"] = ("idx_transactions_code", "transaction_code", code, code)
+        if date_from or date_to:
+            ranges["day"] = ("idx_transactions_day", "day", date_from, date_to)
+        if min_amount is not None or max_amount is not None:
+            ranges["amount"] = ("idx_transactions_amount", "amount_cents",
+                                None if min_amount is None else amount_cents(str(min_amount)),
+                                None if max_amount is None else amount_cents(str(max_amount)))
+
+        def bounds(column, low, high):
+            parts, values = [], []
+            if low is not None:
+                parts.append(f"{column} >= ?")
+                values.append(low)
+            if high is not None:
+                parts.append(f"{column} <= ?")
+                values.append(high)
+            return parts, values
+
+        # The scan is driven by the most selective filter. One matching at most
+        # DRIVER_CAP rows is read through its index and sorted; when every filter
+        # is broad, walking newest-first reaches a page of matches quickly.
+        selectivity = []
+        if match:
+            selectivity.append((self._count_up_to(
+                "SELECT 1 FROM transaction_tokens WHERE transaction_tokens MATCH ?", [match], DRIVER_CAP), "text"))
+        for name, (index, column, low, high) in ranges.items():
+            parts, values = bounds(column, low, high)
+            selectivity.append((self._count_up_to(
+                f"SELECT 1 FROM transactions INDEXED BY {index} WHERE {' AND '.join(parts)}", values, DRIVER_CAP), name))
+        driver = min(selectivity)[1] if selectivity and min(selectivity)[0] < DRIVER_CAP else None
+        if driver is None and match:
+            driver = "text"
+
+        conditions, params = [], []
+        if driver == "text":
+            # The token index walks its matches in rowid order
+            source = "transaction_tokens JOIN transactions t ON t.id = transaction_tokens.rowid"
+            id_column = "transaction_tokens.rowid"
+            conditions.append("transaction_tokens MATCH ?")
+            params.append(match)
+        else:
+            source = f"transactions t INDEXED BY {ranges[driver][0]}" if driver else "transactions t"
+            id_column = "t.id"
+            if match:
+                conditions.append("t.id IN (SELECT rowid FROM transaction_tokens WHERE transaction_tokens MATCH ?)")
+                params.append(match)
+        for name, (index, column, low, high) in ranges.items():
+            # A unary + keeps SQLite from using the index of a filter that is not driving
+            parts, values = bounds(("t." if name == driver else "+t.") + column, low, high)
+            conditions.extend(parts)
+            params.extend(values)
+        if transaction_type:
+            # Without a driver, the (type, id) index yields rows newest-first
+            conditions.append("t.transaction_type = ?" if driver is None else "+t.transaction_type = ?")
+            params.append(transaction_type)
+        if before:
+            if not str(before).isdigit():
+                raise ValueError(f"invalid cursor {before!r}")
+            conditions.append(f"{id_column} < ?")
+            params.append(int(before))
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self.conn.execute(
+            f"SELECT t.id, {', '.join('t.' + field for field in FIELDS)} FROM {source} {where} "
+            f"ORDER BY {id_column} DESC LIMIT ?",
+            params + [limit + 1],
+        ).fetchall()
+
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return [dict(zip(["id"] + FIELDS, row)) for row in rows[:limit]], next_cursor
+
+    def iter_rows(self, batch_size=1000, month=None):
+        """Yield stored transactions as tuples in FIELDS order, oldest first
+
+        month ('YYYY-MM') limits the rows to that month's transaction days.
+        """
+        where, params = "", ()
+        if month:
+            where, params = "WHERE day BETWEEN ? AND ?", (month + "-01", month + "-31")
+        cursor = self.conn.execute(
+            f"SELECT {', '.join(FIELDS)} FROM transactions {where} ORDER BY id", params
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+    def month_counts(self):
+        """Return {'YYYY-MM': number of transactions} by transaction day"""
+        return dict(self.conn.execute(
+            "SELECT substr(day, 1, 7), COUNT(*) FROM transactions WHERE day IS NOT NULL GROUP BY 1"
+        ))
+
+    def iter_codes(self, offset=0, batch_size=10000):
+        """Yield transaction codes in store order, skipping the first offset rows"""
+        cursor = self.conn.execute(
+            "SELECT transaction_code FROM transactions ORDER BY id LIMIT -1 OFFSET ?", (offset,)
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row[0]
+
+    def open_reader(self):
+        """Open a separate read-only connection, for long scans that must not share the writer's"""
+        # WAL lets it read a consistent snapshot while the writer keeps committing
+        return sqlite3.connect(f"file:{quote(os.path.abspath(self.db_file))}?mode=ro", uri=True,
+                               check_same_thread=False)
+
+    def sync(self):
+        """Force committed transactions to disk
+
+        With synchronous=NORMAL a commit survives an application crash but not
+        a power cut until the WAL is synced; fsyncing the WAL file makes every
+        commit so far durable, which is what the message journal waits for.
+        """
+        for path in (self.db_file + "-wal", self.db_file):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        """Close the database connection"""
+        self.conn.close()